@@ -0,0 +1,224 @@
+"""
+Admission control. Requests are sorted into route classes, health checks, reads and writes, each admitted up to its
+own concurrency limit, so a spike of slow reads cannot take the worker threads and connections health checks and
+writes need. Requests over the limit wait in a bounded queue, and are shed with 503 when the queue is full or they
+waited too long. With a rate limit set, each client also draws its requests from a token bucket and is answered 429
+once it runs dry. Both answers carry a Retry-After header.
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+
+from starlette.responses import JSONResponse
+
+from app.config import settings
+from app.metrics import REGISTRY
+
+# Route classes
+HEALTH = "health"
+READ = "read"
+WRITE = "write"
+
+# The paths of the health route class, admitted on their own reserved slots and never rate limited
+HEALTH_PATHS = ("/health_check", "/metrics")
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# Token buckets kept, the least recently seen clients are forgotten beyond it
+MAX_RATE_LIMITED_CLIENTS = 10000
+
+ADMISSION_SHED = REGISTRY.counter(
+    "greystone_admission_shed_total", "Requests turned away by admission control, by route class and reason",
+    ("route_class", "reason"))
+ADMISSION_QUEUED = REGISTRY.counter(
+    "greystone_admission_queued_total", "Requests that waited in the admission queue for a slot", ("route_class",))
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    "greystone_admission_wait_seconds", "Time queued requests waited for a slot", ("route_class",))
+ADMISSION_REQUESTS = REGISTRY.gauge(
+    "greystone_admission_requests", "Requests admitted and running or waiting in the admission queue",
+    ("route_class", "state"))
+
+
+class Shed(Exception):
+    """
+    Raised when a request is not admitted, `reason` being one of queue_full, queue_timeout or rate_limited
+    """
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class ConcurrencyLimiter:
+    """
+    Admits up to `limit` requests at once and queues up to `queue_size` more, first in first out. A released
+    slot is handed straight to the longest waiting request. Only used from the event loop, so it needs no lock.
+    """
+
+    def __init__(self, limit: int, queue_size: int):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self._waiters = deque()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    async def acquire(self, timeout: float) -> bool:
+        """
+        Takes a slot, waiting up to `timeout` seconds for one. Returns whether the request had to wait.
+        """
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return False
+        if len(self._waiters) >= self.queue_size:
+            raise Shed("queue_full", settings.admission_retry_after)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            raise Shed("queue_timeout", settings.admission_retry_after)
+        except BaseException:
+            # Given the slot just as the request went away
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+        return True
+
+    def release(self):
+        self.active -= 1
+        while self._waiters and self.active < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.active += 1
+
+class TokenBucket:
+    """
+    Holds up to `burst` tokens, refilled at `rate` tokens a second
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """
+        Takes a token. Returns 0 when there was one, otherwise the seconds until there will be.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    """
+    A token bucket per client key, the least recently seen clients are forgotten beyond `max_clients`
+    """
+
+    def __init__(self, rate: float, burst: int, max_clients: int = MAX_RATE_LIMITED_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+
+    def check(self, client: str):
+        """
+        Raises Shed when the client has no token left
+        """
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+        wait = bucket.take()
+        if wait:
+            raise Shed("rate_limited", wait)
+
+def route_class(scope) -> str:
+    if scope["path"] in HEALTH_PATHS:
+        return HEALTH
+    return READ if scope["method"] in READ_METHODS else WRITE
+
+def client_key(scope) -> str:
+    """
+    The key clients are rate limited by: the configured client header when the request has it, its address otherwise
+    """
+    header = settings.admission_client_header.lower().encode()
+    for name, value in scope["headers"]:
+        if name == header:
+            return value.decode("latin-1")
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware admitting HTTP requests under the per route class concurrency limits and per client rate limit,
+    when admission control is on. The limits are read from the settings when the middleware is built.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.limiters = {
+            HEALTH: ConcurrencyLimiter(settings.admission_health_limit, settings.admission_queue_size),
+            READ: ConcurrencyLimiter(settings.admission_read_limit, settings.admission_queue_size),
+            WRITE: ConcurrencyLimiter(settings.admission_write_limit, settings.admission_queue_size),
+        }
+        self.rate_limiter = None
+        if settings.rate_limit is not None:
+            self.rate_limiter = RateLimiter(settings.rate_limit, settings.rate_limit_burst)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.admission_control:
+            await self.app(scope, receive, send)
+            return
+        kind = route_class(scope)
+        limiter = self.limiters[kind]
+        try:
+            if self.rate_limiter is not None and kind != HEALTH:
+                self.rate_limiter.check(client_key(scope))
+            start = time.perf_counter()
+            ADMISSION_REQUESTS.inc(route_class=kind, state="waiting")
+            try:
+                queued = await limiter.acquire(settings.admission_queue_timeout)
+            finally:
+                ADMISSION_REQUESTS.dec(route_class=kind, state="waiting")
+        except Shed as shed:
+            ADMISSION_SHED.inc(route_class=kind, reason=shed.reason)
+            await shed_response(shed)(scope, receive, send)
+            return
+        if queued:
+            ADMISSION_QUEUED.inc(route_class=kind)
+            ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start, route_class=kind)
+        ADMISSION_REQUESTS.inc(route_class=kind, state="running")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            ADMISSION_REQUESTS.dec(route_class=kind, state="running")
+            limiter.release()
+
+def shed_response(shed: Shed):
+    """
+    429 for a client over its rate limit, 503 for a request shed under load, both with a whole seconds Retry-After
+    """
+    if shed.reason == "rate_limited":
+        status_code, detail = 429, "Too many requests"
+    else:
+        status_code, detail = 503, "Server busy"
+    return JSONResponse({"detail": detail}, status_code=status_code,
+                        headers={"Retry-After": str(max(1, math.ceil(shed.retry_after)))})
@@ -0,0 +1,124 @@
+"""
+Async handlers for the core user and loan routes, served on the async engine instead of the
+threadpool when GREYSTONE_DATABASE_ASYNC is enabled. They mirror the sync handlers in app.main.
+"""
+from fastapi import APIRouter, Depends, Query, Request, Response
+from fastapi.exceptions import HTTPException
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import schemas
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.http_cache import is_not_modified, make_etag, not_modified, with_cache_headers
+from app.idempotency import IdempotentRequest
+from app.jobs import BACKGROUND_RESPONSES, accepted_response, get_job_queue
+from app.logic.async_loan import create_loan, get_loan, get_loan_schedule, get_loan_version, get_month_summary, share_loan
+from app.logic.async_user import create_user, get_user_by_email, get_user_loans
+from app.logic.loan import build_loan_response
+from app.logic.ping_db import async_ping_db
+from app.profiling import TimedRoute
+from app.serialization import fast_response
+
+router = APIRouter(route_class=TimedRoute)
+
+# Dependency
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+@router.get("/health_check")
+async def health_check(db: AsyncSession = Depends(get_db)):
+    if await async_ping_db(db=db):
+        return {"Status": "Ok"}
+    else:
+        raise HTTPException(status_code=400, detail="No Database Connection")
+
+@router.post("/users/", response_model=schemas.User, status_code=201)
+async def register_user(request: Request, user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+    async with IdempotentRequest(request, user) as idempotency:
+        if idempotency.response is not None:
+            return idempotency.response
+        db_user = await get_user_by_email(db, email=user.email)
+        if db_user:
+            raise HTTPException(status_code=400, detail="Email already registered")
+        try:
+            db_user = await create_user(db=db, user=user)
+        except IntegrityError:
+            # Another request registered the email since it was looked up
+            raise HTTPException(status_code=400, detail="Email already registered")
+        idempotency.complete(f"users/{db_user.id}")
+        return db_user
+
+@router.get("/users/{email}/loans/", response_model=list[schemas.UserLoan], response_model_exclude_unset=True)
+async def read_user_loans(request: Request, response: Response, email: str, include_months: bool = True,
+                          db: AsyncSession = Depends(get_db)):
+    db_user = await get_user_by_email(db, email=email)
+    if not db_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    etag = make_etag("user", db_user.id, db_user.loans_version, "loans", int(include_months))
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    with_cache_headers(response, etag)
+    loans = await get_user_loans(db=db, user=db_user, include_months=include_months)
+    if not include_months:
+        return [schemas.LoanHeader.from_orm(loan) for loan in loans]
+    return [build_loan_response(loan, schemas.UserLoan) for loan in loans]
+
+@router.post("/loans/{email}/", response_model=schemas.Loan, status_code=201, responses=BACKGROUND_RESPONSES)
+async def create_user_loan(request: Request, loan: schemas.LoanCreate, email: str, db: AsyncSession = Depends(get_db)):
+    async with IdempotentRequest(request, loan) as idempotency:
+        if idempotency.response is not None:
+            return idempotency.response
+        db_user = await get_user_by_email(db, email=email)
+        if not db_user:
+            raise HTTPException(status_code=404, detail="No user for loan found")
+        if settings.background_writes:
+            job = get_job_queue().submit("create_loan", {"email": db_user.email, "loan": loan.dict()})
+            idempotency.complete(f"jobs/{job.id}", status_code=202)
+            return accepted_response(job)
+        _loan = await create_loan(db=db, loan=loan, user=db_user)
+        idempotency.complete(f"loans/{_loan.id}")
+        return build_loan_response(_loan)
+
+@router.get("/loans/{id}/schedule/")
+async def read_loan_schedule(request: Request, response: Response, id: int, from_month: int = Query(1, ge=1),
+                            to_month: int | None = Query(None, ge=1), db: AsyncSession = Depends(get_db)) -> list[schemas.ScheduleItem]:
+    version = await get_loan_version(db=db, loan_id=id)
+    etag = None if version is None else make_etag("loan", id, version, "schedule", from_month, to_month)
+    if etag is not None and is_not_modified(request, etag):
+        return not_modified(etag)
+    result = await get_loan_schedule(db=db, loan_id=id, from_month=from_month, to_month=to_month)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    if settings.fast_serialization:
+        return with_cache_headers(fast_response(schemas.ScheduleItem, result), etag)
+    with_cache_headers(response, etag)
+    return result
+
+@router.get("/loans/{id}/month/{month}/")
+async def read_month_summary(request: Request, response: Response, id: int, month: int,
+                             db: AsyncSession = Depends(get_db)) -> schemas.MonthSummary:
+    version = await get_loan_version(db=db, loan_id=id)
+    etag = None if version is None else make_etag("loan", id, version, "month", month)
+    if etag is not None and is_not_modified(request, etag):
+        return not_modified(etag)
+    result = await get_month_summary(db=db, loan_id=id, month=month)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    if result["principal_balance"] is None:
+        raise HTTPException(status_code=404, detail="Requested month not found")
+    if settings.fast_serialization:
+        return with_cache_headers(fast_response(schemas.MonthSummary, result), etag)
+    with_cache_headers(response, etag)
+    return result
+
+@router.patch("/loans/{id}/share/{email}/")
+async def share_loan_with_user(id: int, email: str, db: AsyncSession = Depends(get_db)):
+    db_user = await get_user_by_email(db, email=email)
+    db_loan = await get_loan(db=db, id=id)
+    if db_loan is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    await share_loan(db=db, user=db_user, loan=db_loan)
@@ -0,0 +1,21 @@
+"""
+Brings a database created by an earlier version of the application up to date: migrates its schema
+and fills in the loan month running totals for every existing loan.
+
+Usage: python -m app.backfill
+"""
+from app.database import SessionLocal
+from app.logic.loan import backfill_loan_month_totals
+from app.migrations import upgrade
+
+
+def main():
+    upgrade()
+    db = SessionLocal()
+    try:
+        print(f"Backfilled running totals for {backfill_loan_month_totals(db)} loans")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+from typing import Literal
+
+from pydantic import BaseSettings, Field, root_validator
+
+
+class Settings(BaseSettings):
+    """
+    Deployment configuration, read from GREYSTONE_* environment variables
+    """
+    schedule_storage: Literal["rows", "lazy", "packed"] = Field("rows", description="""
+        How new loans keep their payout schedule. "rows" persists a loan month per month of the term,
+        "lazy" stores only the loan terms and computes the months on demand, "packed" stores the months
+        of a loan in a single binary blob on the loan""")
+    database_url: str = Field("sqlite:///./greystone_app.db", description="The SQLAlchemy URL of the database")
+    database_async: bool = Field(False, description="""
+        Serve the core user and loan routes with async handlers on an async engine""")
+    async_database_url: str | None = Field(None, description="""
+        The async driver URL of the database, e.g. sqlite+aiosqlite:// or postgresql+asyncpg://.
+        Defaults to the database URL with its driver swapped for the async one""")
+    migrate_on_startup: bool = Field(True, description="""
+        Upgrade the database schema when the application starts. Turn off when several processes share the
+        database and migrations run as a separate deployment step""")
+
+    shards: dict[str, str] = Field({}, description="""
+        Further databases to spread the loans over, as a JSON object of shard names to SQLAlchemy URLs.
+        The database at the database URL is the "main" shard, which also holds the users and hands out the
+        loan ids. Every loan is placed on a shard by a hash of its id, see app.sharding""")
+    shard_id_block_size: int = Field(1000, description="Loan ids each process reserves from the main shard at a time")
+
+    pool_size: int = Field(5, description="Connections kept open in the pool")
+    max_overflow: int = Field(10, description="Connections opened beyond pool_size under load")
+    pool_timeout: float = Field(30, description="Seconds to wait for a connection before giving up")
+    pool_pre_ping: bool = Field(False, description="Test connections for liveness on checkout")
+    pool_recycle: int = Field(-1, description="Seconds after which connections are replaced, -1 to never replace them")
+
+    sqlite_journal_mode: str = Field("wal", description="""
+        SQLite journal mode, WAL lets readers proceed while a write is in progress""")
+    sqlite_synchronous: str = Field("normal", description="""
+        SQLite sync level, NORMAL is durable across application crashes in WAL mode""")
+    sqlite_busy_timeout: int = Field(5000, description="""
+        Milliseconds a SQLite connection waits for a lock before failing with 'database is locked'""")
+    sqlite_cache_size: int = Field(-65536, description="SQLite page cache size, in KiB when negative")
+    sqlite_mmap_size: int = Field(268435456, description="Bytes of the SQLite database file to memory map")
+
+    cache_backend: Literal["memory", "redis", "none"] = Field("memory", description="""
+        Where computed loan schedules and month summaries are cached, "none" disables the cache""")
+    cache_ttl: float = Field(3600, description="Seconds a cached loan schedule or month summary is kept")
+    cache_max_bytes: int = Field(64 * 1024 * 1024, description="Estimated memory bound of the in-process cache")
+    redis_url: str = Field("redis://localhost:6379/0", description="The Redis server of the redis cache backend")
+
+    profile_slow_requests: float | None = Field(None, description="""
+        Requests taking at least this many seconds have their cProfile profile saved, profiling is off when unset""")
+    profile_dir: str = Field("./profiles", description="Where the profiles of slow requests are saved")
+
+    simulation_workers: int | None = Field(None, description="Processes running simulations, the number of CPUs by default")
+    simulation_batch_size: int = Field(1000, description="Scenarios simulated together as one batch of arrays")
+    simulation_max_scenarios: int = Field(100000, description="The largest scenario grid a simulation request may ask for")
+
+    amortization_cache_size: int = Field(4096, description="Loan products, (interest rate, term) pairs, kept in the amortization factor table")
+    amortization_prewarm_terms: list[int] = Field([180, 240, 360], description="""
+        Terms, in months, whose factors are computed at startup for every prewarmed interest rate""")
+    amortization_prewarm_rate_step: float = Field(0.125, description="Step between the prewarmed interest rates")
+    amortization_prewarm_max_rate: float = Field(12, description="""
+        The highest prewarmed interest rate, the prewarmed rates run from zero up to it""")
+
+    background_writes: bool = Field(False, description="""
+        Create loans in background jobs, the loan creation routes answer 202 with a job id to poll at /jobs/{id}""")
+    job_backend: Literal["memory", "redis"] = Field("memory", description="""
+        Where jobs are queued, "memory" for the application process, "redis" to share the queue between processes""")
+    job_workers: int = Field(2, description="Worker threads running background jobs in each process")
+    job_batch_size: int = Field(120, description="Loan months a background job writes per transaction")
+    job_ttl: float = Field(86400, description="Seconds finished jobs can still be looked up")
+
+    admission_control: bool = Field(False, description="""
+        Admit requests under per route class concurrency limits and the per client rate limit""")
+    # All three limits together stay within the connection pool, pool_size + max_overflow, and the threadpool
+    admission_read_limit: int = Field(8, description="Read requests handled at once")
+    admission_write_limit: int = Field(4, description="Write requests handled at once")
+    admission_health_limit: int = Field(2, description="Health check requests handled at once, on slots of their own")
+    admission_queue_size: int = Field(64, description="Requests of each route class that may wait for a slot")
+    admission_queue_timeout: float = Field(5, description="Seconds a request waits for a slot before it is shed with 503")
+    admission_retry_after: int = Field(1, description="The Retry-After, in seconds, of requests shed with 503")
+    admission_client_header: str = Field("X-Client-Id", description="""
+        The header identifying clients for the rate limit, requests without it are keyed by their address""")
+    rate_limit: float | None = Field(None, description="Requests a second each client may make, unlimited when unset")
+    rate_limit_burst: int = Field(20, description="Requests a client may make at once before the rate limit applies")
+
+    idempotency_ttl: float = Field(86400, description="""
+        Seconds the response of a create request sent with an Idempotency-Key is replayed to requests with the same key""")
+    idempotency_lock_timeout: float = Field(300, description="""
+        Seconds after which a request holding an Idempotency-Key is taken for abandoned, e.g. by a crashed process,
+        and a request with the same key may run instead""")
+    idempotency_wait_timeout: float = Field(10, description="""
+        Seconds a request waits for another one with the same Idempotency-Key to finish before it fails with 409""")
+
+    http_cache_max_age: int = Field(60, description="""
+        Seconds clients and shared caches may reuse a loan read without revalidating its ETag""")
+
+    fast_serialization: bool = Field(False, description="""
+        Serialize loan schedules and month summaries with orjson instead of validating them against their response models""")
+
+    @root_validator(skip_on_failure=True)
+    def check_shards(cls, values):
+        if values["shards"] and values["database_async"]:
+            raise ValueError("Sharding is only supported by the sync routes")
+        if "main" in values["shards"]:
+            raise ValueError('The shard name "main" is taken by the database URL')
+        return values
+
+    class Config:
+        env_prefix = "GREYSTONE_"
+
+settings = Settings()
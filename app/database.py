@@ -1,11 +1,140 @@
-from sqlalchemy import create_engine
+import time
+import weakref
+from functools import lru_cache
+
+from sqlalchemy import Table, create_engine, event, exc
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine, URL, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from app.config import settings
+from app.metrics import REGISTRY
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./greystone_app.db"
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+DIALECT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+POOL_CHECKOUT_SECONDS = REGISTRY.histogram(
+    "greystone_db_pool_checkout_seconds", "Time spent waiting for a connection from the pool", ("database",))
+POOL_CHECKOUT_TIMEOUTS = REGISTRY.counter(
+    "greystone_db_pool_checkout_timeouts_total", "Connection checkouts that gave up after the pool timeout", ("database",))
+_engines = weakref.WeakSet()
+POOL_CHECKED_OUT = REGISTRY.gauge(
+    "greystone_db_pool_checked_out", "Connections currently checked out of the pool", ("database",),
+    callback=lambda: [({"database": engine.pool.logging_name}, engine.pool.checkedout())
+                      for engine in list(_engines) if isinstance(engine.pool, QueuePool)])
 
 Base = declarative_base()
+
+
+class _TimedCheckout:
+    """
+    Pool mixin recording how long every checkout waits for a connection, labelled with the pool logging name
+    """
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            POOL_CHECKOUT_TIMEOUTS.inc(database=self.logging_name)
+            raise
+        finally:
+            POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - start, database=self.logging_name)
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+def create_db_engine(url: str | URL | None = None, **options) -> Engine:
+    """
+    Creates an engine for `url`, the configured database URL by default, with the configured pool
+    settings and, for SQLite, the configured pragmas. Keyword `options` override any create_engine argument.
+    """
+    url = make_url(url or settings.database_url)
+    engine = create_engine(url, **{**_engine_options(url, TimedQueuePool), **options})
+    _instrument(engine)
+    return engine
+
+def create_async_db_engine(url: str | URL | None = None, **options) -> AsyncEngine:
+    """
+    Creates an async engine, see create_db_engine. `url` defaults to the configured async database URL,
+    or failing that to the database URL with its driver swapped for the async one.
+    """
+    url = make_url(url or settings.async_database_url or get_async_url(settings.database_url))
+    engine = create_async_engine(url, **{**_engine_options(url, TimedAsyncAdaptedQueuePool), **options})
+    _instrument(engine.sync_engine)
+    return engine
+
+def get_async_url(url: str | URL) -> URL:
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+@lru_cache(maxsize=None)
+def get_engine() -> Engine:
+    """
+    The engine of the configured database, created on first use
+    """
+    return create_db_engine()
+
+@lru_cache(maxsize=None)
+def get_async_engine() -> AsyncEngine:
+    """
+    The async engine of the configured database, created on first use
+    """
+    return create_async_db_engine()
+
+@lru_cache(maxsize=None)
+def _get_sessionmaker():
+    return sessionmaker(autocommit=False, autoflush=False, bind=get_engine())
+
+@lru_cache(maxsize=None)
+def _get_async_sessionmaker():
+    # Objects are not expired on commit, as expired attributes cannot be lazy loaded outside of an await
+    return async_sessionmaker(get_async_engine(), autoflush=False, expire_on_commit=False)
+
+def SessionLocal():
+    """
+    Opens a session on the configured database
+    """
+    return _get_sessionmaker()()
+
+def AsyncSessionLocal():
+    """
+    Opens an async session on the configured database
+    """
+    return _get_async_sessionmaker()()
+
+def insert_or_ignore(table: Table, dialect: str):
+    """
+    An INSERT ... ON CONFLICT DO NOTHING into `table` for the `dialect` of the database, skipping the rows
+    that conflict with rows already there
+    """
+    return DIALECT_INSERTS[dialect](table).on_conflict_do_nothing()
+
+def _engine_options(url: URL, poolclass):
+    options = {"pool_pre_ping": settings.pool_pre_ping, "pool_recycle": settings.pool_recycle}
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            # In memory databases live and die with their single connection, there is no pool to size
+            return options
+        options["connect_args"] = {"check_same_thread": False}
+    options.update(poolclass=poolclass, pool_size=settings.pool_size, max_overflow=settings.max_overflow,
+                   pool_timeout=settings.pool_timeout, pool_logging_name=url.database or url.get_backend_name())
+    return options
+
+def _instrument(engine: Engine):
+    _engines.add(engine)
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={settings.sqlite_journal_mode}")
+    cursor.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+    cursor.execute(f"PRAGMA busy_timeout={int(settings.sqlite_busy_timeout)}")
+    cursor.execute(f"PRAGMA cache_size={int(settings.sqlite_cache_size)}")
+    cursor.execute(f"PRAGMA mmap_size={int(settings.sqlite_mmap_size)}")
+    cursor.close()
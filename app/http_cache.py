@@ -0,0 +1,42 @@
+"""
+Conditional GETs for the loan read routes. What they return only changes when the version of the loan, or for a
+user's loans the loan set version of the user, is bumped. Their strong ETags are derived from these versions,
+so a request whose If-None-Match holds the current ETag is answered 304 Not Modified after looking up the version
+alone, before any schedule or loan month is loaded. Cache-Control lets shared caches serve repeat reads and
+revalidate them with the ETag.
+"""
+from fastapi import Request, Response
+
+from app.config import settings
+
+
+def make_etag(*parts) -> str:
+    """
+    A strong ETag made of the version it derives from and whatever else tells the representations of the
+    route apart, such as the requested window of a schedule
+    """
+    return '"' + "-".join("" if part is None else str(part) for part in parts) + '"'
+
+def cache_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": f"public, max-age={settings.http_cache_max_age}"}
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    """
+    Whether the request's If-None-Match matches `etag`. If-None-Match compares ETags weakly, ignoring a W/ prefix.
+    """
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in (tag.removeprefix("W/") for tag in tags)
+
+def not_modified(etag: str):
+    return Response(status_code=304, headers=cache_headers(etag))
+
+def with_cache_headers(response: Response, etag: str | None):
+    """
+    Adds the ETag and Cache-Control headers to a response, if there is an ETag
+    """
+    if etag is not None:
+        response.headers.update(cache_headers(etag))
+    return response
@@ -0,0 +1,169 @@
+"""
+Idempotency keys for the create routes, POST /users/ and POST /loans/{email}/.
+
+A request sent with an Idempotency-Key header claims its key in the idempotency_keys table of the main
+database, along with a hash of the request, before it does anything else. Once it created what it was sent
+to create, a reference to it, such as loans/1, is stored with the key. Retries of the request with the same
+key are answered from that reference, with the resource as it is now and an Idempotent-Replayed header,
+without creating it again. A retry arriving while the request is still in flight waits for it to finish.
+
+Keys are kept for the idempotency TTL after their request finished. A request that failed releases its key,
+so it can be retried, and the key of a request that never finished, e.g. as its process crashed, can be
+claimed again after the idempotency lock timeout.
+"""
+import hashlib
+import time
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from sqlalchemy import delete, select
+from starlette.concurrency import run_in_threadpool
+
+from app import schemas
+from app.config import settings
+from app.database import SessionLocal, get_engine, insert_or_ignore
+from app.jobs import accepted_response, get_job_queue
+from app.logic.loan import build_loan_response, get_loan
+from app.metrics import REGISTRY
+from app.models import User, idempotency_keys
+from app.sharding import ShardSession, shard_for_loan, sharding_enabled
+
+MAX_KEY_LENGTH = 255
+# Seconds between the looks a waiting request takes at the key of the request in flight
+POLL_INTERVAL = 0.05
+# Seconds between the deletions of all expired keys, done by whichever request comes along next
+CLEANUP_INTERVAL = 60
+
+IDEMPOTENT_REQUESTS = REGISTRY.counter(
+    "greystone_idempotent_requests_total", "Requests sent with an Idempotency-Key, by outcome", ("outcome",))
+
+_last_cleanup = 0.0
+
+
+def request_hash(request: Request, payload: BaseModel) -> str:
+    """
+    A hash of what a request asks for: its method, its path and its body
+    """
+    return hashlib.sha256(f"{request.method} {request.url.path} {payload.json(sort_keys=True)}".encode()).hexdigest()
+
+class IdempotentRequest:
+    """
+    Claims the Idempotency-Key of a create request on entry, as a `with` block around the route, or an
+    `async with` one in async routes. A retry of a finished request enters with the original `response` to
+    return. Otherwise the route calls complete with a reference to what it created before it returns, which
+    is stored with the key on exit. Requests without an Idempotency-Key pass through untouched.
+    """
+    def __init__(self, request: Request, payload: BaseModel):
+        self.key = request.headers.get("idempotency-key")
+        if self.key is not None and not 0 < len(self.key) <= MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters")
+        self.request_hash = self.key and request_hash(request, payload)
+        self.response = None
+        self.response_ref = None
+        self.status_code = None
+
+    def complete(self, response_ref: str, status_code: int = 201):
+        """
+        Records where the response of the request is read back from, e.g. loans/1
+        """
+        self.response_ref = response_ref
+        self.status_code = status_code
+
+    def __enter__(self):
+        if self.key is not None:
+            self.response = self._claim()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.key is None or self.response is not None:
+            return
+        with get_engine().begin() as connection:
+            if exc_type is None and self.response_ref is not None:
+                connection.execute(idempotency_keys.update().where(idempotency_keys.c.key == self.key).values(
+                    response_ref=self.response_ref, status_code=self.status_code,
+                    expires_at=time.time() + settings.idempotency_ttl))
+            else:
+                # A failed request leaves nothing to replay, its retries run it again
+                connection.execute(delete(idempotency_keys).where(idempotency_keys.c.key == self.key))
+
+    async def __aenter__(self):
+        return await run_in_threadpool(self.__enter__)
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await run_in_threadpool(self.__exit__, exc_type, exc, traceback)
+
+    def _claim(self):
+        """
+        Claims the key, returning None, or returns the response of the request that claimed it before,
+        waiting for that request to finish if it is still in flight
+        """
+        deadline = time.monotonic() + settings.idempotency_wait_timeout
+        while True:
+            row = self._try_claim()
+            if row is None:
+                IDEMPOTENT_REQUESTS.inc(outcome="claimed")
+                return None
+            if row.request_hash != self.request_hash:
+                IDEMPOTENT_REQUESTS.inc(outcome="mismatched")
+                raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+            if row.response_ref is not None:
+                IDEMPOTENT_REQUESTS.inc(outcome="replayed")
+                return replay_response(row.response_ref, row.status_code)
+            if time.monotonic() >= deadline:
+                IDEMPOTENT_REQUESTS.inc(outcome="in_flight")
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in flight",
+                                    headers={"Retry-After": str(max(1, round(settings.idempotency_wait_timeout)))})
+            time.sleep(POLL_INTERVAL)
+
+    def _try_claim(self):
+        """
+        Inserts the key, unless another request holds it, whose row is returned then. Expired keys are
+        deleted first, the claimed key's own expired row always, those of every other key once in a while.
+        """
+        global _last_cleanup
+        now = time.time()
+        with get_engine().begin() as connection:
+            expired = idempotency_keys.c.expires_at < now
+            if now - _last_cleanup >= CLEANUP_INTERVAL:
+                _last_cleanup = now
+                connection.execute(delete(idempotency_keys).where(expired))
+            else:
+                connection.execute(delete(idempotency_keys).where(idempotency_keys.c.key == self.key, expired))
+            claimed = connection.scalar(
+                insert_or_ignore(idempotency_keys, connection.dialect.name)
+                .values(key=self.key, request_hash=self.request_hash, expires_at=now + settings.idempotency_lock_timeout)
+                .returning(idempotency_keys.c.key))
+            if claimed is not None:
+                return None
+            return connection.execute(select(idempotency_keys).where(idempotency_keys.c.key == self.key)).first()
+
+def replay_response(response_ref: str, status_code: int):
+    """
+    Answers a retry with what the response reference points to: a user, a loan or a background job
+    """
+    kind, id = response_ref.split("/", 1)
+    headers = {"Idempotent-Replayed": "true"}
+    if kind == "jobs":
+        job = get_job_queue().get(id)
+        if job is None:
+            # The job outlived its TTL, where to poll for it is all there is left to answer with
+            return JSONResponse({"id": id}, status_code=status_code, headers={"Location": f"/jobs/{id}", **headers})
+        response = accepted_response(job)
+        response.headers.update(headers)
+        return response
+    if kind == "loans":
+        db = ShardSession(shard_for_loan(int(id))) if sharding_enabled() else SessionLocal()
+        serialize, load = build_loan_response, lambda: get_loan(db, int(id))
+    else:
+        db = SessionLocal()
+        serialize, load = schemas.User.from_orm, lambda: db.get(User, int(id))
+    try:
+        resource = load()
+        if resource is None:
+            raise HTTPException(status_code=404, detail="The response of this Idempotency-Key is gone")
+        return JSONResponse(jsonable_encoder(serialize(resource)), status_code=status_code, headers=headers)
+    finally:
+        db.close()
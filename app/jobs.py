@@ -0,0 +1,288 @@
+"""
+Background jobs for heavy writes. With GREYSTONE_BACKGROUND_WRITES the loan creation routes enqueue a job and
+answer 202 with its id at once, a pool of worker threads runs the jobs and GET /jobs/{id} reports their state.
+Jobs are kept by a JobBackend, in the application process by default or in Redis to share one queue between
+processes.
+"""
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from functools import lru_cache
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app import schemas
+from app.config import settings
+from app.database import SessionLocal
+from app.logic.loan import create_loan_in_batches, create_loans_bulk
+from app.logic.shards import create_loan_on_shard, create_loans_bulk_on_shards
+from app.logic.user import get_user_by_email
+from app.metrics import REGISTRY
+from app.sharding import sharding_enabled
+
+# Job.status values
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+JOBS_FINISHED = REGISTRY.counter(
+    "greystone_jobs_total", "Background jobs finished, by kind and final status", ("kind", "status"))
+JOB_SECONDS = REGISTRY.histogram("greystone_job_seconds", "Time background jobs took to run", ("kind",))
+JOB_QUEUE_DEPTH = REGISTRY.gauge(
+    "greystone_job_queue_depth", "Background jobs waiting for a worker",
+    callback=lambda: [({}, get_job_queue().backend.pending())] if settings.background_writes else [])
+
+
+class Job:
+    """
+    A unit of background work: the `kind` of job, the JSON `payload` it runs on and, once it ran,
+    its `result` or `error`. Timestamps are unix times.
+    """
+
+    def __init__(self, kind: str, payload: dict, id: str | None = None, status: str = JOB_QUEUED, result=None,
+                 error: str | None = None, created_at: float | None = None, updated_at: float | None = None):
+        self.id = id or uuid.uuid4().hex
+        self.kind = kind
+        self.payload = payload
+        self.status = status
+        self.result = result
+        self.error = error
+        self.created_at = created_at or time.time()
+        self.updated_at = updated_at or self.created_at
+
+    @property
+    def finished(self):
+        return self.status in (JOB_SUCCEEDED, JOB_FAILED)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, values: dict):
+        return cls(**values)
+
+class JobBackend:
+    """
+    Stores jobs by id and queues the ids of the jobs to run. Jobs are handed out as copies, a job
+    only changes in the backend when it is saved.
+    """
+
+    def push(self, job: Job):
+        """
+        Saves a new job and queues it
+        """
+        raise NotImplementedError
+
+    def pop(self, timeout: float) -> Job | None:
+        """
+        Takes the next queued job, waiting up to `timeout` seconds for one
+        """
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Job | None:
+        raise NotImplementedError
+
+    def save(self, job: Job):
+        raise NotImplementedError
+
+    def pending(self) -> int:
+        """
+        The number of queued jobs
+        """
+        raise NotImplementedError
+
+class InMemoryJobBackend(JobBackend):
+    """
+    Jobs of this process only. Finished jobs are dropped `ttl` seconds after they finished.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._jobs = {}
+        self._queue = queue.Queue()
+        self._expiries = deque()
+        self._lock = threading.Lock()
+
+    def push(self, job: Job):
+        self.save(job)
+        self._queue.put(job.id)
+
+    def pop(self, timeout: float):
+        try:
+            job_id = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+        except queue.Empty:
+            return None
+        return self.get(job_id)
+
+    def get(self, job_id: str):
+        with self._lock:
+            self._expire()
+            values = self._jobs.get(job_id)
+        return None if values is None else Job.from_dict(values)
+
+    def save(self, job: Job):
+        with self._lock:
+            self._jobs[job.id] = job.to_dict()
+            if job.finished:
+                self._expiries.append((time.monotonic() + self.ttl, job.id))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._expiries and self._expiries[0][0] <= now:
+            self._jobs.pop(self._expiries.popleft()[1], None)
+
+class RedisJobBackend(JobBackend):
+    """
+    Jobs shared by every process using the same Redis server. `client` is a redis-py compatible client.
+    Jobs are stored as JSON strings expiring `ttl` seconds after they were last saved, the queue is a list.
+    """
+
+    def __init__(self, client, ttl: float, prefix: str = "greystone:jobs:"):
+        self.client = client
+        self.ttl = int(ttl)
+        self.prefix = prefix
+        self.queue_key = f"{prefix}queue"
+
+    def push(self, job: Job):
+        self.save(job)
+        self.client.lpush(self.queue_key, job.id)
+
+    def pop(self, timeout: float):
+        if timeout > 0:
+            # BRPOP waits whole seconds
+            item = self.client.brpop(self.queue_key, timeout=max(1, round(timeout)))
+            job_id = None if item is None else item[1]
+        else:
+            job_id = self.client.rpop(self.queue_key)
+        if job_id is None:
+            return None
+        return self.get(job_id.decode() if isinstance(job_id, bytes) else job_id)
+
+    def get(self, job_id: str):
+        value = self.client.get(f"{self.prefix}{job_id}")
+        return None if value is None else Job.from_dict(json.loads(value))
+
+    def save(self, job: Job):
+        self.client.set(f"{self.prefix}{job.id}", json.dumps(job.to_dict()), ex=self.ttl)
+
+    def pending(self):
+        return self.client.llen(self.queue_key)
+
+def run_create_loan(db, payload: dict):
+    if sharding_enabled():
+        loan = create_loan_on_shard(schemas.LoanCreate(**payload["loan"]), payload["email"], batch_size=settings.job_batch_size)
+        return {"loan_id": loan.id}
+    user = get_user_by_email(db, payload["email"])
+    if user is None:
+        raise LookupError("No user for loan found")
+    loan = create_loan_in_batches(db, schemas.LoanCreate(**payload["loan"]), user, batch_size=settings.job_batch_size)
+    return {"loan_id": loan.id}
+
+def run_create_loans_bulk(db, payload: dict):
+    loans = [schemas.LoanBulkCreate(**loan) for loan in payload["loans"]]
+    results = create_loans_bulk_on_shards(loans) if sharding_enabled() else create_loans_bulk(db, loans)
+    return [result.dict() for result in results]
+
+# The function running each kind of job, called with a session and the job payload. What it returns is the job result.
+JOB_HANDLERS = {"create_loan": run_create_loan, "create_loans_bulk": run_create_loans_bulk}
+
+class JobQueue:
+    """
+    Submits jobs to a backend and runs them on a pool of worker threads, each job with its own session
+    """
+
+    def __init__(self, backend: JobBackend, handlers: dict = JOB_HANDLERS, session_factory=SessionLocal):
+        self.backend = backend
+        self.handlers = handlers
+        self.session_factory = session_factory
+        self._stopping = threading.Event()
+        self._workers = []
+
+    def submit(self, kind: str, payload: dict) -> Job:
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind {kind}")
+        job = Job(kind, payload)
+        self.backend.push(job)
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self.backend.get(job_id)
+
+    def run_next(self, timeout: float = 0) -> Job | None:
+        """
+        Runs the next queued job, waiting up to `timeout` seconds for one. Returns the finished job, if any.
+        """
+        job = self.backend.pop(timeout)
+        if job is not None:
+            self.run(job)
+        return job
+
+    def run(self, job: Job):
+        job.status, job.updated_at = JOB_RUNNING, time.time()
+        self.backend.save(job)
+        start = time.perf_counter()
+        db = self.session_factory()
+        try:
+            job.result = self.handlers[job.kind](db, job.payload)
+            job.status = JOB_SUCCEEDED
+        except Exception as e:
+            db.rollback()
+            job.status, job.error = JOB_FAILED, f"{e.__class__.__name__}: {e}"
+        finally:
+            db.close()
+        # Finished jobs are kept for their result, bulk payloads can be large
+        job.payload = None
+        job.updated_at = time.time()
+        self.backend.save(job)
+        JOB_SECONDS.observe(time.perf_counter() - start, kind=job.kind)
+        JOBS_FINISHED.inc(kind=job.kind, status=job.status)
+
+    def start(self, workers: int):
+        """
+        Starts `workers` daemon threads running the queued jobs until stop is called
+        """
+        self._stopping.clear()
+        for number in range(workers):
+            worker = threading.Thread(target=self._work, name=f"greystone-job-worker-{number}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, timeout: float | None = None):
+        """
+        Stops the workers once they finish the job they are running
+        """
+        self._stopping.set()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
+
+    def _work(self):
+        while not self._stopping.is_set():
+            self.run_next(timeout=1)
+
+# The OpenAPI responses of the routes answering with accepted_response when background writes are on
+BACKGROUND_RESPONSES = {202: {"model": schemas.Job, "description": "The job creating the loans, with background writes"}}
+
+def accepted_response(job: Job):
+    """
+    Answers a request whose work was handed to a background job with 202, the job and where to poll it
+    """
+    return JSONResponse(jsonable_encoder(schemas.Job.from_orm(job)), status_code=202, headers={"Location": f"/jobs/{job.id}"})
+
+@lru_cache(maxsize=None)
+def get_job_queue() -> JobQueue:
+    """
+    The configured job queue, created on first use
+    """
+    if settings.job_backend == "redis":
+        import redis
+        return JobQueue(RedisJobBackend(redis.Redis.from_url(settings.redis_url), ttl=settings.job_ttl))
+    return JobQueue(InMemoryJobBackend(ttl=settings.job_ttl))
@@ -0,0 +1,81 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload, undefer
+from app import schemas
+from app.models import SCHEDULE_LAZY, SCHEDULE_PACKED, User, Loan
+from app.logic.cache import get_loan_cache
+from app.logic.loan import build_loan, build_loan_schedule, build_month_summary, build_packed_schedule, build_schedule_window,\
+    bump_user_versions, compute_loan_month, compute_packed_month, insert_user_loans, schedule_cache_field, select_loan_version,\
+    select_month_totals, select_schedule_window
+
+
+async def create_loan(db: AsyncSession, loan: schemas.LoanCreate, user: User):
+    """
+    Creates a loan for a given user with a respective payout schedule, see app.logic.loan.create_loan
+    """
+    _loan = build_loan(loan, user)
+    db.add(_loan)
+    await db.execute(bump_user_versions([user.id]))
+    await db.commit()
+    get_loan_cache().invalidate(_loan.id)
+    return _loan
+
+async def get_loan_schedule(db: AsyncSession, loan_id: int, from_month: int = 1, to_month: int | None = None):
+    """
+    Generates the loan schedule, or a window of it, see app.logic.loan.get_loan_schedule. The loan months
+    and packed schedule are loaded together with the loan, as async sessions cannot lazy load them.
+    """
+    field = schedule_cache_field(from_month, to_month)
+    result = get_loan_cache().get(loan_id, field)
+    if result is None:
+        if field == "schedule":
+            loan: Loan = await db.get(Loan, loan_id, options=[selectinload(Loan.loan_months), undefer(Loan.schedule_blob)])
+            if loan:
+                result = build_loan_schedule(loan)
+        else:
+            rows = (await db.execute(select_schedule_window(loan_id, from_month, to_month))).all()
+            if rows and rows[0].schedule_storage == SCHEDULE_LAZY:
+                result = build_loan_schedule(await db.get(Loan, loan_id))[from_month - 1:to_month]
+            elif rows and rows[0].schedule_storage == SCHEDULE_PACKED:
+                result = build_packed_schedule(rows[0].amount_cents, rows[0].schedule_blob, from_month, to_month)
+            elif rows:
+                result = build_schedule_window(rows)
+        get_loan_cache().set(loan_id, field, result)
+    return result
+
+async def get_month_summary(db: AsyncSession, loan_id: int, month: int):
+    """
+    Gets the loan summary at a given month, see app.logic.loan.get_month_summary
+    """
+    result = get_loan_cache().get(loan_id, f"month:{month}")
+    if result is None:
+        row = (await db.execute(select_month_totals(loan_id, month))).first()
+        if row and row.schedule_storage == SCHEDULE_LAZY:
+            row = compute_loan_month(await db.get(Loan, loan_id), month)
+        elif row and row.schedule_storage == SCHEDULE_PACKED:
+            row = compute_packed_month(row.amount_cents, row.schedule_blob, month)
+        if row:
+            result = build_month_summary(row)
+            get_loan_cache().set(loan_id, f"month:{month}", result)
+    return result
+
+async def get_loan_version(db: AsyncSession, loan_id: int):
+    """
+    Gets the version of a loan, see app.logic.loan.get_loan_version
+    """
+    return await db.scalar(select_loan_version(loan_id))
+
+async def get_loan(db: AsyncSession, id: int):
+    """
+    Gets a loan by primary key
+    """
+    return await db.get(Loan, id)
+
+async def share_loan(db: AsyncSession, loan: Loan, user: User):
+    """
+    Gives the provided user access to the provided loan, see app.logic.loan.share_loan. The association is
+    inserted directly rather than appended to loan.users, which async sessions cannot lazy load.
+    """
+    shared = await db.execute(insert_user_loans(db.get_bind().dialect.name).values(user_id=user.id, loan_id=loan.id))
+    if shared.first() is not None:
+        await db.execute(bump_user_versions([user.id]))
+    await db.commit()
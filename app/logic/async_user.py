@@ -0,0 +1,36 @@
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import noload, selectinload, undefer
+from app import schemas
+from app.logic.user import build_user
+from app.models import User, Loan
+
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
+    """
+    Creates a user, see app.logic.user.build_user. The new user starts with an empty, already loaded, loans
+    collection and is not refreshed after the commit, which would expire the collection again.
+    """
+    _user = build_user(user)
+    _user.loans = []
+    db.add(_user)
+    await db.commit()
+    return _user
+
+async def get_user_by_email(db: AsyncSession, email: str, with_loans: bool = False):
+    """
+    Looks up a user by email, ignoring case. With `with_loans` the user's loans and their loan months are
+    eagerly loaded, async sessions cannot lazy load them later on.
+    """
+    query = select(User).where(func.lower(User.email)==email.lower())
+    if with_loans:
+        query = query.options(selectinload(User.loans).selectinload(Loan.loan_months))
+    return (await db.scalars(query)).first()
+
+async def get_user_loans(db: AsyncSession, user: User, include_months: bool = True):
+    """
+    Returns all the loans associated with a given user, see app.logic.user.get_user_loans
+    """
+    months_loaders = (selectinload(Loan.loan_months), undefer(Loan.schedule_blob)) if include_months else (noload(Loan.loan_months),)
+    query = select(Loan).join(Loan.users).where(User.id==user.id).options(*months_loaders).order_by(Loan.id)
+    return (await db.scalars(query)).all()
@@ -0,0 +1,186 @@
+"""
+Read-through cache for the computed schedules and month summaries of loans. Entries are grouped by loan
+id so all of a loan's entries are invalidated at once when its loan months are written.
+"""
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from app.config import settings
+from app.metrics import REGISTRY
+
+CACHE_REQUESTS = REGISTRY.counter(
+    "greystone_loan_cache_requests_total", "Loan cache lookups by kind of entry and result", ("kind", "result"))
+CACHE_EVICTIONS = REGISTRY.counter(
+    "greystone_loan_cache_evictions_total", "Loan cache entries dropped to stay within the memory bound")
+CACHE_BYTES = REGISTRY.gauge(
+    "greystone_loan_cache_bytes", "Estimated size of the in-process loan cache",
+    callback=lambda: [({}, cache.size) for cache in [get_loan_cache()] if isinstance(cache, InMemoryCache)])
+
+
+class CacheBackend:
+    """
+    Stores values per (loan id, field). Subclasses implement _get, _set, invalidate and clear;
+    get and set count the hits and misses and never cache None, which means "not found".
+    """
+
+    def get(self, loan_id: int, field: str):
+        value = self._get(loan_id, field)
+        CACHE_REQUESTS.inc(kind=field.partition(":")[0], result="miss" if value is None else "hit")
+        return value
+
+    def set(self, loan_id: int, field: str, value):
+        if value is not None:
+            self._set(loan_id, field, value)
+
+    def _get(self, loan_id: int, field: str):
+        raise NotImplementedError
+
+    def _set(self, loan_id: int, field: str, value):
+        raise NotImplementedError
+
+    def invalidate(self, loan_id: int):
+        """
+        Drops every entry of a loan
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+class NullCache(CacheBackend):
+    """
+    Caches nothing, every lookup is a miss
+    """
+
+    def _get(self, loan_id: int, field: str):
+        return None
+
+    def _set(self, loan_id: int, field: str, value):
+        pass
+
+    def invalidate(self, loan_id: int):
+        pass
+
+    def clear(self):
+        pass
+
+class InMemoryCache(CacheBackend):
+    """
+    In-process cache evicting the least recently used entries once the entries' estimated size exceeds
+    `max_bytes`. Entries also expire `ttl` seconds after they are set. Sizes are estimated from the pickled
+    value, which is only computed on a miss. Values are copied going in and out, so callers changing what
+    they were given never change the cached entry.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._fields = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, loan_id: int, field: str):
+        with self._lock:
+            entry = self._entries.get((loan_id, field))
+            if entry is None:
+                return None
+            expires_at, _, value = entry
+            if expires_at < time.monotonic():
+                self._remove((loan_id, field))
+                return None
+            self._entries.move_to_end((loan_id, field))
+        return _copy(value)
+
+    def _set(self, loan_id: int, field: str, value):
+        size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove((loan_id, field))
+            self._entries[(loan_id, field)] = (time.monotonic() + self.ttl, size, _copy(value))
+            self._fields.setdefault(loan_id, set()).add(field)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                CACHE_EVICTIONS.inc()
+
+    def invalidate(self, loan_id: int):
+        with self._lock:
+            for field in list(self._fields.get(loan_id, ())):
+                self._remove((loan_id, field))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._fields.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+            loan_id, field = key
+            fields = self._fields[loan_id]
+            fields.discard(field)
+            if not fields:
+                del self._fields[loan_id]
+
+def _copy(value):
+    """
+    Copies the lists and dicts of a cached value, such as a schedule, a list of dicts, or a month summary,
+    a dict. What they hold are immutable numbers and need no copying, which makes this several times cheaper
+    than a deepcopy.
+    """
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+class RedisCache(CacheBackend):
+    """
+    Cache shared between processes, holding a Redis hash per loan so invalidating a loan is a single DEL.
+    `client` is a redis-py compatible client. The hashes expire `ttl` seconds after they were last written,
+    the memory bound is left to the server's maxmemory policy.
+    """
+
+    def __init__(self, client, ttl: float, prefix: str = "greystone:loan:"):
+        self.client = client
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    def _get(self, loan_id: int, field: str):
+        value = self.client.hget(f"{self.prefix}{loan_id}", field)
+        return None if value is None else pickle.loads(value)
+
+    def _set(self, loan_id: int, field: str, value):
+        key = f"{self.prefix}{loan_id}"
+        self.client.hset(key, field, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        self.client.expire(key, self.ttl)
+
+    def invalidate(self, loan_id: int):
+        self.client.delete(f"{self.prefix}{loan_id}")
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=f"{self.prefix}*"))
+        if keys:
+            self.client.delete(*keys)
+
+@lru_cache(maxsize=None)
+def get_loan_cache() -> CacheBackend:
+    """
+    The configured loan cache, created on first use
+    """
+    if settings.cache_backend == "redis":
+        import redis
+        return RedisCache(redis.Redis.from_url(settings.redis_url), ttl=settings.cache_ttl)
+    if settings.cache_backend == "memory":
+        return InMemoryCache(max_bytes=settings.cache_max_bytes, ttl=settings.cache_ttl)
+    return NullCache()
@@ -1,3 +1,15 @@
+from functools import lru_cache
+
+import numpy as np
+
+from app.config import settings
+from app.metrics import REGISTRY
+
+AMORTIZATION_FACTOR_CACHE = REGISTRY.gauge(
+    "greystone_amortization_factor_cache", "Lookups and entries of the amortization factor table", ("stat",),
+    callback=lambda: [({"stat": stat}, getattr(amortization_factors.cache_info(), stat))
+                      for stat in ("hits", "misses", "currsize", "maxsize")])
+
 
 def generate_amoritization_schedule(interest: float, term: int, principal: float):
     '''
@@ -17,64 +29,165 @@ def generate_amoritization_schedule(interest: float, term: int, principal: float
     list
         A list of tuples that represent the payment portions for a given month of a repayment schedule (principal, interest)
     '''
+    return generate_amoritization_schedules([interest], [term], [principal])[0]
+
+def generate_amoritization_schedules(interests, terms, principals):
+    '''
+    Generates the payout schedules for many loans at once. The schedules are computed together
+    as a single (loans x months) matrix, so pricing a batch costs one pass of array math rather
+    than one python loop per loan.
+
+    Parameters
+    ----------
+    interests : array_like
+        The interest rate of each loan expressed as percentage. A 3.5% APR would be input as 3.5
+    terms : array_like
+        The number of months of each loan. A 3 year mortgage would be input as 36.
+    principals : array_like
+        The original amount borrowed for each loan. $30,000 loan would be input as 30000
+
+    Returns
+    -------
+    list
+        One schedule per input loan, in input order. Each schedule is a list of exactly `term`
+        (principal, interest) tuples, see generate_amoritization_schedule
+    '''
+    terms = np.asarray(terms, dtype=np.int64)
+    principal_cents, interest_cents = calculate_schedule_cents(interests, terms,
+                                                               np.rint(np.asarray(principals, dtype=np.float64) * 100))
+    principal_portions = (principal_cents / 100).tolist()
+    interest_portions = (interest_cents / 100).tolist()
+
     result = []
-    remaining_principal = principal
-    total_monthly_payment = _calculate_total_monthly_payment(interest, term, principal)
-    
-    while remaining_principal > 0:
-        principle_portion = _calculate_principle_payment(total_monthly_payment, remaining_principal, interest)
-        interest_portion = total_monthly_payment - principle_portion
-        remaining_principal -= principle_portion
-        result.append((round(principle_portion, 2), round(interest_portion, 2)))
-    
+    for row, term in enumerate(terms.tolist()):
+        result.append(list(zip(principal_portions[row][:term], interest_portions[row][:term])))
     return result
 
-def _calculate_principle_payment(total_monthly_payment:float, outstanding_balance: float, interest: float):
+def calculate_schedule_cents(interests, terms, principal_cents):
     '''
-    Calculates the principal portion of a given monthly loan payment
+    Calculates the principal and interest portions, in whole cents, of every month of every loan
+    using the closed-form amortization formulas. Months past a loan's term are zero filled.
+
+    The principal portion of month k of a fully amortizing loan is the monthly payment discounted
+    back over the months remaining after it: payment / (1 + r)^(term - k + 1). Per unit of principal
+    both only depend on the loan product, so they are read from the factor table and scaled by each
+    loan's principal. Each portion is rounded to the cent and the final month absorbs the rounding
+    residue so the principal portions always add up to exactly the amount borrowed.
 
     Parameters
     ----------
-    total_monthly_payment : float
-        The total amount owed on a loan on any given month.
-    outstanding_balance : float
-        The total remaining principal on the loan
-    interest : float
-        The interest rate of the loan expressed as percentage. A 3.5% APR would be input as 3.5
+    interests : array_like
+        The interest rate of each loan expressed as percentage. A 3.5% APR would be input as 3.5
+    terms : array_like
+        The number of months of each loan. A 3 year mortgage would be input as 36.
+    principal_cents : array_like
+        The original amount borrowed for each loan in cents. $30,000 loan would be input as 3000000
 
     Returns
     -------
-    float
-        The principal portion of the total monthly payment
+    tuple
+        Two int64 arrays of shape (loans, longest term) holding the (principal, interest) cents
     '''
+    interests = np.asarray(interests, dtype=np.float64).reshape(-1, 1)
+    terms = np.asarray(terms, dtype=np.int64).reshape(-1, 1)
+    principal_cents = np.asarray(principal_cents, dtype=np.int64).reshape(-1, 1)
 
-    monthly_interest = (interest / 100) / 12
-    result = total_monthly_payment - (outstanding_balance * monthly_interest)
-    return result
+    months = np.arange(1, int(terms.max(initial=0)) + 1, dtype=np.int64)
+    in_term = months <= terms
+    payment_factors = np.zeros(terms.shape)
+    principal_fractions = np.zeros(in_term.shape)
+    products = {}
+    for row, product in enumerate(zip(interests[:, 0].tolist(), terms[:, 0].tolist())):
+        products.setdefault(product, []).append(row)
+    for (interest, term), rows in products.items():
+        if term > 0:
+            payment_factors[rows, 0], principal_fractions[rows, :term] = amortization_factors(interest, term)
+
+    total_monthly_payment = principal_cents * payment_factors
+    principal_portions = principal_cents * principal_fractions
+    interest_portions = np.where(in_term, total_monthly_payment - principal_portions, 0.0)
 
+    principal_portions = np.rint(principal_portions).astype(np.int64)
+    interest_portions = np.rint(interest_portions).astype(np.int64)
 
+    # Settle the rounding residue on the final payment so the balance ends at exactly zero
+    rows = np.flatnonzero(terms[:, 0] > 0)
+    last_month = terms[rows, 0] - 1
+    residue = principal_cents[rows, 0] - principal_portions[rows].sum(axis=1)
+    principal_portions[rows, last_month] += residue
 
-def _calculate_total_monthly_payment(interest: float, term: int, principal: float):
+    return principal_portions, interest_portions
+
+@lru_cache(maxsize=settings.amortization_cache_size)
+def amortization_factors(interest: float, term: int):
     '''
-    Calculates the total monthly payment for a loan assuming monthly payments
+    The amortization factors of a loan product, memoized by (interest, term) in a table bounded to the
+    configured number of products, least recently used first out. A loan's monthly payment is its principal
+    times the payment factor and its principal portion of month k is its principal times the principal
+    fraction of month k, so pricing a loan of a known product takes no powers at all.
 
     Parameters
     ----------
     interest : float
-        The interest rate of the loan expressed as percentage. A 3.5% APR would be input as 3.5
+        The interest rate of the product expressed as percentage. A 3.5% APR would be input as 3.5
     term : int
+        The number of months of the product. A 3 year mortgage would be input as 36.
+
+    Returns
+    -------
+    tuple
+        The payment factor and a read-only array of the `term` monthly principal fractions,
+        payment factor / (1 + r)^(term - k + 1)
+    '''
+    monthly_interest = (interest / 100) / 12
+    payment_factor = float(_payment_factor(interest, term))
+    with np.errstate(over="ignore"):
+        principal_fractions = payment_factor / np.power(1 + monthly_interest, np.arange(term, 0, -1, dtype=np.int64))
+    principal_fractions.setflags(write=False)
+    return payment_factor, principal_fractions
+
+def calculate_monthly_payment(interest, term, principal):
+    '''
+    Calculates the total monthly payment for a loan assuming monthly payments. Accepts either
+    scalars or numpy arrays, in which case the payments are calculated element-wise.
+
+    Parameters
+    ----------
+    interest : float or ndarray
+        The interest rate of the loan expressed as percentage. A 3.5% APR would be input as 3.5
+    term : int or ndarray
         The number of months of the loan. A 3 year mortgage would be input as 120.
-    principal : float
+    principal : float or ndarray
         The original amount borrowed. $30,000 loan would be input as 30000
 
     Returns
     -------
-    float
-        The total monthly payment that would need to be made throughout the life of the loan
+    float or ndarray
+        The total monthly payment that would need to be made throughout the life of the loan.
+        An interest free loan is paid off in equal principal-only installments.
     '''
 
-    monthly_interest = (interest / 100) / 12
-    numerator = monthly_interest * pow((1 + monthly_interest), term)
-    denominator = (pow((1 + monthly_interest), term)) - 1
-    result = principal * (numerator / denominator)
-    return result
\ No newline at end of file
+    result = principal * _payment_factor(interest, term)
+    return result if np.ndim(result) else float(result)
+
+def prewarm_amortization_factors(terms, rate_step: float, max_rate: float):
+    '''
+    Fills the factor table with the products of each of the given terms at every interest rate from zero up
+    to `max_rate` in steps of `rate_step`. The rates are rounded so they are the floats the same rates are
+    entered as, 0.1 * 3 would otherwise not be 0.3.
+    '''
+    rates = [round(rate_step * step, 10) for step in range(int(round(max_rate / rate_step)) + 1)]
+    for term in terms:
+        for interest in rates:
+            amortization_factors(interest, int(term))
+
+def _payment_factor(interest, term):
+    '''
+    The monthly payment per unit of principal. Accepts either scalars or numpy arrays.
+    An interest free loan is paid off in equal principal-only installments.
+    '''
+    monthly_interest = (np.asarray(interest, dtype=np.float64) / 100) / 12
+    growth = np.power(1 + monthly_interest, term)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        amortizing = (monthly_interest * growth) / (growth - 1)
+    return np.where(monthly_interest == 0, np.divide(1, term), amortizing)
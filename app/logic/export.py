@@ -0,0 +1,88 @@
+import csv
+import io
+import json
+
+from sqlalchemy import select
+from sqlalchemy.orm import undefer
+from sqlalchemy.orm.session import Session
+
+from app.logic.loan import get_loan_months
+from app.money import from_cents
+from app.models import SCHEDULE_LAZY, SCHEDULE_ON_LOAN, Loan, LoanMonth, User, association_table
+
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_COLUMNS = ("loan_id", "month", "remaining_balance", "monthly_payment")
+
+
+def select_user_loan_ids(user: User):
+    """
+    Returns a subquery selecting the ids of the loans a user holds, so large portfolios never have to be
+    loaded into a python list of ids
+    """
+    return select(association_table.c.loan_id).where(association_table.c.user_id == user.id)
+
+def iter_loan_schedules(db: Session, loan_ids, batch_size: int = 1000):
+    """
+    Yields a (loan_id, month, remaining_balance, monthly_payment) tuple for every month of every requested loan,
+    with the amounts in whole cents.
+    `loan_ids` is either a list of loan ids or a subquery selecting them, unknown ids are skipped.
+
+    Stored loan months are read with a single query whose results are fetched `batch_size` rows at a
+    time, so memory use does not grow with the number of loans or months. Lazily stored and packed loans
+    follow, their months are computed or unpacked one loan at a time. Each loan's months are yielded in order.
+    """
+    loan_months = db.execute(
+        select(LoanMonth.loan_id, LoanMonth.month, LoanMonth.remaining_balance_cents, LoanMonth.principal_cents, LoanMonth.interest_cents)
+        .join(Loan, Loan.id == LoanMonth.loan_id)
+        # A lazily stored loan being materialized already has some of its loan months
+        .where(LoanMonth.loan_id.in_(loan_ids), Loan.schedule_storage.is_distinct_from(SCHEDULE_LAZY))
+        .order_by(LoanMonth.loan_id, LoanMonth.month)
+        .execution_options(yield_per=batch_size)
+    )
+    for row in loan_months:
+        yield row.loan_id, row.month, row.remaining_balance_cents, row.principal_cents + row.interest_cents
+
+    computed_loans = db.scalars(
+        select(Loan).where(Loan.id.in_(loan_ids), Loan.schedule_storage.in_(SCHEDULE_ON_LOAN))
+        .options(undefer(Loan.schedule_blob))
+        .order_by(Loan.id)
+        .execution_options(yield_per=batch_size)
+    )
+    for loan in computed_loans:
+        for loan_month in get_loan_months(loan):
+            yield loan.id, loan_month.month, loan_month.remaining_balance_cents, loan_month.principal_cents + loan_month.interest_cents
+
+def export_loan_schedules(db: Session, loan_ids, format: str = "ndjson", batch_size: int = 1000):
+    """
+    Renders the schedules of the requested loans as NDJSON or CSV text, yielding a chunk of text for
+    every `batch_size` months. NDJSON amounts are numbers, like the schedule endpoint returns them,
+    CSV amounts keep their two decimal places.
+    """
+    return render_loan_schedules(iter_loan_schedules(db, loan_ids, batch_size=batch_size), format, batch_size)
+
+def render_loan_schedules(rows, format: str = "ndjson", batch_size: int = 1000):
+    """
+    Renders the rows of iter_loan_schedules, see export_loan_schedules
+    """
+    buffer = io.StringIO()
+    if format == "csv":
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        def write_row(row):
+            loan_id, month, remaining_balance, monthly_payment = row
+            writer.writerow((loan_id, month, from_cents(remaining_balance), from_cents(monthly_payment)))
+    else:
+        def write_row(row):
+            loan_id, month, remaining_balance, monthly_payment = row
+            buffer.write(json.dumps({"loan_id": loan_id, "month": month, "remaining_balance": remaining_balance / 100,
+                                     "monthly_payment": monthly_payment / 100}))
+            buffer.write("\n")
+
+    for count, row in enumerate(rows, start=1):
+        write_row(row)
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -1,85 +1,495 @@
+import numpy as np
+from itertools import groupby
+
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import undefer
 from sqlalchemy.orm.session import Session
 from app import schemas
-from app.models import User, Loan, LoanMonth
-from app.logic.common import generate_amoritization_schedule
-from decimal import Decimal
+from app.config import settings
+from app.database import insert_or_ignore
+from app.models import SCHEDULE_LAZY, SCHEDULE_ON_LOAN, SCHEDULE_PACKED, SCHEDULE_ROWS, User, Loan, LoanMonth, association_table
+from app.logic.cache import get_loan_cache
+from app.logic.common import calculate_schedule_cents
+from app.money import from_cents, to_cents
+from app.packing import pack_schedule, unpack_schedule
 
 
-def create_loan(db: Session, loan: schemas.LoanCreate, user: User):
+def create_loan(db: Session, loan: schemas.LoanCreate, user: User, id: int | None = None):
     """
-    Creates a loan for a given user with a respective payout schedule
+    Creates a loan for a given user with a respective payout schedule. Depending on the configured
+    schedule storage the payout schedule is either persisted as loan months or computed on demand.
+    The loan gets the next id of the database, unless an `id` allocated for it is given.
     """
-    _loan = Loan(**loan.dict(), users=[user])
-    _loan.loan_months = _create_amoritization_schedule(_loan)
+    _loan = build_loan(loan, user, id=id)
     db.add(_loan)
+    db.execute(bump_user_versions([user.id]))
     db.commit()
     db.refresh(_loan)
+    get_loan_cache().invalidate(_loan.id)
+    return _loan
+
+def create_loan_in_batches(db: Session, loan: schemas.LoanCreate, user: User, batch_size: int, id: int | None = None):
+    """
+    Creates a loan like create_loan does, without ever holding a long write transaction. The loan is first
+    committed as a lazily stored loan, which serves its schedule at once, then, when schedules are stored as
+    rows, its loan months are persisted `batch_size` at a time. A packed schedule is a single value and is
+    written along with the loan.
+    """
+    if settings.schedule_storage == SCHEDULE_PACKED:
+        return create_loan(db, loan, user, id=id)
+    _loan = Loan(**loan.dict(), id=id, users=[user], schedule_storage=SCHEDULE_LAZY, loan_months=[])
+    db.add(_loan)
+    db.execute(bump_user_versions([user.id]))
+    db.commit()
+    get_loan_cache().invalidate(_loan.id)
+    if settings.schedule_storage == SCHEDULE_ROWS:
+        materialize_loan_schedule(db, _loan, batch_size=batch_size)
     return _loan
 
-def get_loan_schedule(db: Session, loan_id: int):
+def create_loans_bulk(db: Session, loans: list[schemas.LoanBulkCreate], chunk_size: int = 500,
+                      loan_ids: list[int] | None = None):
+    """
+    Creates many loans at once. The owners are resolved by case-insensitive email with a single query,
+    then every chunk of `chunk_size` loans is written with one multi-row insert per table and committed on its own.
+    Returns a result per requested loan, in request order, holding either the new loan id or the
+    reason the loan could not be created. A failed chunk does not roll back the chunks before it.
+    The loans get the next ids of the database, unless `loan_ids` allocated for them are given.
+    """
+    emails = {loan.email.lower() for loan in loans}
+    user_ids = dict(db.execute(select(func.lower(User.email), User.id).where(func.lower(User.email).in_(emails))).all())
+    results = [schemas.LoanBulkResult(email=loan.email) for loan in loans]
+    pending = []
+    for loan, result, loan_id in zip(loans, results, loan_ids or [None] * len(loans)):
+        if loan.email.lower() in user_ids:
+            pending.append((loan, result, loan_id))
+        else:
+            result.error = "No user for loan found"
+
+    for start in range(0, len(pending), chunk_size):
+        chunk = pending[start:start + chunk_size]
+        try:
+            chunk_ids = _insert_loans(db, [loan for loan, _, _ in chunk], user_ids,
+                                      None if loan_ids is None else [loan_id for _, _, loan_id in chunk])
+            db.execute(bump_user_versions({user_ids[loan.email.lower()] for loan, _, _ in chunk}))
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            for _, result, _ in chunk:
+                result.error = f"Loan could not be saved: {e.__class__.__name__}"
+        else:
+            for (_, result, _), loan_id in zip(chunk, chunk_ids):
+                result.loan_id = loan_id
+                get_loan_cache().invalidate(loan_id)
+    return results
+
+def get_loan_schedule(db: Session, loan_id: int, from_month: int = 1, to_month: int | None = None):
     """
     Generate the loan schedule by iterating through all the loan months, running down the balance,
     and capturing the record for each month in a list. 
     NOTE: The remaining balance is calculated as post-payment for a given month (ie 1k loan w/ 100 principal payment 
     amount at month 1 will have a remaining balance of 900, and all loans should have a 0 remaining balance on the final month)
+    Pass `from_month` and/or `to_month` to get only the months in between, inclusive. The window is selected
+    through the (loan_id, month) index and the remaining balances are read from the stored running totals,
+    so only the months in the window are loaded. Schedules are read through the loan cache.
     """
     
-    result = None
-    loan: Loan = db.get(Loan, loan_id)
-    if loan:
-        result = []
-        remaining_balance = Decimal(loan.amount)
-        for loan_month in loan.loan_months:
-            remaining_balance -= loan_month.principal_amount
-            monthly_payment = loan_month.principal_amount + loan_month.interest_amount
-            result.append({"month": loan_month.month, "remaining_balance": remaining_balance, "monthly_payment": monthly_payment})
+    field = schedule_cache_field(from_month, to_month)
+    result = get_loan_cache().get(loan_id, field)
+    if result is None:
+        if field == "schedule":
+            loan: Loan = db.get(Loan, loan_id, options=[undefer(Loan.schedule_blob)])
+            if loan:
+                result = build_loan_schedule(loan)
+        else:
+            rows = db.execute(select_schedule_window(loan_id, from_month, to_month)).all()
+            if rows and rows[0].schedule_storage == SCHEDULE_LAZY:
+                result = build_loan_schedule(db.get(Loan, loan_id))[from_month - 1:to_month]
+            elif rows and rows[0].schedule_storage == SCHEDULE_PACKED:
+                result = build_packed_schedule(rows[0].amount_cents, rows[0].schedule_blob, from_month, to_month)
+            elif rows:
+                result = build_schedule_window(rows)
+        get_loan_cache().set(loan_id, field, result)
     return result
 
 def get_month_summary(db: Session, loan_id: int, month: int):
     """
-    Get the loan summary at a given month by iterating through all the months,
-    summing the paid totals, and running down the balance. We can break out of the
-    loop once we've found the requested month. If we make it all the way through
-    it means the requested month is outside the bounds of the payout schedule and we'll
-    use a "None" principal balance to signal that the requested month was not found to the caller.
+    Get the loan summary at a given month. The running totals are stored on every loan month when
+    the loan is created, so this is a single lookup on the (loan_id, month) unique index. The loan is
+    outer joined so we can tell a missing loan (None) apart from a month outside the bounds of the
+    payout schedule, which is signalled to the caller with a "None" principal balance.
+    Lazily stored loans have no loan months to look up, so their summary is computed from the loan terms,
+    packed loans sum their months up to the requested one. Summaries are read through the loan cache.
     """
-    
-    result = None
-    loan: Loan = db.get(Loan, loan_id)
-    if loan:
-        principal_paid = Decimal(0)
-        interest_paid = Decimal(0)
-        principal_balance = None
-        remaining_balance = Decimal(loan.amount)
-        for loan_month in loan.loan_months:
-            principal_paid += loan_month.principal_amount
-            interest_paid += loan_month.interest_amount
-            remaining_balance -= loan_month.principal_amount
-            if loan_month.month == month:
-                principal_balance = remaining_balance
-                break
-        result = {"principal_balance": principal_balance, "principal_paid": principal_paid, "interest_paid": interest_paid}
+
+    result = get_loan_cache().get(loan_id, f"month:{month}")
+    if result is None:
+        row = db.execute(select_month_totals(loan_id, month)).first()
+        if row and row.schedule_storage == SCHEDULE_LAZY:
+            row = compute_loan_month(db.get(Loan, loan_id), month)
+        elif row and row.schedule_storage == SCHEDULE_PACKED:
+            row = compute_packed_month(row.amount_cents, row.schedule_blob, month)
+        if row:
+            result = build_month_summary(row)
+            get_loan_cache().set(loan_id, f"month:{month}", result)
     return result
 
+def build_loan(loan: schemas.LoanCreate, user: User, id: int | None = None):
+    """
+    Builds a new loan for a given user. Depending on the configured schedule storage the loan
+    either carries its loan months, its packed schedule or is left to compute them on demand.
+    """
+    _loan = Loan(**loan.dict(), id=id, users=[user], schedule_storage=settings.schedule_storage, loan_months=[])
+    if _loan.schedule_storage == SCHEDULE_ROWS:
+        _loan.loan_months = _create_amoritization_schedule(_loan)
+    elif _loan.schedule_storage == SCHEDULE_PACKED:
+        _loan.schedule_blob = pack_schedule(*_schedule_cents(_loan))
+    return _loan
+
+def build_loan_schedule(loan: Loan):
+    """
+    Builds the loan schedule by iterating through all the loan months, running down the balance in whole
+    cents, and capturing the record for each month in a list. The loan months must already be loaded.
+    """
+    if loan.schedule_storage == SCHEDULE_PACKED:
+        return build_packed_schedule(loan.amount_cents, loan.schedule_blob)
+    result = []
+    remaining_balance = loan.amount_cents
+    for month, principal, interest in get_loan_month_cents(loan):
+        remaining_balance -= principal
+        result.append({"month": month, "remaining_balance": from_cents(remaining_balance),
+                       "monthly_payment": from_cents(principal + interest)})
+    return result
+
+def build_packed_schedule(amount_cents: int, schedule_blob, from_month: int = 1, to_month: int | None = None):
+    """
+    Builds the loan schedule, or the window of it from `from_month` to `to_month`, of a packed loan.
+    The balances are run down with array math over the months of the blob, only the window is converted.
+    """
+    principal_cents, interest_cents = unpack_schedule(schedule_blob)
+    window = slice(from_month - 1, to_month)
+    remaining_balances = (amount_cents - np.cumsum(principal_cents))[window].tolist()
+    monthly_payments = (principal_cents[window] + interest_cents[window]).tolist()
+    return [{"month": month, "remaining_balance": from_cents(remaining_balance), "monthly_payment": from_cents(monthly_payment)}
+            for month, remaining_balance, monthly_payment in zip(range(from_month, from_month + len(monthly_payments)),
+                                                                 remaining_balances, monthly_payments)]
+
+def schedule_cache_field(from_month: int = 1, to_month: int | None = None):
+    if from_month == 1 and to_month is None:
+        return "schedule"
+    return f"schedule:{from_month}:{'' if to_month is None else to_month}"
+
+def select_schedule_window(loan_id: int, from_month: int, to_month: int | None):
+    """
+    Selects the storage mode of a loan along with the stored loan months from `from_month` to `to_month`, if any.
+    A loan without any loan months in the window yields a single row without a month. The amount and packed
+    schedule of the loan come along, packed loans are served from them.
+    """
+    window = (LoanMonth.loan_id == Loan.id) & (LoanMonth.month >= from_month)
+    if to_month is not None:
+        window &= LoanMonth.month <= to_month
+    return (select(Loan.schedule_storage, Loan.amount_cents, Loan.schedule_blob, LoanMonth.month, LoanMonth.remaining_balance_cents, LoanMonth.principal_cents,
+                   LoanMonth.interest_cents)
+            .outerjoin(LoanMonth, window)
+            .where(Loan.id == loan_id)
+            .order_by(LoanMonth.month))
+
+def build_schedule_window(rows):
+    return [{"month": row.month, "remaining_balance": from_cents(row.remaining_balance_cents),
+             "monthly_payment": from_cents(row.principal_cents + row.interest_cents)} for row in rows if row.month is not None]
+
+def select_month_totals(loan_id: int, month: int):
+    """
+    Selects the storage mode, amount and packed schedule of a loan along with the running totals stored
+    for the requested month, if any
+    """
+    return (select(Loan.schedule_storage, Loan.amount_cents, Loan.schedule_blob, LoanMonth.remaining_balance_cents, LoanMonth.cumulative_principal_cents,
+                   LoanMonth.cumulative_interest_cents)
+            .outerjoin(LoanMonth, (LoanMonth.loan_id == Loan.id) & (LoanMonth.month == month))
+            .where(Loan.id == loan_id))
+
+def compute_loan_month(loan: Loan, month: int):
+    """
+    Computes a month of a lazily stored or packed loan. An out of bounds month reads as a loan month without any totals.
+    """
+    if loan.schedule_storage == SCHEDULE_PACKED:
+        return compute_packed_month(loan.amount_cents, loan.schedule_blob, month)
+    loan_months = get_loan_months(loan)
+    return loan_months[month - 1] if 0 < month <= len(loan_months) else LoanMonth()
+
+def compute_packed_month(amount_cents: int, schedule_blob, month: int):
+    """
+    Reads a month of a packed loan, totalling the months up to it. An out of bounds month reads as a loan
+    month without any totals.
+    """
+    principal_cents, interest_cents = unpack_schedule(schedule_blob)
+    if not 0 < month <= len(principal_cents):
+        return LoanMonth()
+    paid_principal = int(principal_cents[:month].sum())
+    return LoanMonth(month=month, principal_cents=int(principal_cents[month - 1]), interest_cents=int(interest_cents[month - 1]),
+                     cumulative_principal_cents=paid_principal, cumulative_interest_cents=int(interest_cents[:month].sum()),
+                     remaining_balance_cents=amount_cents - paid_principal)
+
+def build_month_summary(loan_month):
+    return {"principal_balance": from_cents(loan_month.remaining_balance_cents),
+            "principal_paid": from_cents(loan_month.cumulative_principal_cents),
+            "interest_paid": from_cents(loan_month.cumulative_interest_cents)}
+
+def get_loan_version(db: Session, loan_id: int):
+    """
+    Gets the version of a loan, None for a missing loan, without loading anything else
+    """
+    return db.scalar(select_loan_version(loan_id))
+
+def select_loan_version(loan_id: int):
+    return select(Loan.version).where(Loan.id == loan_id)
+
+def bump_user_versions(user_ids):
+    """
+    Bumps the loan set version of the users of `user_ids`, a collection of ids or a select of them,
+    whenever loans are added to their loans
+    """
+    return (update(User).where(User.id.in_(user_ids)).values(loans_version=User.loans_version + 1)
+            .execution_options(synchronize_session=False))
+
+def bump_loan_versions(loan_ids):
+    """
+    Bumps the version of the loans of `loan_ids` whose schedule or loan months changed, along with the loan set
+    version of every user holding them. Returns the two update statements, to run in the changing transaction.
+    """
+    return (update(Loan).where(Loan.id.in_(loan_ids)).values(version=Loan.version + 1)
+            .execution_options(synchronize_session=False),
+            bump_user_versions(select(association_table.c.user_id).where(association_table.c.loan_id.in_(loan_ids))))
+
 def get_loan(db: Session, id: int):
     """
     Gets a loan by primary key
     """
     return db.get(Loan, id)
 
+def get_loan_months(loan: Loan):
+    """
+    Returns the stored loan months of a loan or, for lazily stored and packed loans, builds them from the
+    loan terms or the packed schedule.
+    """
+    if loan.schedule_storage in SCHEDULE_ON_LOAN:
+        return [LoanMonth(**row) for row in _amoritization_rows(loan.amount_cents, *_stored_cents(loan))]
+    return loan.loan_months
+
+def build_loan_response(loan: Loan, schema=schemas.Loan):
+    """
+    Serializes a loan as `schema`, Loan or UserLoan, with the loan months of get_loan_months, so lazily stored
+    and packed loans come back with every month of their schedule, like loans storing them as rows. Packed
+    loans need their schedule blob loaded.
+    """
+    response = schema.from_orm(loan)
+    if loan.schedule_storage in SCHEDULE_ON_LOAN:
+        response = response.copy(update={"loan_months": [schemas.LoanMonth.from_orm(loan_month)
+                                                         for loan_month in get_loan_months(loan)]})
+    return response
+
+def get_loan_month_cents(loan: Loan):
+    """
+    Returns the (month, principal cents, interest cents) of every month of a loan, like get_loan_months
+    does the loan months. Lazily stored and packed loans are read without building loan months.
+    """
+    if loan.schedule_storage in SCHEDULE_ON_LOAN:
+        principal_cents, interest_cents = _stored_cents(loan)
+        return zip(range(1, loan.term + 1), principal_cents.tolist(), interest_cents.tolist())
+    return [(loan_month.month, loan_month.principal_cents, loan_month.interest_cents) for loan_month in loan.loan_months]
+
 def share_loan(db: Session, loan: Loan, user: User):
     """
-    Gives the provided user access to the provided loan
+    Gives the provided user access to the provided loan. Sharing a loan with a user already holding it does
+    nothing, and the users already holding the loan are never loaded.
+    """
+    share_loans(db, [(loan.id, user.id)])
+    db.commit()
+
+def share_loans_by_email(db: Session, shares: list[schemas.LoanShare]):
+    """
+    Shares many loans at once, each with the user of its case-insensitive email, in a single transaction.
+    The users and the loans are resolved with one query each. Returns a result per requested share, in request
+    order, telling whether the loan was newly shared or else why it could not be.
     """
-    loan.users.append(user)
+    emails = {share.email.lower() for share in shares}
+    user_ids = dict(db.execute(select(func.lower(User.email), User.id).where(func.lower(User.email).in_(emails))).all())
+    loan_ids = set(db.scalars(select(Loan.id).where(Loan.id.in_({share.loan_id for share in shares}))))
+    results = [schemas.LoanShareResult(**share.dict()) for share in shares]
+    pending = {}
+    for share, result in zip(shares, results):
+        if share.loan_id not in loan_ids:
+            result.error = "Loan not found"
+        elif share.email.lower() not in user_ids:
+            result.error = "User not found"
+        else:
+            pending.setdefault((share.loan_id, user_ids[share.email.lower()]), []).append(result)
+    for pair in share_loans(db, list(pending)):
+        # A pair requested twice is shared by its first request
+        pending[pair][0].shared = True
     db.commit()
+    return results
+
+def share_loans(db: Session, shares: list[tuple[int, int]]):
+    """
+    Gives users access to loans, for every (loan id, user id) pair, with a single INSERT ... ON CONFLICT DO NOTHING
+    into user_loans that skips the pairs already there. Bumps the loans version of the users gaining a loan.
+    Does not commit. Returns the pairs that were newly shared.
+    """
+    if not shares:
+        return []
+    shared = db.execute(insert_user_loans(db.get_bind().dialect.name),
+                        [{"loan_id": loan_id, "user_id": user_id} for loan_id, user_id in shares]).all()
+    if shared:
+        db.execute(bump_user_versions({user_id for _, user_id in shared}))
+    return [(loan_id, user_id) for loan_id, user_id in shared]
+
+def insert_user_loans(dialect: str):
+    """
+    An insert into user_loans skipping the rows already there, returning the (loan_id, user_id) of those inserted
+    """
+    return insert_or_ignore(association_table, dialect).returning(association_table.c.loan_id, association_table.c.user_id)
+
+def materialize_loan_schedule(db: Session, loan: Loan, batch_size: int | None = None):
+    """
+    Persists the payout schedule of a lazily stored or packed loan as loan months, so that individual
+    months can be adjusted. Loans that already store their loan months are left untouched.
+    With `batch_size` the loan months are inserted and committed `batch_size` at a time, keeping
+    every write transaction short. The loan is served as before until the last batch switches its storage.
+    """
+    if loan.schedule_storage in SCHEDULE_ON_LOAN:
+        rows = _amoritization_rows(loan.amount_cents, *_stored_cents(loan))
+        if batch_size is None:
+            loan.loan_months = [LoanMonth(**row) for row in rows]
+            loan.schedule_storage, loan.schedule_blob = SCHEDULE_ROWS, None
+            _execute_all(db, bump_loan_versions([loan.id]))
+        else:
+            for start in range(0, len(rows), batch_size):
+                db.execute(insert(LoanMonth.__table__), [{**row, "loan_id": loan.id} for row in rows[start:start + batch_size]])
+                if start + batch_size >= len(rows):
+                    loan.schedule_storage, loan.schedule_blob = SCHEDULE_ROWS, None
+                    _execute_all(db, bump_loan_versions([loan.id]))
+                db.commit()
+        db.commit()
+        get_loan_cache().invalidate(loan.id)
+    return loan
+
+def backfill_loan_month_totals(db: Session, batch_size: int = 100):
+    """
+    Fills in the running total columns of loan months written before they were tracked. Loans are
+    processed in batches of `batch_size`, committing after each batch. Returns the number of loans updated.
+    """
+    loan_ids = db.scalars(
+        select(LoanMonth.loan_id).where(LoanMonth.cumulative_principal_cents.is_(None)).distinct().order_by(LoanMonth.loan_id)
+    ).all()
+    for start in range(0, len(loan_ids), batch_size):
+        for loan in db.scalars(select(Loan).where(Loan.id.in_(loan_ids[start:start + batch_size]))):
+            totals = _running_totals(loan.amount_cents, [m.principal_cents for m in loan.loan_months],
+                                     [m.interest_cents for m in loan.loan_months])
+            db.execute(update(LoanMonth), [{"id": m.id, **total} for m, total in zip(loan.loan_months, totals)])
+        _execute_all(db, bump_loan_versions(loan_ids[start:start + batch_size]))
+        db.commit()
+        for loan_id in loan_ids[start:start + batch_size]:
+            get_loan_cache().invalidate(loan_id)
+    return len(loan_ids)
+
+def pack_loan_schedules(db: Session, loan_ids: list[int] | None = None, batch_size: int = 100):
+    """
+    Converts the loans storing their loan months, all of them or those of `loan_ids`, to packed loans: the
+    principal and interest of their months are packed onto the loan and the loan months deleted. Loans are
+    processed in batches of `batch_size`, committing after each batch. Returns the number of loans converted.
+    """
+    query = (select(LoanMonth.loan_id).join(Loan, Loan.id == LoanMonth.loan_id)
+             # A lazily stored loan being materialized has only some of its loan months
+             .where(Loan.schedule_storage.is_distinct_from(SCHEDULE_LAZY)).distinct().order_by(LoanMonth.loan_id))
+    if loan_ids is not None:
+        query = query.where(LoanMonth.loan_id.in_(loan_ids))
+    loan_ids = db.scalars(query).all()
+    for start in range(0, len(loan_ids), batch_size):
+        batch = loan_ids[start:start + batch_size]
+        months = db.execute(
+            select(LoanMonth.loan_id, LoanMonth.principal_cents, LoanMonth.interest_cents)
+            .where(LoanMonth.loan_id.in_(batch)).order_by(LoanMonth.loan_id, LoanMonth.month))
+        db.execute(update(Loan), [
+            {"id": loan_id, "schedule_storage": SCHEDULE_PACKED,
+             "schedule_blob": pack_schedule(*zip(*[(row.principal_cents, row.interest_cents) for row in rows]))}
+            for loan_id, rows in groupby(months, key=lambda row: row.loan_id)])
+        db.execute(delete(LoanMonth).where(LoanMonth.loan_id.in_(batch)))
+        _execute_all(db, bump_loan_versions(batch))
+        db.commit()
+        for loan_id in batch:
+            get_loan_cache().invalidate(loan_id)
+    return len(loan_ids)
+
+def _execute_all(db: Session, statements):
+    for statement in statements:
+        db.execute(statement)
+
+def _insert_loans(db: Session, loans: list[schemas.LoanBulkCreate], user_ids: dict, loan_ids: list[int] | None = None):
+    """
+    Inserts loans, their owners and, when schedules are stored as rows, their loan months with one
+    executemany insert per table. Packed schedules are inserted with the loans. Returns the loan ids,
+    the given `loan_ids` or else the new ones of the database, in the order of `loans`.
+    """
+    amount_cents = [to_cents(loan.amount) for loan in loans]
+    values = [{**loan.dict(exclude={"email", "amount"}), "amount_cents": amount, "schedule_storage": settings.schedule_storage}
+              for loan, amount in zip(loans, amount_cents)]
+    if loan_ids is not None:
+        for value, loan_id in zip(values, loan_ids):
+            value["id"] = loan_id
+    if settings.schedule_storage != SCHEDULE_LAZY:
+        principal_cents, interest_cents = calculate_schedule_cents([loan.interest_rate for loan in loans],
+                                                                   [loan.term for loan in loans], amount_cents)
+    if settings.schedule_storage == SCHEDULE_PACKED:
+        for loan, value, principal, interest in zip(loans, values, principal_cents, interest_cents):
+            value["schedule_blob"] = pack_schedule(principal[:loan.term], interest[:loan.term])
+
+    loan_ids = db.scalars(insert(Loan.__table__).returning(Loan.__table__.c.id, sort_by_parameter_order=True), values).all()
+    db.execute(insert(association_table),
+               [{"user_id": user_ids[loan.email.lower()], "loan_id": loan_id} for loan, loan_id in zip(loans, loan_ids)])
+
+    if settings.schedule_storage == SCHEDULE_ROWS:
+        loan_months = []
+        for loan, loan_id, amount, principal, interest in zip(loans, loan_ids, amount_cents, principal_cents, interest_cents):
+            loan_months.extend({**row, "loan_id": loan_id}
+                               for row in _amoritization_rows(amount, principal[:loan.term], interest[:loan.term]))
+        db.execute(insert(LoanMonth.__table__), loan_months)
+    return loan_ids
 
 def _create_amoritization_schedule(loan:Loan):
-    result = []
-    payout_schedule = generate_amoritization_schedule(interest=loan.interest_rate, term=loan.term, principal=loan.amount)
-    
-    for month, payout in enumerate(payout_schedule):
-        loan_month = LoanMonth(month=month+1, principal_amount=payout[0], interest_amount=payout[1])
-        result.append(loan_month)
-            
-    return result
+    return [LoanMonth(**row) for row in _amoritization_rows(loan.amount_cents, *_schedule_cents(loan))]
+
+def _schedule_cents(loan: Loan):
+    """
+    Computes the principal and interest cents of every month of a loan from its terms
+    """
+    principal_cents, interest_cents = calculate_schedule_cents([loan.interest_rate], [loan.term], [loan.amount_cents])
+    return principal_cents[0], interest_cents[0]
+
+def _stored_cents(loan: Loan):
+    """
+    The principal and interest cents of every month of a lazily stored or packed loan
+    """
+    if loan.schedule_storage == SCHEDULE_PACKED:
+        return unpack_schedule(loan.schedule_blob)
+    return _schedule_cents(loan)
+
+def _amoritization_rows(amount_cents: int, principal_cents, interest_cents):
+    """
+    Builds the loan month column values, running totals included, for each month's principal and interest cents
+    """
+    totals = _running_totals(amount_cents, principal_cents, interest_cents)
+    return [{"month": month, "principal_cents": principal, "interest_cents": interest, **total}
+            for month, (principal, interest, total) in enumerate(zip(np.asarray(principal_cents).tolist(),
+                                                                     np.asarray(interest_cents).tolist(), totals), start=1)]
+
+def _running_totals(amount_cents: int, principal_cents, interest_cents):
+    """
+    Accumulates the paid to date totals and the post-payment remaining balance, all in whole cents,
+    for each month's principal and interest cents
+    """
+    cumulative_principal = np.cumsum(principal_cents, dtype=np.int64)
+    cumulative_interest = np.cumsum(interest_cents, dtype=np.int64)
+    return [{"cumulative_principal_cents": principal, "cumulative_interest_cents": interest, "remaining_balance_cents": balance}
+            for principal, interest, balance in zip(cumulative_principal.tolist(), cumulative_interest.tolist(),
+                                                    (amount_cents - cumulative_principal).tolist())]
@@ -1,3 +1,4 @@
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm.session import Session
 from sqlalchemy.sql._elements_constructors import text
 
@@ -9,4 +10,12 @@ def ping_db(db: Session):
     result = db.execute(text("SELECT 1"))
     if result.cursor.arraysize == 1:
         return True
-    return False
\ No newline at end of file
+    return False
+
+async def async_ping_db(db: AsyncSession):
+    '''
+    Perform a simple query to make sure the async engine can connect to the database
+    '''
+
+    result = await db.execute(text("SELECT 1"))
+    return result.scalar() == 1
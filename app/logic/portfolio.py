@@ -0,0 +1,63 @@
+from sqlalchemy import case, func, select
+from sqlalchemy.orm import undefer
+from sqlalchemy.orm.session import Session
+
+from app.logic.loan import compute_loan_month
+from app.money import from_cents
+from app.models import SCHEDULE_ON_LOAN, Loan, LoanMonth, User, association_table
+
+PORTFOLIO_TOTALS = ("principal_balance", "principal_paid", "interest_paid", "next_payment")
+
+
+def select_portfolio(user: User, month: int):
+    """
+    Selects a row per loan of a user with its running totals as of `month` and the payment due the month after,
+    aggregated by a single GROUP BY over the two loan months of every loan. Loans paid off before `month`
+    report the totals of their last month, lazily stored and packed loans have no loan months and report no totals.
+    The totals are selected in whole cents.
+    """
+    paid_month = case((Loan.term < month, Loan.term), else_=month)
+    as_of = LoanMonth.month == paid_month
+    return (select(Loan.id.label("loan_id"), Loan.schedule_storage,
+                   func.max(case((as_of, LoanMonth.remaining_balance_cents))).label("principal_balance"),
+                   func.max(case((as_of, LoanMonth.cumulative_principal_cents))).label("principal_paid"),
+                   func.max(case((as_of, LoanMonth.cumulative_interest_cents))).label("interest_paid"),
+                   func.max(case((LoanMonth.month == month + 1, LoanMonth.principal_cents + LoanMonth.interest_cents)))
+                   .label("next_payment"))
+            .join(association_table, association_table.c.loan_id == Loan.id)
+            .outerjoin(LoanMonth, (LoanMonth.loan_id == Loan.id) & (as_of | (LoanMonth.month == month + 1)))
+            .where(association_table.c.user_id == user.id)
+            .group_by(Loan.id, Loan.schedule_storage)
+            .order_by(Loan.id))
+
+def get_user_portfolio(db: Session, user: User, month: int):
+    """
+    Gets the outstanding principal, principal and interest paid to date as of `month` and the next payment due
+    for every loan of a user, along with their totals. The totals of loans storing their loan months come from
+    one aggregate query, those of lazily stored and packed loans are computed from the loan terms or read from
+    the packed schedule.
+    """
+    loans = []
+    computed_loan_ids = []
+    for row in db.execute(select_portfolio(user, month)):
+        loan = row._asdict()
+        if loan.pop("schedule_storage") in SCHEDULE_ON_LOAN:
+            computed_loan_ids.append(row.loan_id)
+        else:
+            loans.append(loan)
+    if computed_loan_ids:
+        for loan in db.scalars(select(Loan).where(Loan.id.in_(computed_loan_ids)).options(undefer(Loan.schedule_blob))):
+            paid = compute_loan_month(loan, min(month, loan.term))
+            next_month = compute_loan_month(loan, month + 1)
+            next_payment = None if next_month.month is None else next_month.principal_cents + next_month.interest_cents
+            loans.append({"loan_id": loan.id, "principal_balance": paid.remaining_balance_cents,
+                          "principal_paid": paid.cumulative_principal_cents, "interest_paid": paid.cumulative_interest_cents,
+                          "next_payment": next_payment})
+        loans.sort(key=lambda loan: loan["loan_id"])
+
+    result = {"month": month, "loans": loans}
+    for total in PORTFOLIO_TOTALS:
+        result[total] = from_cents(sum(loan[total] for loan in loans if loan[total] is not None))
+        for loan in loans:
+            loan[total] = from_cents(loan[total])
+    return result
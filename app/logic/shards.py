@@ -0,0 +1,244 @@
+"""
+The user and loan logic spanning several shards, see app.sharding. The logic of a single loan needs none
+of it, it runs as is on a session of the loan's shard.
+"""
+from itertools import chain
+
+from sqlalchemy import delete, func, insert, or_, select
+from sqlalchemy.orm.session import Session
+
+from app import schemas
+from app.logic.export import iter_loan_schedules, render_loan_schedules, select_user_loan_ids
+from app.logic.loan import build_loan_response, bump_user_versions, create_loan, create_loan_in_batches, create_loans_bulk, share_loans_by_email
+from app.logic.portfolio import PORTFOLIO_TOTALS, get_user_portfolio
+from app.logic.user import build_user, get_user_by_email, get_user_loans
+from app.models import Loan, LoanMonth, User, association_table
+from app.money import from_cents, to_cents
+from app.sharding import MAIN_SHARD, ShardSession, allocate_loan_ids, fan_out, shard_for_loan, shard_names
+
+USER_COLUMNS = (User.id, User.email, User.first_name, User.last_name)
+
+
+def create_user_on_shards(db: Session, user: schemas.UserCreate):
+    """
+    Creates a user on the main shard, with a session `db` of it, and replicates it to every other shard. The
+    user is only committed on the main shard once every other shard holds its copy, so a failed copy leaves
+    no user behind, and retries register it anew.
+    """
+    _user = build_user(user)
+    db.add(_user)
+    db.flush()
+    replicate_users([_user])
+    db.commit()
+    db.refresh(_user)
+    return _user
+
+def replicate_users(users: list[User]):
+    """
+    Copies users created on the main shard to every other shard, with the ids the main shard gave them.
+    Copies left on a shard by a registration that failed on another one, with the same id or email, are replaced.
+    """
+    values = [{column.key: getattr(user, column.key) for column in USER_COLUMNS} for user in users]
+    stale = or_(User.id.in_([user.id for user in users]), func.lower(User.email).in_([user.email.lower() for user in users]))
+    def insert_users(db: Session):
+        db.execute(delete(User.__table__).where(stale))
+        db.execute(insert(User), values)
+        db.commit()
+    fan_out(insert_users, shard_names()[1:])
+
+def sync_users():
+    """
+    Copies the users of the main shard missing on the other shards to them, e.g. to a shard that was just
+    added. Returns the number of users copied.
+    """
+    db = ShardSession(MAIN_SHARD)
+    try:
+        users = db.execute(select(*USER_COLUMNS)).mappings().all()
+    finally:
+        db.close()
+    def sync(db: Session):
+        existing = set(db.scalars(select(User.id)))
+        missing = [dict(user) for user in users if user["id"] not in existing]
+        if missing:
+            db.execute(insert(User), missing)
+            db.commit()
+        return len(missing)
+    return sum(fan_out(sync, shard_names()[1:]).values())
+
+def get_user_loans_version_on_shards(email: str):
+    """
+    Returns the (id, loans version) of a user, or None for unknown users. Every shard bumps its own copy of
+    the loans version, their sum changes whenever any of them does.
+    """
+    statement = select(User.id, User.loans_version).where(func.lower(User.email) == email.lower())
+    versions = fan_out(lambda db: db.execute(statement).first())
+    if versions[MAIN_SHARD] is None:
+        return None
+    return versions[MAIN_SHARD].id, sum(version.loans_version for version in versions.values() if version is not None)
+
+def get_user_loans_on_shards(email: str, include_months: bool = True):
+    """
+    Gets the loans of a user, see get_user_loans, from every shard at once. Returns them ordered by id, as
+    UserLoan or, without `include_months`, LoanHeader schemas.
+    """
+    def user_loans(db: Session):
+        user = get_user_by_email(db, email=email)
+        if user is None:
+            return []
+        loans = get_user_loans(db=db, user=user, include_months=include_months)
+        if not include_months:
+            return [schemas.LoanHeader.from_orm(loan) for loan in loans]
+        return [build_loan_response(loan, schemas.UserLoan) for loan in loans]
+    return sorted(chain.from_iterable(fan_out(user_loans).values()), key=lambda loan: loan.id)
+
+def create_loan_on_shard(loan: schemas.LoanCreate, email: str, batch_size: int | None = None):
+    """
+    Creates a loan for the user with `email` on the shard of a newly allocated loan id, with
+    create_loan_in_batches when a `batch_size` is given. Returns the loan as a Loan schema.
+    """
+    loan_id = allocate_loan_ids()[0]
+    db = ShardSession(shard_for_loan(loan_id))
+    try:
+        user = get_user_by_email(db, email=email)
+        if user is None:
+            raise LookupError("No user for loan found")
+        if batch_size is None:
+            _loan = create_loan(db, loan, user, id=loan_id)
+        else:
+            _loan = create_loan_in_batches(db, loan, user, batch_size=batch_size, id=loan_id)
+        return build_loan_response(_loan)
+    finally:
+        db.close()
+
+def create_loans_bulk_on_shards(loans: list[schemas.LoanBulkCreate], chunk_size: int = 500):
+    """
+    Creates many loans at once, see create_loans_bulk. The loans are given their ids up front and written
+    by every shard at once, each shard inserting those placed on it.
+    """
+    by_shard = {}
+    for index, loan_id in enumerate(allocate_loan_ids(len(loans))):
+        by_shard.setdefault(shard_for_loan(loan_id), []).append((index, loan_id))
+    def create(db: Session):
+        placed = by_shard[db.info["shard"]]
+        return create_loans_bulk(db, [loans[index] for index, _ in placed], chunk_size=chunk_size,
+                                 loan_ids=[loan_id for _, loan_id in placed])
+    results = [None] * len(loans)
+    for shard, shard_results in fan_out(create, list(by_shard)).items():
+        for (index, _), result in zip(by_shard[shard], shard_results):
+            results[index] = result
+    return results
+
+def share_loans_on_shards(shares: list[schemas.LoanShare]):
+    """
+    Shares many loans at once, see share_loans_by_email. Every shard shares the loans placed on it, all shards
+    at once and each in a transaction of its own.
+    """
+    by_shard = {}
+    for index, share in enumerate(shares):
+        by_shard.setdefault(shard_for_loan(share.loan_id), []).append(index)
+    def share(db: Session):
+        return share_loans_by_email(db, [shares[index] for index in by_shard[db.info["shard"]]])
+    results = [None] * len(shares)
+    for shard, shard_results in fan_out(share, list(by_shard)).items():
+        for index, result in zip(by_shard[shard], shard_results):
+            results[index] = result
+    return results
+
+def get_user_portfolio_on_shards(email: str, month: int):
+    """
+    Gets the portfolio of a user, see get_user_portfolio, from every shard at once
+    """
+    def user_portfolio(db: Session):
+        user = get_user_by_email(db, email=email)
+        return None if user is None else get_user_portfolio(db=db, user=user, month=month)
+    portfolios = [portfolio for portfolio in fan_out(user_portfolio).values() if portfolio is not None]
+    result = {"month": month, "loans": sorted(chain.from_iterable(portfolio["loans"] for portfolio in portfolios),
+                                              key=lambda loan: loan["loan_id"])}
+    for total in PORTFOLIO_TOTALS:
+        # Summed in cents, adding Decimals would round to the precision of the decimal context
+        result[total] = from_cents(sum(to_cents(portfolio[total]) for portfolio in portfolios))
+    return result
+
+def export_loan_schedules_on_shards(loan_ids: list[int] | None = None, email: str | None = None,
+                                    format: str = "ndjson", batch_size: int = 1000):
+    """
+    Renders the schedules of the requested loans, or of all loans of the user with `email`, like
+    export_loan_schedules does. The shards are exported one after the other, each with a session that
+    is only open while it is read.
+    """
+    def rows():
+        for shard in shard_names():
+            shard_loan_ids = None if loan_ids is None else [loan_id for loan_id in loan_ids if shard_for_loan(loan_id) == shard]
+            if shard_loan_ids == []:
+                continue
+            db = ShardSession(shard)
+            try:
+                if shard_loan_ids is None:
+                    user = get_user_by_email(db, email=email)
+                    if user is None:
+                        continue
+                    shard_loan_ids = select_user_loan_ids(user)
+                yield from iter_loan_schedules(db, shard_loan_ids, batch_size=batch_size)
+            finally:
+                db.close()
+    return render_loan_schedules(rows(), format, batch_size)
+
+def rebalance_loans(batch_size: int = 100, drain: list[str] = ()):
+    """
+    Moves every loan that is not on the shard its id hashes to, e.g. after a shard was added, along with
+    its loan months and user_loans rows. Shards to `drain` are left out of the placement, so that all their
+    loans move off them and they can be removed. The users are synced to every shard first. Loans are copied to their
+    shard and committed there before they are deleted from the one they were on, so an interrupted run
+    leaves loans on both, which the next run replaces. Loan months get new ids on the shard they move to.
+    Returns the number of loans moved.
+    """
+    if MAIN_SHARD in drain:
+        raise ValueError("The main shard cannot be drained")
+    placement = [shard for shard in shard_names() if shard not in drain]
+    sync_users()
+    moved = 0
+    for source in shard_names():
+        db = ShardSession(source)
+        try:
+            misplaced = [loan_id for loan_id in db.scalars(select(Loan.id).order_by(Loan.id))
+                         if shard_for_loan(loan_id, placement) != source]
+            for start in range(0, len(misplaced), batch_size):
+                batch = misplaced[start:start + batch_size]
+                by_target = {}
+                for loan_id in batch:
+                    by_target.setdefault(shard_for_loan(loan_id, placement), []).append(loan_id)
+                for target, loan_ids in by_target.items():
+                    _copy_loans(db, target, loan_ids)
+                _delete_loans(db, batch)
+                db.commit()
+                moved += len(batch)
+        finally:
+            db.close()
+    return moved
+
+def _copy_loans(db: Session, target: str, loan_ids: list[int]):
+    loans = db.execute(select(Loan.__table__).where(Loan.id.in_(loan_ids))).mappings().all()
+    user_loans = db.execute(select(association_table).where(association_table.c.loan_id.in_(loan_ids))).mappings().all()
+    month_columns = [column for column in LoanMonth.__table__.columns if column.key != "id"]
+    loan_months = db.execute(select(*month_columns).where(LoanMonth.loan_id.in_(loan_ids))).mappings().all()
+    target_db = ShardSession(target)
+    try:
+        # Copies left behind by an interrupted run are replaced
+        _delete_loans(target_db, loan_ids)
+        target_db.execute(insert(Loan.__table__), [dict(loan) for loan in loans])
+        if user_loans:
+            target_db.execute(insert(association_table), [dict(user_loan) for user_loan in user_loans])
+            # The users' loans read differently now, see below, so the sum of their loans versions over the
+            # shards, their loans ETag, has to change
+            target_db.execute(bump_user_versions({user_loan["user_id"] for user_loan in user_loans}))
+        if loan_months:
+            # The loan months get new ids on the shard they move to
+            target_db.execute(insert(LoanMonth.__table__), [dict(loan_month) for loan_month in loan_months])
+        target_db.commit()
+    finally:
+        target_db.close()
+
+def _delete_loans(db: Session, loan_ids: list[int]):
+    db.execute(delete(LoanMonth.__table__).where(LoanMonth.loan_id.in_(loan_ids)))
+    db.execute(delete(association_table).where(association_table.c.loan_id.in_(loan_ids)))
+    db.execute(delete(Loan.__table__).where(Loan.id.in_(loan_ids)))
@@ -0,0 +1,137 @@
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from sqlalchemy.orm.session import Session
+
+from app import schemas
+from app.config import settings
+from app.logic.common import calculate_monthly_payment
+from app.models import Loan
+
+
+def simulate_loan(db: Session, loan_id: int, simulation: schemas.SimulationRequest):
+    '''
+    Simulates every combination of the requested extra principal, lump sums and rate resets against the terms
+    of a loan, returning the total interest and payoff month of each scenario. Scenarios refer to their lump sums
+    and rate resets by position in the request, which keeps large grids quick to serialize. Returns None for a
+    missing loan.
+    '''
+    loan = db.get(Loan, loan_id)
+    if loan is None:
+        return None
+    grid = build_scenario_grid(simulation.extra_principal, range(len(simulation.lump_sums)), range(len(simulation.rate_resets)))
+    scenarios = build_scenario_grid(simulation.extra_principal,
+                                    [[(lump_sum.month, lump_sum.amount) for lump_sum in lump_sums] for lump_sums in simulation.lump_sums],
+                                    [[(reset.month, reset.interest_rate) for reset in resets] for resets in simulation.rate_resets])
+    summaries = run_simulation(loan.interest_rate, loan.term, loan.amount_cents / 100, scenarios)
+    return {"loan_id": loan.id,
+            "scenarios": [{"extra_principal": extra_principal, "lump_sums_index": lump_sums, "rate_resets_index": rate_resets,
+                           "total_interest": total_interest, "payoff_month": payoff_month}
+                          for (extra_principal, lump_sums, rate_resets), (total_interest, payoff_month) in zip(grid, summaries)]}
+
+def build_scenario_grid(extra_principal, lump_sums, rate_resets):
+    '''
+    Builds every combination of the given scenario axes
+
+    Parameters
+    ----------
+    extra_principal : list
+        Extra principal paid every month, one entry per scenario of this axis
+    lump_sums : list
+        Lists of (month, amount) one-off prepayments, one list per scenario of this axis
+    rate_resets : list
+        Lists of (month, interest) rate changes, one list per scenario of this axis. From the given month on the
+        loan accrues the new interest rate, expressed as percentage, and its payment is recalculated over the
+        remaining term, like an adjustable rate mortgage does.
+
+    Returns
+    -------
+    list
+        An (extra_principal, lump_sums, rate_resets) tuple per scenario
+    '''
+    return list(itertools.product(extra_principal, lump_sums, rate_resets))
+
+def simulate_scenarios(interest: float, term: int, principal: float, scenarios):
+    '''
+    Simulates the repayment of a loan under each scenario. The scenarios run side by side as arrays, so the
+    cost is one pass over the months of the loan whatever the number of scenarios. Balances are kept in whole
+    cents, interest is rounded to the cent every month and the final month of the term pays off any balance left.
+
+    Parameters
+    ----------
+    interest : float
+        The interest rate of the loan expressed as percentage. A 3.5% APR would be input as 3.5
+    term : int
+        The number of months of the loan. A 3 year mortgage would be input as 36.
+    principal : float
+        The original amount borrowed. $30,000 loan would be input as 30000
+    scenarios : list
+        (extra_principal, lump_sums, rate_resets) tuples, see build_scenario_grid
+
+    Returns
+    -------
+    tuple
+        Two arrays holding the total interest paid and the month the loan is paid off in, per scenario
+    '''
+    count = len(scenarios)
+    extra = np.rint(np.array([scenario[0] for scenario in scenarios], dtype=np.float64) * 100)
+    lumps = np.zeros((count, term + 1))
+    rates = np.full((count, term + 1), float(interest))
+    for row, (_, lump_sums, rate_resets) in enumerate(scenarios):
+        for month, amount in lump_sums:
+            if 0 < month <= term:
+                lumps[row, month] += round(amount * 100)
+        for month, rate in sorted(rate_resets):
+            if 0 < month <= term:
+                rates[row, month:] = rate
+
+    balance = np.full(count, float(round(principal * 100)))
+    payment = np.full(count, np.rint(calculate_monthly_payment(interest, term, principal) * 100))
+    total_interest = np.zeros(count)
+    payoff_month = np.zeros(count, dtype=np.int64)
+    for month in range(1, term + 1):
+        active = balance > 0
+        if not active.any():
+            break
+        reset = active & (rates[:, month] != rates[:, month - 1])
+        if reset.any():
+            payment[reset] = np.rint(calculate_monthly_payment(rates[reset, month], term - month + 1,
+                                                               balance[reset] / 100) * 100)
+        interest_due = np.where(active, np.rint(balance * rates[:, month] / 1200), 0)
+        if month == term:
+            principal_paid = balance
+        else:
+            principal_paid = np.minimum(payment - interest_due + extra + lumps[:, month], balance)
+        total_interest += interest_due
+        balance = np.where(active, balance - principal_paid, balance)
+        payoff_month[active & (balance <= 0)] = month
+    return total_interest / 100, payoff_month
+
+def run_simulation(interest: float, term: int, principal: float, scenarios, batch_size: int | None = None):
+    '''
+    Simulates the scenarios in batches of `batch_size`, spread over the simulation process pool when there is
+    more than one batch. Returns a (total_interest, payoff_month) tuple per scenario, in scenario order.
+    '''
+    batch_size = batch_size or settings.simulation_batch_size
+    batches = [scenarios[start:start + batch_size] for start in range(0, len(scenarios), batch_size)]
+    if len(batches) > 1:
+        results = get_simulation_executor().map(simulate_scenarios, itertools.repeat(interest), itertools.repeat(term),
+                                                itertools.repeat(principal), batches)
+    else:
+        results = (simulate_scenarios(interest, term, principal, batch) for batch in batches)
+
+    summaries = []
+    for total_interest, payoff_month in results:
+        summaries.extend(zip(np.round(total_interest, 2).tolist(), payoff_month.tolist()))
+    return summaries
+
+@lru_cache(maxsize=None)
+def get_simulation_executor() -> ProcessPoolExecutor:
+    '''
+    The process pool simulations run on, created on first use. Workers are spawned rather than forked,
+    as forking the threaded server process is not safe.
+    '''
+    return ProcessPoolExecutor(max_workers=settings.simulation_workers, mp_context=multiprocessing.get_context("spawn"))
@@ -1,19 +1,38 @@
+from sqlalchemy import func
+from sqlalchemy.orm import noload, selectinload, undefer
 from sqlalchemy.orm.session import Session
 from app import schemas
-from app.models import User
+from app.models import User, Loan
+
+def build_user(user: schemas.UserCreate):
+    """
+    Builds a user without adding it to a session. Emails are stored lowercased, as users are looked up by
+    email ignoring case.
+    """
+    return User(**{**user.dict(), "email": user.email.lower()})
 
 def create_user(db: Session, user: schemas.UserCreate):
-    _user = User(**user.dict())
+    _user = build_user(user)
     db.add(_user)
     db.commit()
     db.refresh(_user)
     return _user
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(User).filter(User.email==email).first()
+def get_user_by_email(db: Session, email: str, with_loans: bool = False):
+    """
+    Looks up a user by email, ignoring case. With `with_loans` the user's loans and their loan months are
+    eagerly loaded with one extra query each, instead of one lazy load per loan.
+    """
+    query = db.query(User).filter(func.lower(User.email)==email.lower())
+    if with_loans:
+        query = query.options(selectinload(User.loans).selectinload(Loan.loan_months))
+    return query.first()
 
-def get_user_loans(db: Session, user: User):
+def get_user_loans(db: Session, user: User, include_months: bool = True):
     """
-    Returns all the loans associated with a given user
+    Returns all the loans associated with a given user. The loan months of every loan are
+    loaded with a single additional query, along with the packed schedules, or not at all when
+    `include_months` is False, in which case the loans come back with an empty loan_months list.
     """
-    return user.loans
\ No newline at end of file
+    months_loaders = (selectinload(Loan.loan_months), undefer(Loan.schedule_blob)) if include_months else (noload(Loan.loan_months),)
+    return db.query(Loan).join(Loan.users).filter(User.id==user.id).options(*months_loaders).order_by(Loan.id).all()
\ No newline at end of file
@@ -1,72 +1,249 @@
-from fastapi import Depends, FastAPI
+from typing import Literal
+
+from fastapi import APIRouter, Depends, FastAPI, Query, Request
 from fastapi.exceptions import HTTPException
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.session import Session
 
-from app import models, schemas
-from app.database import engine, SessionLocal 
+from app import schemas
+from app.admission import AdmissionMiddleware
+from app.config import settings
+from app.database import SessionLocal
+from app.http_cache import is_not_modified, make_etag, not_modified, with_cache_headers
+from app.idempotency import IdempotentRequest
+from app.jobs import BACKGROUND_RESPONSES, accepted_response, get_job_queue
+from app.logic.common import prewarm_amortization_factors
+from app.logic.export import EXPORT_MEDIA_TYPES, export_loan_schedules, select_user_loan_ids
 from app.logic.ping_db import ping_db
+from app.logic.portfolio import get_user_portfolio
+from app.logic.shards import create_loan_on_shard, create_loans_bulk_on_shards, create_user_on_shards,\
+    export_loan_schedules_on_shards, get_user_loans_on_shards, get_user_loans_version_on_shards, get_user_portfolio_on_shards,\
+    share_loans_on_shards
+from app.logic.simulation import simulate_loan
+from app.metrics import CONTENT_TYPE, REGISTRY
+from app.migrations import upgrade
+from app.profiling import ProfilingMiddleware, TimedRoute
+from app.serialization import fast_response
+from app.sharding import fan_out, get_shard_engine, request_shard, route_session, shard_names, sharding_enabled
 from app.logic.user import get_user_by_email, create_user, get_user_loans
-from app.logic.loan import create_loan, get_loan, share_loan
-
-#TODO: Implement Alembic migrations
-models.Base.metadata.create_all(bind=engine)
+from app.logic.loan import build_loan_response, create_loan, create_loans_bulk, get_loan, get_loan_schedule, get_loan_version, get_month_summary,\
+    share_loan, share_loans_by_email
 
 app = FastAPI()
+app.router.route_class = TimedRoute
+app.add_middleware(ProfilingMiddleware)
+# Outermost, so shed requests cost as little as possible
+app.add_middleware(AdmissionMiddleware)
+# The core user and loan routes, swapped for their async counterparts in async database mode
+router = APIRouter(route_class=TimedRoute)
+
+@app.on_event("startup")
+def migrate_database():
+    if settings.migrate_on_startup:
+        for shard in shard_names():
+            upgrade(get_shard_engine(shard))
+
+@app.on_event("startup")
+def prewarm_amortization_table():
+    prewarm_amortization_factors(settings.amortization_prewarm_terms, settings.amortization_prewarm_rate_step,
+                                 settings.amortization_prewarm_max_rate)
+
+@app.on_event("startup")
+def start_job_workers():
+    if settings.background_writes:
+        get_job_queue().start(settings.job_workers)
+
+@app.on_event("shutdown")
+def stop_job_workers():
+    if settings.background_writes:
+        get_job_queue().stop()
 
 # Dependency
-def get_db():
+def get_db(request: Request):
     db = SessionLocal()
+    if sharding_enabled():
+        # The routes of a single loan go to the loan's shard, all others start out on the main shard
+        route_session(db, request_shard(request))
     try:
         yield db
     finally:
         db.close()
 
-@app.get("/health_check")
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+@router.get("/health_check")
 def health_check(db: Session = Depends(get_db)):
-    if ping_db(db=db):
+    healthy = all(fan_out(ping_db).values()) if sharding_enabled() else ping_db(db=db)
+    if healthy:
         return {"Status": "Ok"}
     else:
         raise HTTPException(status_code=400, detail="No Database Connection")
 
-@app.post("/users/", response_model=schemas.User, status_code=201)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = get_user_by_email(db, email=user.email)
-    if db_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    return create_user(db=db, user=user)
+@router.post("/users/", response_model=schemas.User, status_code=201)
+def register_user(request: Request, user: schemas.UserCreate, db: Session = Depends(get_db)):
+    with IdempotentRequest(request, user) as idempotency:
+        if idempotency.response is not None:
+            return idempotency.response
+        db_user = get_user_by_email(db, email=user.email)
+        if db_user:
+            raise HTTPException(status_code=400, detail="Email already registered")
+        try:
+            if sharding_enabled():
+                db_user = create_user_on_shards(db=db, user=user)
+            else:
+                db_user = create_user(db=db, user=user)
+        except IntegrityError:
+            # Another request registered the email since it was looked up
+            raise HTTPException(status_code=400, detail="Email already registered")
+        idempotency.complete(f"users/{db_user.id}")
+        return db_user
 
-@app.get("/users/{email}/loans/")
-def get_user_loans(email: str, db: Session = Depends(get_db)) -> list[schemas.UserLoan]:
-    db_user = get_user_by_email(db, email=email)
-    if not db_user:
+# Loan headers come back without the loan_months key, as it is left unset on them
+@router.get("/users/{email}/loans/", response_model=list[schemas.UserLoan], response_model_exclude_unset=True)
+def read_user_loans(request: Request, response: Response, email: str, include_months: bool = True,
+                    db: Session = Depends(get_db)):
+    if sharding_enabled():
+        user_version = get_user_loans_version_on_shards(email)
+    else:
+        db_user = get_user_by_email(db, email=email)
+        user_version = db_user and (db_user.id, db_user.loans_version)
+    if not user_version:
         raise HTTPException(status_code=404, detail="User not found")
-    return get_user_loans(db=db, user=db_user)
+    etag = make_etag("user", *user_version, "loans", int(include_months))
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    with_cache_headers(response, etag)
+    if sharding_enabled():
+        return get_user_loans_on_shards(email, include_months=include_months)
+    loans = get_user_loans(db=db, user=db_user, include_months=include_months)
+    if not include_months:
+        return [schemas.LoanHeader.from_orm(loan) for loan in loans]
+    return [build_loan_response(loan, schemas.UserLoan) for loan in loans]
+
+@router.post("/loans/{email}/", response_model=schemas.Loan, status_code=201, responses=BACKGROUND_RESPONSES)
+def create_user_loan(request: Request, loan: schemas.LoanCreate, email: str, db: Session = Depends(get_db)):
+    with IdempotentRequest(request, loan) as idempotency:
+        if idempotency.response is not None:
+            return idempotency.response
+        db_user = get_user_by_email(db, email=email)
+        if not db_user:
+            raise HTTPException(status_code=404, detail="No user for loan found")
+        if settings.background_writes:
+            job = get_job_queue().submit("create_loan", {"email": db_user.email, "loan": loan.dict()})
+            idempotency.complete(f"jobs/{job.id}", status_code=202)
+            return accepted_response(job)
+        if sharding_enabled():
+            try:
+                _loan = create_loan_on_shard(loan, email=db_user.email)
+            except LookupError:
+                # The user is on the main shard but not yet on the loan's, e.g. one added without app.rebalance
+                raise HTTPException(status_code=409, detail="User not yet replicated to the shard of the loan")
+        else:
+            _loan = build_loan_response(create_loan(db=db, loan=loan, user=db_user))
+        idempotency.complete(f"loans/{_loan.id}")
+        return _loan
 
-@app.post("/loans/{email}/", response_model=schemas.Loan, status_code=201)
-def create_loan(loan: schemas.LoanCreate, email: str, db: Session = Depends(get_db)):
+# The routes below are served by their sync handlers in both database modes, as their logic has no async
+# counterpart. Being on the app, they are matched ahead of the router's /loans/{email}/, which would otherwise take
+# /loans/bulk/ for the loans of a user with the email "bulk", so their trailing slash paths are declared here too.
+@app.post("/loans/bulk", responses=BACKGROUND_RESPONSES)
+@app.post("/loans/bulk/", include_in_schema=False)
+def bulk_create_loans(loans: list[schemas.LoanBulkCreate], db: Session = Depends(get_db)) -> list[schemas.LoanBulkResult]:
+    if settings.background_writes:
+        return accepted_response(get_job_queue().submit("create_loans_bulk", {"loans": [loan.dict() for loan in loans]}))
+    if sharding_enabled():
+        return create_loans_bulk_on_shards(loans)
+    return create_loans_bulk(db=db, loans=loans)
+
+@app.patch("/loans/share")
+@app.patch("/loans/share/", include_in_schema=False)
+def share_loans_with_users(shares: list[schemas.LoanShare], db: Session = Depends(get_db)) -> list[schemas.LoanShareResult]:
+    if sharding_enabled():
+        return share_loans_on_shards(shares)
+    return share_loans_by_email(db=db, shares=shares)
+
+@app.get("/jobs/{id}")
+def read_job(id: str) -> schemas.Job:
+    job = get_job_queue().get(id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/loans/export/")
+def export_schedules(format: Literal["ndjson", "csv"] = "ndjson", email: str | None = None,
+                     loan_id: list[int] = Query(default=[]), db: Session = Depends(get_db)):
+    if (email is None) == (not loan_id):
+        raise HTTPException(status_code=400, detail="Either an email or loan ids are required")
+    loan_ids = loan_id
+    if email is not None:
+        db_user = get_user_by_email(db, email=email)
+        if not db_user:
+            raise HTTPException(status_code=404, detail="User not found")
+        loan_ids = select_user_loan_ids(db_user)
+    if sharding_enabled():
+        content = export_loan_schedules_on_shards(loan_ids=loan_id or None, email=email, format=format)
+    else:
+        content = export_loan_schedules(db=db, loan_ids=loan_ids, format=format)
+    # The session stays open until the response has been streamed, the dependency cleanup runs after it
+    return StreamingResponse(content,
+                             media_type=EXPORT_MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="schedules.{format}"'})
+
+@app.post("/loans/{id}/simulate/")
+def simulate_loan_scenarios(id: int, simulation: schemas.SimulationRequest, db: Session = Depends(get_db)) -> schemas.SimulationResult:
+    if simulation.scenario_count > settings.simulation_max_scenarios:
+        raise HTTPException(status_code=400, detail=f"At most {settings.simulation_max_scenarios} scenarios can be simulated at once")
+    result = simulate_loan(db=db, loan_id=id, simulation=simulation)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    return result
+
+@app.get("/users/{email}/portfolio/")
+def read_user_portfolio(email: str, month: int = Query(ge=1), db: Session = Depends(get_db)) -> schemas.Portfolio:
     db_user = get_user_by_email(db, email=email)
     if not db_user:
-        raise HTTPException(status_code=404, detail="No user for loan found")
-    return create_loan(db=db, loan=loan, email=email)
+        raise HTTPException(status_code=404, detail="User not found")
+    if sharding_enabled():
+        return get_user_portfolio_on_shards(email, month=month)
+    return get_user_portfolio(db=db, user=db_user, month=month)
 
-@app.get("/loans/{id}/schedule/")
-def get_loan_schedule(id: int, db: Session = Depends(get_db)) -> list[schemas.ScheduleItem]:
-    result = get_loan_schedule(db=db, loan_id=id)
+@router.get("/loans/{id}/schedule/")
+def read_loan_schedule(request: Request, response: Response, id: int, from_month: int = Query(1, ge=1),
+                      to_month: int | None = Query(None, ge=1), db: Session = Depends(get_db)) -> list[schemas.ScheduleItem]:
+    version = get_loan_version(db=db, loan_id=id)
+    etag = None if version is None else make_etag("loan", id, version, "schedule", from_month, to_month)
+    if etag is not None and is_not_modified(request, etag):
+        return not_modified(etag)
+    result = get_loan_schedule(db=db, loan_id=id, from_month=from_month, to_month=to_month)
     if result is None:
         raise HTTPException(status_code=404, detail="Loan not found")
+    if settings.fast_serialization:
+        return with_cache_headers(fast_response(schemas.ScheduleItem, result), etag)
+    with_cache_headers(response, etag)
     return result
 
-@app.get("/loans/{id}/month/{month}/")
-def get_month_summary(id: int, month: int, db: Session = Depends(get_db)) ->schemas.MonthSummary:
+@router.get("/loans/{id}/month/{month}/")
+def read_month_summary(request: Request, response: Response, id: int, month: int,
+                       db: Session = Depends(get_db)) -> schemas.MonthSummary:
+    version = get_loan_version(db=db, loan_id=id)
+    etag = None if version is None else make_etag("loan", id, version, "month", month)
+    if etag is not None and is_not_modified(request, etag):
+        return not_modified(etag)
     result = get_month_summary(db=db, loan_id=id, month=month)
     if result is None:
         raise HTTPException(status_code=404, detail="Loan not found")
     if result["principal_balance"] is None:
         raise HTTPException(status_code=404, detail="Requested month not found")
+    if settings.fast_serialization:
+        return with_cache_headers(fast_response(schemas.MonthSummary, result), etag)
+    with_cache_headers(response, etag)
     return result
 
-@app.patch("/loans/{id}/share/{email}/")
-def share_loan(id: int, email: str, db: Session = Depends(get_db)):
+@router.patch("/loans/{id}/share/{email}/")
+def share_loan_with_user(id: int, email: str, db: Session = Depends(get_db)):
     db_user = get_user_by_email(db, email=email)
     db_loan = get_loan(db=db, id=id)
     if db_loan is None:
@@ -74,3 +251,9 @@ def share_loan(id: int, email: str, db: Session = Depends(get_db)):
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     share_loan(db=db, user=db_user, loan=db_loan)
+
+if settings.database_async:
+    from app.async_routes import router as async_router
+    app.include_router(async_router)
+else:
+    app.include_router(router)
@@ -0,0 +1,55 @@
+"""
+Schema migrations, managed with Alembic. Every change to the mapped tables comes with a revision in
+app/migrations/versions, written by hand or started with `alembic revision --autogenerate -m "..."`.
+
+Usage: python -m app.migrations [revision], upgrades the configured database to `revision`, "head" by default
+"""
+import os
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+from app.database import get_engine
+
+
+def get_config() -> Config:
+    """
+    The Alembic configuration of the application, pointing at this package's revisions
+    """
+    config = Config()
+    config.set_main_option("script_location", os.path.dirname(__file__))
+    return config
+
+def upgrade(engine: Engine | None = None, revision: str = "head"):
+    """
+    Upgrades the database of `engine`, the configured database by default, to `revision`.
+    Databases created before migrations existed are adopted by the initial revision.
+    """
+    engine = engine or get_engine()
+    config = get_config()
+    with engine.begin() as connection:
+        config.attributes["connection"] = connection
+        command.upgrade(config, revision)
+
+def check_unique_emails(connection: Connection):
+    """
+    Fails with the emails held by several users, ignoring case, which the unique lower(email) index cannot
+    be created over. Their users have to be merged, or their emails changed, by hand first.
+    """
+    duplicates = connection.execute(text("SELECT lower(email) FROM users GROUP BY lower(email) HAVING count(*) > 1 "
+                                         "ORDER BY lower(email)")).scalars().all()
+    if duplicates:
+        raise RuntimeError("Several users share an email, ignoring case, merge them before upgrading: "
+                           + ", ".join(duplicates))
+
+def downgrade(engine: Engine | None = None, revision: str = "-1"):
+    """
+    Downgrades the database of `engine`, the configured database by default, to `revision`
+    """
+    engine = engine or get_engine()
+    config = get_config()
+    with engine.begin() as connection:
+        config.attributes["connection"] = connection
+        command.downgrade(config, revision)
@@ -0,0 +1,5 @@
+import sys
+
+from app.migrations import upgrade
+
+upgrade(revision=sys.argv[1] if len(sys.argv) > 1 else "head")
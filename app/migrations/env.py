@@ -0,0 +1,34 @@
+from logging.config import fileConfig
+
+from alembic import context
+
+from app import models
+from app.config import settings
+from app.database import create_db_engine
+
+config = context.config
+# Only the alembic command line reads alembic.ini, the application keeps its own logging setup
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+
+def run_migrations(connection):
+    # SQLite can only alter tables by recreating them, which batch mode does
+    context.configure(connection=connection, target_metadata=models.Base.metadata,
+                      render_as_batch=connection.dialect.name == "sqlite")
+    with context.begin_transaction():
+        context.run_migrations()
+
+if context.is_offline_mode():
+    context.configure(url=settings.database_url, target_metadata=models.Base.metadata, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+elif config.attributes.get("connection") is not None:
+    run_migrations(config.attributes["connection"])
+else:
+    engine = create_db_engine()
+    try:
+        with engine.begin() as connection:
+            run_migrations(connection)
+    finally:
+        engine.dispose()
@@ -0,0 +1,70 @@
+"""Initial schema
+
+The tables as they were before migrations were introduced. Databases created back then by create_all
+are adopted: tables they are missing are created and tables created by even earlier versions get the
+columns they are missing, added as nullable and left NULL on existing rows as app.backfill expects.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+metadata = sa.MetaData()
+
+sa.Table(
+    "users", metadata,
+    sa.Column("id", sa.Integer, primary_key=True, index=True),
+    sa.Column("email", sa.String, unique=True, index=True),
+    sa.Column("first_name", sa.String),
+    sa.Column("last_name", sa.String),
+)
+sa.Table(
+    "loans", metadata,
+    sa.Column("id", sa.Integer, primary_key=True, index=True),
+    sa.Column("amount", sa.Float),
+    sa.Column("term", sa.Integer),
+    sa.Column("interest_rate", sa.Float),
+    sa.Column("schedule_storage", sa.String),
+)
+sa.Table(
+    "user_loans", metadata,
+    sa.Column("user_id", sa.ForeignKey("users.id"), primary_key=True),
+    sa.Column("loan_id", sa.ForeignKey("loans.id"), primary_key=True),
+)
+sa.Table(
+    "loan_months", metadata,
+    sa.Column("id", sa.Integer, primary_key=True, index=True),
+    sa.Column("month", sa.Integer),
+    sa.Column("principal_amount", sa.Numeric(scale=2)),
+    sa.Column("interest_amount", sa.Numeric(scale=2)),
+    sa.Column("cumulative_principal", sa.Numeric(scale=2)),
+    sa.Column("cumulative_interest", sa.Numeric(scale=2)),
+    sa.Column("remaining_balance", sa.Numeric(scale=2)),
+    sa.Column("loan_id", sa.Integer, sa.ForeignKey("loans.id")),
+    sa.UniqueConstraint("loan_id", "month", name="_loan_month_uc"),
+)
+
+
+def upgrade():
+    connection = op.get_bind()
+    inspector = sa.inspect(connection)
+    existing_tables = set(inspector.get_table_names())
+    metadata.create_all(connection, tables=[table for table in metadata.sorted_tables if table.name not in existing_tables])
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                op.add_column(table.name, sa.Column(column.name, column.type))
+
+
+def downgrade():
+    metadata.drop_all(op.get_bind())
@@ -0,0 +1,30 @@
+"""Index loan owners and case-insensitive emails
+
+user_loans is keyed by (user_id, loan_id), which leaves finding the users of a loan to a full scan.
+Users are looked up by lower(email), which the plain email index cannot serve. The index is unique, so
+that no two users' emails differ by case alone.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.migrations import check_unique_emails
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_user_loans_loan_id", "user_loans", ["loan_id"])
+    check_unique_emails(op.get_bind())
+    op.create_index("ix_users_email_lower", "users", [sa.text("lower(email)")], unique=True)
+
+
+def downgrade():
+    op.drop_index("ix_users_email_lower", table_name="users")
+    op.drop_index("ix_user_loans_loan_id", table_name="user_loans")
@@ -0,0 +1,51 @@
+"""Store money as whole cents
+
+Loan amounts were floats and loan month amounts two place numerics. Both become BIGINT cents,
+converted in place by rounding the old amounts to the nearest cent.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+# (table, amount column, cents column)
+MONEY_COLUMNS = (
+    ("loans", "amount", "amount_cents"),
+    ("loan_months", "principal_amount", "principal_cents"),
+    ("loan_months", "interest_amount", "interest_cents"),
+    ("loan_months", "cumulative_principal", "cumulative_principal_cents"),
+    ("loan_months", "cumulative_interest", "cumulative_interest_cents"),
+    ("loan_months", "remaining_balance", "remaining_balance_cents"),
+)
+
+
+def upgrade():
+    for table in ("loans", "loan_months"):
+        columns = [(amount, cents) for name, amount, cents in MONEY_COLUMNS if name == table]
+        with op.batch_alter_table(table) as batch:
+            for _, cents in columns:
+                batch.add_column(sa.Column(cents, sa.BigInteger))
+        op.execute(f"UPDATE {table} SET " +
+                   ", ".join(f"{cents} = CAST(ROUND({amount} * 100) AS BIGINT)" for amount, cents in columns))
+        with op.batch_alter_table(table) as batch:
+            for amount, _ in columns:
+                batch.drop_column(amount)
+
+
+def downgrade():
+    for table, amount_type in (("loans", sa.Float), ("loan_months", sa.Numeric(scale=2))):
+        columns = [(amount, cents) for name, amount, cents in MONEY_COLUMNS if name == table]
+        with op.batch_alter_table(table) as batch:
+            for amount, _ in columns:
+                batch.add_column(sa.Column(amount, amount_type))
+        op.execute(f"UPDATE {table} SET " + ", ".join(f"{amount} = {cents} / 100.0" for amount, cents in columns))
+        with op.batch_alter_table(table) as batch:
+            for _, cents in columns:
+                batch.drop_column(cents)
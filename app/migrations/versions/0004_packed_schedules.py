@@ -0,0 +1,27 @@
+"""Add packed schedule storage
+
+Loans gain a schedule_blob column holding the packed schedule of loans stored as "packed". Downgrading
+turns packed loans into lazily stored ones, which compute the same schedule from the loan terms.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("loans") as batch:
+        batch.add_column(sa.Column("schedule_blob", sa.LargeBinary))
+
+
+def downgrade():
+    op.execute("UPDATE loans SET schedule_storage = 'lazy' WHERE schedule_storage = 'packed'")
+    with op.batch_alter_table("loans") as batch:
+        batch.drop_column("schedule_blob")
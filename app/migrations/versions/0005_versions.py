@@ -0,0 +1,33 @@
+"""Add loan and user loan set versions
+
+Loans gain a version, bumped whenever their schedule changes, and users a loans_version, bumped
+whenever the loans they hold change. The ETags of the loan read routes are derived from them.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("loans") as batch:
+        batch.add_column(sa.Column("version", sa.Integer, nullable=False, server_default="1"))
+    with op.batch_alter_table("users") as batch:
+        batch.add_column(sa.Column("loans_version", sa.Integer, nullable=False, server_default="1"))
+
+
+def downgrade():
+    # SQLite drops the column by copying the table, which cannot carry over the expression index
+    op.drop_index("ix_users_email_lower", table_name="users")
+    with op.batch_alter_table("users") as batch:
+        batch.drop_column("loans_version")
+    op.create_index("ix_users_email_lower", "users", [sa.text("lower(email)")], unique=True)
+    with op.batch_alter_table("loans") as batch:
+        batch.drop_column("version")
@@ -0,0 +1,28 @@
+"""Add the id block table
+
+With sharding, loan ids are handed out in blocks reserved from the main shard's id_blocks table, so
+that ids are unique across the shards and every loan can be placed on a shard by its id.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "id_blocks",
+        sa.Column("name", sa.String, primary_key=True),
+        sa.Column("next_id", sa.BigInteger, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("id_blocks")
@@ -0,0 +1,33 @@
+"""Add the idempotency key table
+
+Create requests sent with an Idempotency-Key header store the key, a hash of the request and a reference to
+their response, so that retries are answered with the original response instead of creating duplicates.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "idempotency_keys",
+        sa.Column("key", sa.String, primary_key=True),
+        sa.Column("request_hash", sa.String, nullable=False),
+        sa.Column("response_ref", sa.String),
+        sa.Column("status_code", sa.Integer),
+        sa.Column("expires_at", sa.Float, nullable=False),
+    )
+    op.create_index("ix_idempotency_keys_expires_at", "idempotency_keys", ["expires_at"])
+
+
+def downgrade():
+    op.drop_index("ix_idempotency_keys_expires_at", table_name="idempotency_keys")
+    op.drop_table("idempotency_keys")
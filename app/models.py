@@ -1,9 +1,12 @@
 from __future__ import annotations
 
-from sqlalchemy import Column, Float, ForeignKey, Integer, Numeric, String, Table, UniqueConstraint
-from sqlalchemy.orm import Mapped, relationship
+from sqlalchemy import BigInteger, Column, Float, ForeignKey, Index, Integer, LargeBinary, String, Table, UniqueConstraint, func,\
+    type_coerce
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Mapped, deferred, relationship
 
 from app.database import Base
+from app.money import Money, from_cents, to_cents
 from typing import List
 
 
@@ -12,8 +15,55 @@ association_table = Table(
     Base.metadata,
     Column("user_id", ForeignKey("users.id"), primary_key=True),
     Column("loan_id", ForeignKey("loans.id"), primary_key=True),
+    # The primary key only serves lookups by user, this one finds the users of a loan
+    Index("ix_user_loans_loan_id", "loan_id"),
 )
 
+# The next free id of every id sequence handed out in blocks, see app.sharding. Only the main shard's is used.
+id_blocks = Table(
+    "id_blocks",
+    Base.metadata,
+    Column("name", String, primary_key=True),
+    Column("next_id", BigInteger, nullable=False),
+)
+
+# The Idempotency-Key of every recent create request, with the response it got, see app.idempotency
+idempotency_keys = Table(
+    "idempotency_keys",
+    Base.metadata,
+    Column("key", String, primary_key=True),
+    Column("request_hash", String, nullable=False),
+    # Where the response is read back from, e.g. loans/1, unset while the request is in flight
+    Column("response_ref", String),
+    Column("status_code", Integer),
+    Column("expires_at", Float, nullable=False, index=True),
+)
+
+
+# Loan.schedule_storage values
+SCHEDULE_ROWS = "rows"
+SCHEDULE_LAZY = "lazy"
+SCHEDULE_PACKED = "packed"
+# The storages keeping no loan months, whose schedule is read from the loan itself
+SCHEDULE_ON_LOAN = (SCHEDULE_LAZY, SCHEDULE_PACKED)
+
+
+def money_attribute(cents: str):
+    """
+    An amount of money stored as whole cents in the column attribute `cents`, read and written as a two
+    place Decimal. In queries it selects the cents column and converts the results, the logic reading
+    many amounts selects the cents columns themselves and does integer math on them.
+    """
+    def fget(self):
+        return from_cents(getattr(self, cents))
+
+    def fset(self, value):
+        setattr(self, cents, to_cents(value))
+
+    def expr(cls):
+        return type_coerce(getattr(cls, cents), Money())
+    return hybrid_property(fget, fset, expr=expr)
+
 
 #TODO: Add uuid style external ids
 class User(Base):
@@ -23,17 +73,28 @@ class User(Base):
     email = Column(String, unique=True, index=True)
     first_name = Column(String)
     last_name = Column(String)
+    # Bumped whenever the user's loans, or any of them, change, see Loan.version
+    loans_version = Column(Integer, nullable=False, default=1, server_default="1")
     loans: Mapped[List[Loan]] = relationship(
         secondary=association_table, back_populates="users"
     )
+    # Users are looked up by case-insensitive email, which is unique
+    __table_args__ = (Index("ix_users_email_lower", func.lower(email), unique=True),
+                     )
 
 class Loan(Base):
     __tablename__ = "loans"
 
     id = Column(Integer, primary_key=True, index=True)
-    amount = Column(Float)
+    amount_cents = Column(BigInteger)
+    amount = money_attribute("amount_cents")
     term = Column(Integer)
     interest_rate = Column(Float)
+    schedule_storage = Column(String, default=SCHEDULE_ROWS)
+    # The packed schedule of packed loans, see app.packing. Only loaded when asked for.
+    schedule_blob = deferred(Column(LargeBinary))
+    # Bumped whenever the schedule or the loan months of the loan change, the ETags of its routes derive from it
+    version = Column(Integer, nullable=False, default=1, server_default="1")
     users: Mapped[List[User]] = relationship(
         secondary=association_table, back_populates="loans"
     )
@@ -44,8 +105,16 @@ class LoanMonth(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     month = Column(Integer)
-    principal_amount = Column(Numeric(scale=2))
-    interest_amount = Column(Numeric(scale=2))
+    principal_cents = Column(BigInteger)
+    interest_cents = Column(BigInteger)
+    cumulative_principal_cents = Column(BigInteger)
+    cumulative_interest_cents = Column(BigInteger)
+    remaining_balance_cents = Column(BigInteger)
+    principal_amount = money_attribute("principal_cents")
+    interest_amount = money_attribute("interest_cents")
+    cumulative_principal = money_attribute("cumulative_principal_cents")
+    cumulative_interest = money_attribute("cumulative_interest_cents")
+    remaining_balance = money_attribute("remaining_balance_cents")
     loan_id = Column(Integer, ForeignKey("loans.id"))
     loan = relationship("Loan", back_populates="loan_months")
     __table_args__ = (UniqueConstraint('loan_id', 'month', name='_loan_month_uc'),
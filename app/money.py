@@ -0,0 +1,36 @@
+"""
+Money is stored and computed in whole cents, as integers, and only turned into two place Decimals where
+amounts leave the application. The conversions never go through the decimal context, so they are exact
+whatever its precision.
+"""
+from decimal import Decimal
+
+from sqlalchemy import BigInteger
+from sqlalchemy.types import TypeDecorator
+
+
+def to_cents(amount):
+    """
+    Converts an amount of money, a float or a Decimal, to whole cents. None stays None.
+    """
+    return None if amount is None else round(float(amount) * 100)
+
+def from_cents(cents):
+    """
+    Converts whole cents to a two place Decimal. None stays None.
+    """
+    return None if cents is None else Decimal(f"{cents}e-2")
+
+class Money(TypeDecorator):
+    """
+    Reads and writes a cents column as Decimal amounts, for the money attributes of the models to be used
+    in queries with the same values they have on instances
+    """
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return to_cents(value)
+
+    def process_result_value(self, value, dialect):
+        return from_cents(value)
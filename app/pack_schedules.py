@@ -0,0 +1,21 @@
+"""
+Converts the loans of a database storing their schedules as loan month rows to packed schedules, see
+GREYSTONE_SCHEDULE_STORAGE. Set the storage to "packed" as well for new loans to be packed.
+
+Usage: python -m app.pack_schedules
+"""
+from app.database import SessionLocal
+from app.logic.loan import pack_loan_schedules
+from app.migrations import upgrade
+
+
+def main():
+    upgrade()
+    db = SessionLocal()
+    try:
+        print(f"Packed the schedules of {pack_loan_schedules(db)} loans")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+The packed schedule format: the principal and interest cents of every month of a loan in a single blob,
+stored on the loan itself instead of as a loan month row per month.
+
+The blob is an 8 byte header, the magic bytes, the format version and the number of months, followed by
+the principal cents of every month and then their interest cents, all little endian int64. The header keeps
+the arrays 8 byte aligned, so they are read straight out of the blob without copying it.
+"""
+import struct
+
+import numpy as np
+
+SCHEDULE_MAGIC = b"GS"
+SCHEDULE_VERSION = 1
+SCHEDULE_HEADER = struct.Struct("<2sHI")
+CENTS_DTYPE = np.dtype("<i8")
+
+
+def pack_schedule(principal_cents, interest_cents) -> bytes:
+    """
+    Packs the principal and interest cents of the months of a loan into a schedule blob
+    """
+    cents = np.array([principal_cents, interest_cents], dtype=CENTS_DTYPE)
+    return SCHEDULE_HEADER.pack(SCHEDULE_MAGIC, SCHEDULE_VERSION, cents.shape[1]) + cents.tobytes()
+
+def unpack_schedule(blob):
+    """
+    Reads the principal and interest cents back out of a schedule blob, as two read-only int64 arrays
+    viewing the blob. Accepts bytes or any other buffer, e.g. the memoryview some database drivers return.
+    """
+    magic, version, months = SCHEDULE_HEADER.unpack_from(blob)
+    if magic != SCHEDULE_MAGIC or version != SCHEDULE_VERSION:
+        raise ValueError(f"Not a version {SCHEDULE_VERSION} schedule blob")
+    cents = np.frombuffer(blob, dtype=CENTS_DTYPE, count=2 * months, offset=SCHEDULE_HEADER.size)
+    return cents[:months], cents[months:]
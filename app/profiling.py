@@ -0,0 +1,201 @@
+"""
+Per request timings, split into the time spent executing SQL, running the endpoint and validating and serializing
+around it. The timings of every request are reported in its Server-Timing header and in /metrics. When
+profiling is configured, requests slower than the threshold have their cProfile profile saved to disk.
+"""
+import asyncio
+import cProfile
+import functools
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+
+from app.config import settings
+from app.metrics import REGISTRY
+
+REQUEST_PHASE_SECONDS = REGISTRY.histogram(
+    "greystone_request_phase_seconds", "Time requests spent in each phase", ("route", "phase"))
+REQUEST_SQL_STATEMENTS = REGISTRY.histogram(
+    "greystone_request_sql_statements", "SQL statements executed per request", ("route",),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+SAVED_PROFILES = REGISTRY.counter(
+    "greystone_slow_request_profiles_total", "Profiles saved of requests slower than the profiling threshold")
+
+_current = ContextVar("request_timings", default=None)
+# cProfile profiles a whole thread, so only one request is profiled at a time
+_profiling = threading.Lock()
+
+
+class RequestTimings:
+    """
+    The timings of a request. Endpoint and serialization times exclude the SQL executed during them.
+    """
+
+    def __init__(self):
+        self.route = None
+        self.sql_seconds = 0.0
+        self.sql_statements = 0
+        self.endpoint_seconds = 0.0
+        self.handler_seconds = 0.0
+        self.total_seconds = 0.0
+        self.profile = None
+
+    @property
+    def serialize_seconds(self):
+        return max(self.handler_seconds - self.endpoint_seconds, 0.0)
+
+    def phases(self):
+        return {"sql": self.sql_seconds, "endpoint": self.endpoint_seconds, "serialize": self.serialize_seconds,
+                "total": self.total_seconds}
+
+    def server_timing(self):
+        return (f'sql;dur={self.sql_seconds * 1000:.3f};desc="{self.sql_statements} statements", '
+                f'endpoint;dur={self.endpoint_seconds * 1000:.3f}, '
+                f'serialize;dur={self.serialize_seconds * 1000:.3f}, '
+                f'total;dur={self.total_seconds * 1000:.3f}')
+
+    def observe(self):
+        route = self.route or "unmatched"
+        for phase, seconds in self.phases().items():
+            REQUEST_PHASE_SECONDS.observe(seconds, route=route, phase=phase)
+        REQUEST_SQL_STATEMENTS.observe(self.sql_statements, route=route)
+
+def current_timings() -> RequestTimings | None:
+    """
+    The timings of the request being handled, if any
+    """
+    return _current.get()
+
+@contextmanager
+def _phase(attribute: str, profile: bool = False):
+    """
+    Adds the time spent in the block, less the SQL executed in it, to the `attribute` of the current timings.
+    With `profile`, the block runs under cProfile when slow requests are profiled and no other request is.
+    """
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    if profile and settings.profile_slow_requests is not None and _profiling.acquire(blocking=False):
+        timings.profile = cProfile.Profile()
+        timings.profile.enable()
+    start, sql_seconds = time.perf_counter(), timings.sql_seconds
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start - (timings.sql_seconds - sql_seconds)
+        setattr(timings, attribute, getattr(timings, attribute) + elapsed)
+        if profile and timings.profile is not None:
+            timings.profile.disable()
+            _profiling.release()
+
+def timed_endpoint(endpoint):
+    """
+    Wraps a route endpoint so its time is recorded in the current timings. Sync endpoints stay sync, so
+    they still run in the threadpool and are profiled on their worker thread.
+    """
+    if getattr(endpoint, "__timed__", False):
+        return endpoint
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            with _phase("endpoint_seconds", profile=True):
+                return await endpoint(*args, **kwargs)
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            with _phase("endpoint_seconds", profile=True):
+                return endpoint(*args, **kwargs)
+    wrapper.__timed__ = True
+    return wrapper
+
+class TimedRoute(APIRoute):
+    """
+    Route recording the time spent in its endpoint and, around it, in validating the request and
+    serializing the response
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, timed_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = self.path_format
+
+        async def timed_handler(request):
+            timings = _current.get()
+            if timings is not None:
+                timings.route = route
+            with _phase("handler_seconds"):
+                return await handler(request)
+        return timed_handler
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware collecting the timings of every HTTP request, adding them to the response as a
+    Server-Timing header and to the request phase metrics
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+
+        async def send_with_timings(message):
+            if message["type"] == "http.response.start":
+                timings.total_seconds = time.perf_counter() - start
+                MutableHeaders(scope=message).append("Server-Timing", timings.server_timing())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            _current.reset(token)
+            timings.total_seconds = time.perf_counter() - start
+            timings.observe()
+            if timings.profile is not None and timings.total_seconds >= settings.profile_slow_requests:
+                save_profile(timings, scope)
+
+def save_profile(timings: RequestTimings, scope):
+    """
+    Dumps the profile of a slow request to the profile directory, named after the time, method and path
+    of the request. The dumps can be read with pstats or snakeviz.
+    """
+    os.makedirs(settings.profile_dir, exist_ok=True)
+    path = re.sub(r"[^A-Za-z0-9]+", "_", scope["path"]).strip("_") or "root"
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{scope['method']}-{path}-{timings.total_seconds * 1000:.0f}ms.prof"
+    timings.profile.dump_stats(os.path.join(settings.profile_dir, name))
+    SAVED_PROFILES.inc()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("greystone_query_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = _current.get()
+    starts = conn.info.get("greystone_query_start")
+    if timings is not None and starts:
+        timings.sql_seconds += time.perf_counter() - starts.pop()
+        timings.sql_statements += 1
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    starts = context.connection.info.get("greystone_query_start") if context.connection is not None else None
+    if starts:
+        starts.pop()
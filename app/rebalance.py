@@ -0,0 +1,26 @@
+"""
+Moves every loan to the shard its id hashes to, see GREYSTONE_SHARDS. Run it once a shard was added to the
+configuration, then again after every process of the application got the new configuration, for the loans
+they created in between. Processes only find the moved loans once they have the new configuration, so
+rebalance while the application is quiet. To remove a shard, drain it while no loans are being created,
+then remove it from the configuration.
+
+Usage: python -m app.rebalance [--drain shard ...]
+"""
+import argparse
+
+from app.logic.shards import rebalance_loans
+from app.migrations import upgrade
+from app.sharding import get_shard_engine, shard_names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drain", nargs="+", default=[], help="shards to move all loans off")
+    args = parser.parse_args()
+    for shard in shard_names():
+        upgrade(get_shard_engine(shard))
+    print(f"Moved {rebalance_loans(drain=args.drain)} loans to their shards")
+
+if __name__ == "__main__":
+    main()
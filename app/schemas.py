@@ -1,6 +1,7 @@
 from __future__ import annotations
-from pydantic import BaseModel
-from typing import Optional
+from datetime import datetime
+from pydantic import BaseModel, validator
+from typing import Any, Optional
 from pydantic.fields import Field
 
 
@@ -18,8 +19,13 @@ class User(UserBase):
     class Config:
         orm_mode = True
 
-class LoanMonth(BaseModel):
+class LoanUser(UserBase):
     id: int
+    class Config:
+        orm_mode = True
+
+class LoanMonth(BaseModel):
+    id: int | None = Field(description="None for the months of lazily stored and packed loans, which are not stored")
     month: int
     principal_amount: float
     interest_amount: float
@@ -35,18 +41,36 @@ class LoanBase(BaseModel):
 class LoanCreate(LoanBase):
     pass
 
+class LoanBulkCreate(LoanCreate):
+    email: str
+
+class LoanBulkResult(BaseModel):
+    email: str
+    loan_id: int | None = None
+    error: str | None = None
+
+class LoanShare(BaseModel):
+    loan_id: int
+    email: str
+
+class LoanShareResult(LoanShare):
+    shared: bool = Field(False, description="False when the user already held the loan or the share failed")
+    error: str | None = None
+
 class Loan(LoanBase):
     id: int
     loan_months: list[LoanMonth] = []
-    users: list[User] = []
+    users: list[LoanUser] = []
     class Config:
         orm_mode = True
 
-class UserLoan(LoanBase):
+class LoanHeader(LoanBase):
     id: int
-    loan_months: list[LoanMonth] = []
     class Config:
         orm_mode = True
+
+class UserLoan(LoanHeader):
+    loan_months: list[LoanMonth] = []
         
 class ScheduleItem(BaseModel):
     month: int = Field(gt=0, description="The month must be greater than zero")
@@ -58,4 +82,64 @@ class MonthSummary(BaseModel):
     principal_paid: float = Field(ge=0, description="The principal paid cannot be negative")
     interest_paid: float = Field(ge=0, description="The interest remaining cannot be negative")
 
-User.update_forward_refs()
\ No newline at end of file
+class PortfolioLoan(BaseModel):
+    loan_id: int
+    principal_balance: float
+    principal_paid: float
+    interest_paid: float
+    next_payment: float | None = Field(description="None once the loan is paid off")
+
+class Portfolio(BaseModel):
+    month: int
+    principal_balance: float
+    principal_paid: float
+    interest_paid: float
+    next_payment: float
+    loans: list[PortfolioLoan]
+
+class LumpSum(BaseModel):
+    month: int = Field(gt=0, description="The month must be greater than zero")
+    amount: float = Field(gt=0, description="The prepayment must be greater than zero")
+
+class RateReset(BaseModel):
+    month: int = Field(gt=0, description="The month must be greater than zero")
+    interest_rate: float = Field(ge=0, description="The interest rate must not be less than zero")
+
+class SimulationRequest(BaseModel):
+    extra_principal: list[float] = Field([0], description="Extra principal paid every month, per scenario")
+    lump_sums: list[list[LumpSum]] = Field([[]], description="One-off prepayments, per scenario")
+    rate_resets: list[list[RateReset]] = Field([[]], description="Interest rate changes, per scenario")
+
+    @validator("extra_principal", "lump_sums", "rate_resets")
+    def not_empty(cls, value):
+        if not value:
+            raise ValueError("Every scenario axis needs at least one entry")
+        return value
+
+    @property
+    def scenario_count(self):
+        return len(self.extra_principal) * len(self.lump_sums) * len(self.rate_resets)
+
+class ScenarioResult(BaseModel):
+    extra_principal: float
+    lump_sums_index: int = Field(description="The position of the scenario's lump sums in the request")
+    rate_resets_index: int = Field(description="The position of the scenario's rate resets in the request")
+    total_interest: float
+    payoff_month: int
+
+class SimulationResult(BaseModel):
+    loan_id: int
+    scenarios: list[ScenarioResult]
+
+class Job(BaseModel):
+    id: str
+    kind: str
+    status: str = Field(description="queued, running, succeeded or failed")
+    result: Any = Field(None, description="What the job created, once it succeeded")
+    error: str | None = None
+    created_at: datetime
+    updated_at: datetime
+    class Config:
+        orm_mode = True
+
+User.update_forward_refs()
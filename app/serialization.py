@@ -0,0 +1,47 @@
+"""
+Fast path for serializing the responses of routes returning data the server computed itself, such as loan
+schedules and month summaries. That data is known to be valid, so rather than validating every row against the
+response model and encoding it with the standard library, its values are only cast to the model's field types and
+encoded with orjson. The output is byte for byte what the validating path produces for every money amount below
+1e16, i.e. any realistic one: from 1e16 up, and below 1e-4, orjson writes floats as e.g. 1e16 where the standard
+library writes 1e+16, the same number in other bytes.
+"""
+from decimal import Decimal
+from functools import lru_cache
+
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_default)
+
+def fast_response(model: type[BaseModel], content, status_code: int = 200):
+    """
+    Renders a dict, or a list of dicts, shaped like `model` without validating it. Only the fields of the model
+    are kept, in the model's field order, each cast to its field type like validation would.
+    """
+    casts = _field_casts(model)
+    if isinstance(content, list):
+        content = [{name: cast(row[name]) for name, cast in casts} for row in content]
+    else:
+        content = {name: cast(content[name]) for name, cast in casts}
+    return FastJSONResponse(content, status_code=status_code)
+
+@lru_cache(maxsize=None)
+def _field_casts(model: type[BaseModel]):
+    casts = []
+    for name, field in model.__fields__.items():
+        # Constrained fields, e.g. Field(gt=0), have a subclass of their type
+        cast = next((cast for cast in (int, float, str) if isinstance(field.outer_type_, type) and issubclass(field.outer_type_, cast)), None)
+        if cast is None or field.allow_none:
+            raise TypeError(f"{model.__name__}.{name} is not a required scalar field, it cannot be fast serialized")
+        casts.append((name, cast))
+    return tuple(casts)
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError
@@ -0,0 +1,165 @@
+"""
+Horizontal sharding of the loans over several databases, each with a write lock of its own.
+
+The database at the database URL is the "main" shard, GREYSTONE_SHARDS adds further ones. Every loan, along
+with its loan months and its user_loans rows, lives on the shard its id hashes to, so the routes of a single
+loan open their session on that shard alone. Users are replicated to every shard, keeping the ids they
+were given by the main shard, so the loan logic runs on any shard as it does on a single database.
+
+Loan ids are unique across the shards: they are handed out from blocks each process reserves in the main
+shard's id_blocks table, the one write every shard's loans still share, once per block.
+"""
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from fastapi import Request
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.config import settings
+from app.database import create_db_engine, get_engine
+from app.metrics import REGISTRY
+from app.models import Loan, id_blocks
+
+MAIN_SHARD = "main"
+
+SHARD_FAN_OUTS = REGISTRY.counter(
+    "greystone_shard_fan_outs_total", "Reads and writes spread over every shard at once")
+ID_BLOCKS_RESERVED = REGISTRY.counter(
+    "greystone_shard_id_blocks_reserved_total", "Blocks of loan ids reserved from the main shard")
+
+
+def sharding_enabled() -> bool:
+    return bool(settings.shards)
+
+def shard_names() -> list[str]:
+    """
+    The names of all shards, the main shard first
+    """
+    return [MAIN_SHARD, *settings.shards]
+
+@lru_cache(maxsize=None)
+def get_shard_engine(shard: str) -> Engine:
+    """
+    The engine of a shard, created on first use. The main shard's is the engine of the configured database.
+    """
+    if shard == MAIN_SHARD:
+        return get_engine()
+    return create_db_engine(settings.shards[shard])
+
+@lru_cache(maxsize=None)
+def _get_shard_sessionmaker(shard: str):
+    return sessionmaker(autocommit=False, autoflush=False, bind=get_shard_engine(shard), info={"shard": shard})
+
+def ShardSession(shard: str) -> Session:
+    """
+    Opens a session on a shard
+    """
+    return _get_shard_sessionmaker(shard)()
+
+def route_session(db: Session, shard: str):
+    """
+    Binds a session that has not been used yet to a shard
+    """
+    if db.in_transaction():
+        raise RuntimeError("Sessions can only be routed to a shard before they are used")
+    db.bind = get_shard_engine(shard)
+    db.info["shard"] = shard
+
+def shard_for_loan(loan_id: int, shards: list[str] | None = None) -> str:
+    """
+    The shard of a loan, by rendezvous hashing: of all shards, the one whose hash with the loan id is the
+    highest. The placement of a loan only depends on its id and the shard names, and adding a shard only
+    moves the loans it now wins, about one in N, off the other shards.
+    """
+    return max(shards or shard_names(), key=lambda shard: _shard_score(shard, loan_id))
+
+def _shard_score(shard: str, loan_id: int) -> int:
+    return int.from_bytes(hashlib.blake2b(f"{shard}:{loan_id}".encode(), digest_size=8).digest(), "little")
+
+def request_shard(request: Request) -> str:
+    """
+    The shard a request's session is opened on: that of the loan for the routes of a single loan,
+    the main shard otherwise
+    """
+    loan_id = request.path_params.get("id")
+    try:
+        return shard_for_loan(int(loan_id))
+    except (TypeError, ValueError):
+        return MAIN_SHARD
+
+@lru_cache(maxsize=None)
+def _get_executor():
+    return ThreadPoolExecutor(thread_name_prefix="greystone-shard")
+
+def fan_out(function, shards: list[str] | None = None) -> dict:
+    """
+    Calls `function` with a session of its own on every shard, all shards at once. Returns what it returned
+    by shard name, or raises the error of the first shard it failed on.
+    """
+    SHARD_FAN_OUTS.inc()
+    executor = _get_executor()
+    futures = {shard: executor.submit(_call_on_shard, function, shard) for shard in shards or shard_names()}
+    return {shard: future.result() for shard, future in futures.items()}
+
+def _call_on_shard(function, shard: str):
+    db = ShardSession(shard)
+    try:
+        return function(db)
+    finally:
+        db.close()
+
+class IdAllocator:
+    """
+    Hands out loan ids unique across the shards, from blocks of `block_size` ids reserved from the main shard.
+    Ids left in a block when the process exits are never used.
+    """
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self._next = self._end = 0
+        self._lock = threading.Lock()
+
+    def allocate(self, count: int = 1) -> list[int]:
+        with self._lock:
+            if self._end - self._next < count:
+                size = max(self.block_size, count)
+                self._next = reserve_loan_ids(size)
+                self._end = self._next + size
+            ids = list(range(self._next, self._next + count))
+            self._next += count
+            return ids
+
+@lru_cache(maxsize=None)
+def get_id_allocator() -> IdAllocator:
+    return IdAllocator(settings.shard_id_block_size)
+
+def allocate_loan_ids(count: int = 1) -> list[int]:
+    return get_id_allocator().allocate(count)
+
+def reserve_loan_ids(count: int) -> int:
+    """
+    Reserves the next `count` loan ids in the main shard's id_blocks table, returning the first of them.
+    The first reservation starts after the highest loan id on any shard, so loans created before the
+    database was sharded keep their ids.
+    """
+    main = get_shard_engine(MAIN_SHARD)
+    while True:
+        with main.begin() as connection:
+            end = connection.scalar(update(id_blocks).where(id_blocks.c.name == "loans")
+                                    .values(next_id=id_blocks.c.next_id + count).returning(id_blocks.c.next_id))
+        if end is not None:
+            ID_BLOCKS_RESERVED.inc()
+            return end - count
+        start = max(fan_out(lambda db: db.scalar(select(func.max(Loan.id))) or 0).values()) + 1
+        try:
+            with main.begin() as connection:
+                connection.execute(insert(id_blocks).values(name="loans", next_id=start + count))
+        except IntegrityError:
+            # Another process reserved the first block meanwhile
+            continue
+        ID_BLOCKS_RESERVED.inc()
+        return start
@@ -0,0 +1,108 @@
+import fnmatch
+import os
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.database import Base, create_db_engine
+from app.logic.cache import get_loan_cache
+from app.migrations import upgrade
+
+
+@pytest.fixture(autouse=True)
+def clear_loan_cache():
+    # Every test module works on its own database, where the same loan ids refer to other loans
+    get_loan_cache().clear()
+    yield
+
+class FakeRedis:
+    """
+    Stand-in for a redis-py client, implementing the hash commands the redis cache backend uses and the
+    string and list commands the redis job backend uses
+    """
+
+    def __init__(self):
+        self.hashes = {}
+        self.values = {}
+        self.lists = {}
+        self.expiries = {}
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = value
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value.encode()
+        self.expiries[key] = ex
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def expire(self, key, seconds):
+        self.expiries[key] = seconds
+
+    def delete(self, *keys):
+        for key in keys:
+            for store in (self.hashes, self.values, self.lists, self.expiries):
+                store.pop(key, None)
+
+    def scan_iter(self, match):
+        return [key for key in (*self.hashes, *self.values, *self.lists) if fnmatch.fnmatch(key, match)]
+
+    def lpush(self, key, value):
+        self.lists.setdefault(key, []).insert(0, value.encode())
+
+    def rpop(self, key):
+        items = self.lists.get(key)
+        return items.pop() if items else None
+
+    def brpop(self, key, timeout):
+        item = self.rpop(key)
+        return None if item is None else (key.encode(), item)
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+@contextmanager
+def count_statements(db: Session):
+    """
+    Collects the SQL statements the session `db` executes in the block
+    """
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.get_bind(), "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.get_bind(), "before_cursor_execute", before_cursor_execute)
+
+def remove_database(path: str):
+    for file in (path, f"{path}-wal", f"{path}-shm"):
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+
+def engine_fixture(path: str, schema: str | None = "create_all", scope: str = "module", autouse: bool = False):
+    """
+    Makes a fixture yielding an engine on a fresh SQLite database at `path`, whose tables are created by
+    create_all, by the migrations with `schema` "migrate", or not at all with None. The database files are
+    removed before and after.
+    """
+    @pytest.fixture(scope=scope, autouse=autouse)
+    def engine():
+        remove_database(path)
+        engine = create_db_engine(f"sqlite:///./{path}")
+        if schema == "create_all":
+            Base.metadata.create_all(bind=engine)
+        elif schema == "migrate":
+            upgrade(engine)
+        yield engine
+        engine.dispose()
+        remove_database(path)
+    return engine
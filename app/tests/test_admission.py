@@ -0,0 +1,186 @@
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+from app import database
+from app.admission import ADMISSION_QUEUED, ADMISSION_SHED, AdmissionMiddleware, ConcurrencyLimiter, RateLimiter, Shed
+from app.config import settings
+from app.main import app
+from app.migrations import upgrade
+
+
+@pytest.fixture
+def admission(monkeypatch):
+    monkeypatch.setattr(settings, "admission_control", True)
+    monkeypatch.setattr(settings, "admission_read_limit", 1)
+    monkeypatch.setattr(settings, "admission_write_limit", 1)
+    monkeypatch.setattr(settings, "admission_health_limit", 1)
+    monkeypatch.setattr(settings, "admission_queue_size", 1)
+    monkeypatch.setattr(settings, "admission_queue_timeout", 5)
+    return monkeypatch
+
+class GatedApp:
+    """
+    ASGI app answering every request once its gate opens
+    """
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.started = 0
+
+    async def __call__(self, scope, receive, send):
+        self.started += 1
+        await self.gate.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+def run(test):
+    async def main():
+        inner = GatedApp()
+        async with httpx.AsyncClient(app=AdmissionMiddleware(inner), base_url="http://test") as client:
+            return await test(client, inner)
+    return asyncio.run(main())
+
+async def until(condition):
+    while not condition():
+        await asyncio.sleep(0)
+
+def test_queue_full_is_shed(admission):
+    async def test(client, inner):
+        shed = ADMISSION_SHED.value(route_class="read", reason="queue_full")
+        queued = ADMISSION_QUEUED.value(route_class="read")
+        running = asyncio.create_task(client.get("/loans/1/schedule/"))
+        await until(lambda: inner.started == 1)
+        waiting = asyncio.create_task(client.get("/loans/2/schedule/"))
+        await asyncio.sleep(0.01)
+
+        response = await client.get("/loans/3/schedule/")
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "1"
+        assert response.json() == {"detail": "Server busy"}
+        assert ADMISSION_SHED.value(route_class="read", reason="queue_full") == shed + 1
+
+        # Other route classes have slots of their own
+        health = asyncio.create_task(client.get("/health_check"))
+        write = asyncio.create_task(client.post("/users/"))
+        await until(lambda: inner.started == 3)
+
+        inner.gate.set()
+        assert [r.status_code for r in await asyncio.gather(running, waiting, health, write)] == [200] * 4
+        assert inner.started == 4
+        assert ADMISSION_QUEUED.value(route_class="read") == queued + 1
+    run(test)
+
+def test_queue_timeout_is_shed(admission):
+    admission.setattr(settings, "admission_queue_timeout", 0.01)
+    admission.setattr(settings, "admission_retry_after", 3)
+    async def test(client, inner):
+        shed = ADMISSION_SHED.value(route_class="write", reason="queue_timeout")
+        running = asyncio.create_task(client.post("/loans/bulk"))
+        await until(lambda: inner.started == 1)
+        response = await client.post("/loans/bulk")
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "3"
+        assert ADMISSION_SHED.value(route_class="write", reason="queue_timeout") == shed + 1
+        inner.gate.set()
+        assert (await running).status_code == 200
+    run(test)
+
+def test_rate_limit(admission):
+    admission.setattr(settings, "rate_limit", 0.5)
+    admission.setattr(settings, "rate_limit_burst", 2)
+    async def test(client, inner):
+        inner.gate.set()
+        shed = ADMISSION_SHED.value(route_class="read", reason="rate_limited")
+        headers = {"X-Client-Id": "a"}
+        assert [(await client.get("/users/a/loans/", headers=headers)).status_code for _ in range(2)] == [200, 200]
+        response = await client.get("/users/a/loans/", headers=headers)
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "2"
+        assert response.json() == {"detail": "Too many requests"}
+        assert ADMISSION_SHED.value(route_class="read", reason="rate_limited") == shed + 1
+
+        # Other clients and health checks are not limited
+        assert (await client.get("/users/b/loans/", headers={"X-Client-Id": "b"})).status_code == 200
+        assert (await client.get("/health_check", headers=headers)).status_code == 200
+    run(test)
+
+def test_concurrency_limiter_hands_over_slots():
+    async def main():
+        limiter = ConcurrencyLimiter(limit=1, queue_size=2)
+        assert await limiter.acquire(1) is False
+        first = asyncio.create_task(limiter.acquire(1))
+        second = asyncio.create_task(limiter.acquire(1))
+        await until(lambda: limiter.waiting == 2)
+        with pytest.raises(Shed):
+            await limiter.acquire(1)
+        first.cancel()
+        await asyncio.sleep(0)
+        limiter.release()
+        assert await second is True
+        assert limiter.active == 1 and limiter.waiting == 0
+        limiter.release()
+        assert limiter.active == 0
+    asyncio.run(main())
+
+def test_rate_limiter_forgets_clients():
+    limiter = RateLimiter(rate=1, burst=1, max_clients=2)
+    limiter.check("a")
+    limiter.check("b")
+    limiter.check("c")
+    # a was forgotten, so it has a full bucket again while c has none
+    limiter.check("a")
+    with pytest.raises(Shed):
+        limiter.check("c")
+
+def test_admission_middleware_in_app(monkeypatch, mocker):
+    mocker.patch("app.main.ping_db", return_value=True)
+    monkeypatch.setattr(settings, "admission_control", True)
+    client = TestClient(app)
+    assert client.get("/health_check").status_code == 200
+    # The metrics request itself is a running health request
+    assert 'greystone_admission_requests{route_class="health",state="running"} 1' in client.get("/metrics").text
+
+def test_health_check_answers_under_read_saturation(tmp_path, monkeypatch, mocker):
+    monkeypatch.setattr(settings, "database_url", f"sqlite:///{tmp_path / 'admission.db'}")
+    monkeypatch.setattr(settings, "admission_control", True)
+    monkeypatch.setattr(settings, "pool_timeout", 2)
+    database.get_engine.cache_clear()
+    database._get_sessionmaker.cache_clear()
+    upgrade()
+    release = threading.Event()
+    holding = []
+    def hold_connection(db, loan_id):
+        # Every admitted read holds a worker thread and a pooled connection until released
+        db.execute(text("SELECT 1"))
+        holding.append(loan_id)
+        release.wait(10)
+        return None
+    mocker.patch("app.main.get_loan_version", side_effect=hold_connection)
+
+    async def test():
+        async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+            reads = [asyncio.create_task(client.get(f"/loans/{id}/schedule/")) for id in range(settings.admission_read_limit + 4)]
+            deadline = time.perf_counter() + 2
+            while len(holding) < settings.admission_read_limit and time.perf_counter() < deadline:
+                await asyncio.sleep(0.01)
+            started = time.perf_counter()
+            health = await client.get("/health_check")
+            elapsed = time.perf_counter() - started
+            release.set()
+            await asyncio.gather(*reads)
+            return health, elapsed
+    try:
+        health, elapsed = asyncio.run(test())
+    finally:
+        release.set()
+        database.get_engine().dispose()
+        database.get_engine.cache_clear()
+        database._get_sessionmaker.cache_clear()
+    assert health.status_code == 200
+    assert elapsed < 1
+    assert len(holding) == settings.admission_read_limit + 4
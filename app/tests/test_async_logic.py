@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from ..database import create_async_db_engine, get_async_url
+from app.logic import async_loan, async_user
+from app.logic.ping_db import async_ping_db
+from app.models import User
+from app.schemas import UserCreate, LoanCreate, Loan, UserLoan
+from decimal import Decimal
+from app.tests.conftest import engine_fixture
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test_async.db"
+# The tables are created once, every test opens its own async engine on them
+engine = engine_fixture("test_async.db", autouse=True)
+
+def run(test):
+    """
+    Runs an async test body with a fresh async session, disposing of the engine on the same event loop
+    """
+    async def main():
+        engine = create_async_db_engine(get_async_url(SQLALCHEMY_DATABASE_URL))
+        try:
+            async with async_sessionmaker(engine, autoflush=False, expire_on_commit=False)() as db:
+                return await test(db)
+        finally:
+            await engine.dispose()
+    return asyncio.run(main())
+
+def test_async_ping_db():
+    assert run(lambda db: async_ping_db(db=db)) == True
+
+def test_async_user_create():
+    async def test(db):
+        user = await async_user.create_user(db=db, user=UserCreate(first_name="Grey", last_name="Stone", email="async@greystone.com"))
+        assert user.id > 0
+        assert (await async_user.get_user_by_email(db, email="async@greystone.com")).id == user.id
+        assert await async_user.get_user_by_email(db, email="missing@greystone.com") is None
+    run(test)
+
+def test_async_loan_create():
+    async def test(db):
+        user = await async_user.get_user_by_email(db, email="async@greystone.com")
+        loan = await async_loan.create_loan(db=db, loan=LoanCreate(amount=30000, term=48, interest_rate=3.0), user=user)
+        response = Loan.from_orm(loan)
+        assert len(response.loan_months) == 48
+        assert response.users[0].email == "async@greystone.com"
+
+        schedule = await async_loan.get_loan_schedule(db=db, loan_id=loan.id)
+        assert len(schedule) == 48
+        assert schedule[-1]["remaining_balance"] == 0
+        assert await async_loan.get_loan_schedule(db=db, loan_id=loan.id + 1) is None
+
+        month_summary = await async_loan.get_month_summary(db=db, loan_id=loan.id, month=48)
+        assert month_summary["principal_paid"] == Decimal('30000.00')
+        assert (await async_loan.get_month_summary(db=db, loan_id=loan.id, month=49))["principal_balance"] is None
+        assert await async_loan.get_month_summary(db=db, loan_id=loan.id + 1, month=1) is None
+        assert await async_loan.get_loan_version(db=db, loan_id=loan.id) == 1
+        assert await async_loan.get_loan_version(db=db, loan_id=loan.id + 1) is None
+    run(test)
+
+def test_async_share_loan():
+    async def test(db):
+        owner = await async_user.get_user_by_email(db, email="async@greystone.com")
+        loan = (await async_user.get_user_loans(db=db, user=owner))[0]
+        other = await async_user.create_user(db=db, user=UserCreate(first_name="Grey", last_name="Stone", email="async_2@greystone.com"))
+        await async_loan.share_loan(db=db, loan=await async_loan.get_loan(db=db, id=loan.id), user=other)
+
+        loans = await async_user.get_user_loans(db=db, user=other)
+        assert [UserLoan.from_orm(loan).id for loan in loans] == [loan.id]
+        assert len(loans[0].loan_months) == 48
+        db.expunge_all()
+        assert (await async_user.get_user_loans(db=db, user=other, include_months=False))[0].loan_months == []
+        assert (await async_user.get_user_by_email(db, email="async_2@greystone.com")).loans_version == 2
+        # Sharing again is a no-op
+        await async_loan.share_loan(db=db, loan=await async_loan.get_loan(db=db, id=loan.id), user=other)
+        db.expunge_all()
+        assert (await async_user.get_user_by_email(db, email="async_2@greystone.com")).loans_version == 2
+    run(test)
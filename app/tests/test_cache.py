@@ -0,0 +1,133 @@
+import time
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from app.logic.cache import CACHE_REQUESTS, InMemoryCache, NullCache, RedisCache, get_loan_cache
+from app.logic.loan import create_loan, get_loan_schedule, get_month_summary, materialize_loan_schedule
+from app.models import User
+from app.schemas import LoanCreate
+from app.config import settings
+from app.tests.conftest import FakeRedis, count_statements, engine_fixture
+
+engine = engine_fixture("test_cache.db")
+
+
+@pytest.fixture(scope="module")
+def db(engine):
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield db
+    db.close()
+
+@pytest.fixture(scope="module")
+def user(db):
+    user = User(email="cache@test.com", first_name="Test", last_name="McTest")
+    db.add(user)
+    db.commit()
+    return user
+
+def test_in_memory_cache_evicts_least_recently_used():
+    cache = InMemoryCache(max_bytes=1000, ttl=60)
+    cache.set(1, "schedule", "a" * 400)
+    cache.set(2, "schedule", "b" * 400)
+    cache.get(1, "schedule")
+    cache.set(3, "schedule", "c" * 400)
+    assert cache.get(2, "schedule") is None
+    assert cache.get(1, "schedule") == "a" * 400
+    assert cache.get(3, "schedule") == "c" * 400
+    assert cache.size <= 1000
+
+    cache.set(4, "schedule", "d" * 2000)
+    assert cache.get(4, "schedule") is None
+    assert len(cache) == 2
+
+def test_in_memory_cache_expires_entries(monkeypatch):
+    cache = InMemoryCache(max_bytes=1000, ttl=60)
+    cache.set(1, "schedule", [1, 2, 3])
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    assert cache.get(1, "schedule") is None
+    assert len(cache) == 0 and cache.size == 0
+
+def test_in_memory_cache_invalidates_loan():
+    cache = InMemoryCache(max_bytes=1000, ttl=60)
+    cache.set(1, "schedule", [1])
+    cache.set(1, "month:1", {"principal_balance": 1})
+    cache.set(2, "schedule", [2])
+    cache.invalidate(1)
+    assert cache.get(1, "schedule") is None
+    assert cache.get(1, "month:1") is None
+    assert cache.get(2, "schedule") == [2]
+
+def test_in_memory_cache_copies_values():
+    cache = InMemoryCache(max_bytes=1000, ttl=60)
+    schedule = [{"month": 1, "remaining_balance": 10}]
+    cache.set(1, "schedule", schedule)
+    schedule[0]["remaining_balance"] = 0
+    cache.get(1, "schedule")[0]["remaining_balance"] = 0
+    cache.get(1, "schedule").append({"month": 2})
+    assert cache.get(1, "schedule") == [{"month": 1, "remaining_balance": 10}]
+
+def test_redis_cache():
+    client = FakeRedis()
+    cache = RedisCache(client, ttl=60)
+    cache.set(1, "schedule", [{"month": 1}])
+    cache.set(1, "month:1", {"principal_balance": 1})
+    cache.set(2, "schedule", [{"month": 1}])
+    assert cache.get(1, "schedule") == [{"month": 1}]
+    assert client.expiries == {"greystone:loan:1": 60, "greystone:loan:2": 60}
+
+    cache.invalidate(1)
+    assert cache.get(1, "month:1") is None
+    assert cache.get(2, "schedule") == [{"month": 1}]
+    cache.clear()
+    assert client.hashes == {}
+
+def test_cache_counts_hits_and_misses():
+    cache = NullCache()
+    misses = CACHE_REQUESTS.value(kind="month", result="miss")
+    cache.get(1, "month:12")
+    assert CACHE_REQUESTS.value(kind="month", result="miss") == misses + 1
+
+def test_get_loan_schedule_reads_through_cache(db, user):
+    loan = create_loan(db, LoanCreate(amount=1000, interest_rate=5, term=12), user)
+    hits = CACHE_REQUESTS.value(kind="schedule", result="hit")
+    schedule = get_loan_schedule(db, loan.id)
+    db.expunge_all()
+
+    with count_statements(db) as statements:
+        assert get_loan_schedule(db, loan.id) == schedule
+    assert statements == []
+    assert CACHE_REQUESTS.value(kind="schedule", result="hit") == hits + 1
+
+def test_changing_cached_schedule(db, user):
+    loan = create_loan(db, LoanCreate(amount=1000, interest_rate=5, term=12), user)
+    schedule = get_loan_schedule(db, loan.id)
+    expected = [dict(item) for item in schedule]
+    schedule[0]["remaining_balance"] = 0
+    get_loan_schedule(db, loan.id).pop()
+    assert get_loan_schedule(db, loan.id) == expected
+
+def test_get_month_summary_reads_through_cache(db, user):
+    loan = create_loan(db, LoanCreate(amount=1000, interest_rate=5, term=12), user)
+    summary = get_month_summary(db, loan.id, 6)
+    assert get_loan_cache().get(loan.id, "month:6") == summary
+    assert get_month_summary(db, 0, 6) is None
+    assert get_loan_cache().get(0, "month:6") is None
+
+def test_writing_loan_months_invalidates_cache(db, user, monkeypatch):
+    monkeypatch.setattr(settings, "schedule_storage", "lazy")
+    loan = create_loan(db, LoanCreate(amount=1000, interest_rate=5, term=12), user)
+    schedule = get_loan_schedule(db, loan.id)
+    materialize_loan_schedule(db, loan)
+    assert get_loan_cache().get(loan.id, "schedule") is None
+    assert get_loan_schedule(db, loan.id) == schedule
+
+def test_configured_cache_backend(monkeypatch):
+    assert isinstance(get_loan_cache(), InMemoryCache)
+    monkeypatch.setattr(settings, "cache_backend", "none")
+    get_loan_cache.cache_clear()
+    try:
+        assert isinstance(get_loan_cache(), NullCache)
+    finally:
+        get_loan_cache.cache_clear()
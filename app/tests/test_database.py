@@ -0,0 +1,78 @@
+import pytest
+from sqlalchemy import exc, text
+
+from app.config import settings
+from app.database import POOL_CHECKOUT_SECONDS, POOL_CHECKOUT_TIMEOUTS, create_db_engine, get_async_url
+from app.metrics import REGISTRY, Registry
+from app.tests.conftest import engine_fixture
+
+engine = engine_fixture("test_database.db", schema=None, scope="function")
+
+
+def test_sqlite_pragmas(engine):
+    with engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert connection.execute(text("PRAGMA synchronous")).scalar() == 1 # NORMAL
+        assert connection.execute(text("PRAGMA busy_timeout")).scalar() == settings.sqlite_busy_timeout
+        assert connection.execute(text("PRAGMA cache_size")).scalar() == settings.sqlite_cache_size
+        assert connection.execute(text("PRAGMA mmap_size")).scalar() == settings.sqlite_mmap_size
+
+def test_pool_settings(engine, monkeypatch):
+    monkeypatch.setattr(settings, "pool_size", 2)
+    monkeypatch.setattr(settings, "max_overflow", 0)
+    monkeypatch.setattr(settings, "pool_timeout", 0.01)
+    # Another engine on the fixture's database, pooled with the settings above
+    engine = create_db_engine(engine.url)
+    assert engine.pool.size() == 2
+    assert engine.pool.logging_name == "./test_database.db"
+
+    checkouts = POOL_CHECKOUT_SECONDS.count(database="./test_database.db")
+    timeouts = POOL_CHECKOUT_TIMEOUTS.value(database="./test_database.db")
+    connections = [engine.connect(), engine.connect()]
+    with pytest.raises(exc.TimeoutError):
+        engine.connect()
+    for connection in connections:
+        connection.close()
+    engine.dispose()
+    assert POOL_CHECKOUT_SECONDS.count(database="./test_database.db") == checkouts + 3
+    assert POOL_CHECKOUT_TIMEOUTS.value(database="./test_database.db") == timeouts + 1
+
+def test_pool_metrics_rendered(engine):
+    with engine.connect():
+        rendered = REGISTRY.render()
+    assert '# TYPE greystone_db_pool_checkout_seconds histogram' in rendered
+    assert 'greystone_db_pool_checked_out{database="./test_database.db"} 1' in rendered
+    assert 'greystone_db_pool_checkout_seconds_bucket{database="./test_database.db",le="+Inf"}' in rendered
+
+def test_in_memory_engine():
+    engine = create_db_engine("sqlite://")
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT 1")).scalar() == 1
+
+def test_get_async_url():
+    assert get_async_url("sqlite:///./greystone_app.db").render_as_string() == "sqlite+aiosqlite:///./greystone_app.db"
+    assert get_async_url("postgresql://user:pw@host/db").drivername == "postgresql+asyncpg"
+    assert get_async_url("postgresql+psycopg2://user:pw@host/db").drivername == "postgresql+asyncpg"
+
+def test_registry_render():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests served", ("route",))
+    requests.inc(route="/a")
+    requests.inc(2, route='/"b"')
+    assert registry.counter("requests_total", "Requests served", ("route",)) is requests
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    latency.observe(0.05)
+    latency.observe(0.5)
+    assert registry.render().splitlines() == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 2',
+        'latency_seconds_bucket{le="+Inf"} 2',
+        "latency_seconds_sum 0.55",
+        "latency_seconds_count 2",
+        "# HELP requests_total Requests served",
+        "# TYPE requests_total counter",
+        'requests_total{route="/a"} 1',
+        'requests_total{route="/\\"b\\""} 2',
+    ]
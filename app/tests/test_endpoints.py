@@ -2,9 +2,20 @@ from fastapi.testclient import TestClient
 from app.main import app
 from app.models import User, Loan, LoanMonth
 import pytest
+from decimal import Decimal
+from app.config import settings
+from app.database import _get_sessionmaker, get_engine
+from app.logic.common import amortization_factors
+from app.migrations import upgrade
+from app.jobs import InMemoryJobBackend, JobQueue
 
 client  = TestClient(app)
 
+@pytest.fixture(scope="module", autouse=True)
+def database():
+    # The client is not used as a context manager, so the startup migration does not run
+    upgrade()
+
 @pytest.fixture(scope="module")
 def user():
     user = User(id=1,first_name="Grey", last_name="Stone", email="test@test.com")
@@ -41,6 +52,21 @@ def test_health_check_no_db(mocker):
     assert response.status_code == 400
     assert response.json() == {'detail': 'No Database Connection'}
     
+def test_metrics():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE greystone_db_pool_checkout_seconds histogram" in response.text
+    assert 'greystone_amortization_factor_cache{stat="maxsize"}' in response.text
+
+def test_startup_prewarms_amortization_factors(monkeypatch):
+    monkeypatch.setattr(settings, "migrate_on_startup", False)
+    monkeypatch.setattr(settings, "amortization_prewarm_terms", [360])
+    amortization_factors.cache_clear()
+    with TestClient(app):
+        pass
+    assert amortization_factors.cache_info().currsize == 97
+
 def test_create_new_user(mocker, user):
     mocker.patch("app.main.get_user_by_email", return_value=None)
     mocker.patch("app.main.create_user", return_value=user)
@@ -80,6 +106,117 @@ def test_create_new_loan_bad_data(mocker, user, loan):
     response = client.post("/loans/test@test.com", json={"term": 10, "interest_rate": 3.5, "amount": -20000})
     assert response.status_code == 422
 
+def test_create_loans_bulk(mocker):
+    results = [{"email": "test@test.com", "loan_id": 1, "error": None},
+               {"email": "missing@test.com", "loan_id": None, "error": "No user for loan found"}]
+    create_loans_bulk = mocker.patch("app.main.create_loans_bulk", return_value=results)
+    response = client.post("/loans/bulk", json=[{"term": 36, "interest_rate": 3.5, "amount": 20000, "email": "test@test.com"},
+                                                {"term": 48, "interest_rate": 2.5, "amount": 30000, "email": "missing@test.com"}])
+    assert response.status_code == 200
+    assert response.json() == results
+    assert [loan.email for loan in create_loans_bulk.call_args.kwargs["loans"]] == ["test@test.com", "missing@test.com"]
+    # Not the loans of a user with the email "bulk"
+    assert client.post("/loans/bulk/", json=[]).json() == results
+
+def test_create_loans_bulk_bad_data(mocker):
+    mocker.patch("app.main.create_loans_bulk", return_value=[])
+    response = client.post("/loans/bulk", json=[{"term": -1, "interest_rate": 3.5, "amount": 20000, "email": "test@test.com"}])
+    assert response.status_code == 422
+
+def test_create_new_loan_in_background(mocker, monkeypatch, user):
+    jobs = JobQueue(InMemoryJobBackend(ttl=60))
+    mocker.patch("app.main.get_job_queue", return_value=jobs)
+    mocker.patch("app.main.get_user_by_email", return_value=user)
+    create_loan = mocker.patch("app.main.create_loan")
+    monkeypatch.setattr(settings, "background_writes", True)
+    response = client.post("/loans/test@test.com", json={"term": 36, "interest_rate": 3.5, "amount": 20000})
+    assert response.status_code == 202
+    job = response.json()
+    assert job["kind"] == "create_loan" and job["status"] == "queued"
+    assert response.headers["location"] == f"/jobs/{job['id']}"
+    assert not create_loan.called
+    assert jobs.get(job["id"]).payload == {"email": "test@test.com", "loan": {"term": 36, "interest_rate": 3.5, "amount": 20000}}
+
+    response = client.post("/loans/bulk", json=[{"term": 36, "interest_rate": 3.5, "amount": 20000, "email": "test@test.com"}])
+    assert response.status_code == 202
+    assert response.json()["kind"] == "create_loans_bulk"
+    assert jobs.backend.pending() == 2
+
+    paths = app.openapi()["paths"]
+    for path in ("/loans/{email}/", "/loans/bulk"):
+        assert paths[path]["post"]["responses"]["202"]["content"]["application/json"]["schema"] == {"$ref": "#/components/schemas/Job"}
+
+def test_read_job(mocker):
+    jobs = JobQueue(InMemoryJobBackend(ttl=60))
+    mocker.patch("app.main.get_job_queue", return_value=jobs)
+    job = jobs.submit("create_loan", {"email": "test@test.com", "loan": {}})
+    response = client.get(f"/jobs/{job.id}")
+    assert response.status_code == 200
+    assert response.json()["status"] == "queued" and response.json()["result"] is None
+    response = client.get("/jobs/unknown")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Job not found"}
+
+def test_export_schedules(mocker, user):
+    mocker.patch("app.main.get_user_by_email", return_value=user)
+    export = mocker.patch("app.main.export_loan_schedules", return_value=iter(['{"loan_id": 1}\n', '{"loan_id": 2}\n']))
+    response = client.get("/loans/export/", params={"email": "test@test.com"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.text == '{"loan_id": 1}\n{"loan_id": 2}\n'
+    assert export.call_args.kwargs["format"] == "ndjson"
+
+    export.return_value = iter(["loan_id,month,remaining_balance,monthly_payment\r\n"])
+    response = client.get("/loans/export/", params={"loan_id": [1, 2], "format": "csv"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.headers["content-disposition"] == 'attachment; filename="schedules.csv"'
+    assert export.call_args.kwargs["loan_ids"] == [1, 2]
+
+def test_export_schedules_bad_request(mocker):
+    mocker.patch("app.main.get_user_by_email", return_value=None)
+    mocker.patch("app.main.export_loan_schedules", return_value=iter([]))
+    response = client.get("/loans/export/")
+    assert response.status_code == 400
+    response = client.get("/loans/export/", params={"email": "test@test.com", "loan_id": 1})
+    assert response.status_code == 400
+    response = client.get("/loans/export/", params={"email": "test@test.com"})
+    assert response.status_code == 404
+    assert response.json() == {"detail": "User not found"}
+
+def test_fetch_user_portfolio(mocker, user):
+    mocker.patch("app.main.get_user_by_email", return_value=user)
+    portfolio = {"month": 12, "principal_balance": 900, "principal_paid": 100, "interest_paid": 50, "next_payment": 20,
+                 "loans": [{"loan_id": 1, "principal_balance": 900, "principal_paid": 100, "interest_paid": 50,
+                            "next_payment": 20}]}
+    get_portfolio = mocker.patch("app.main.get_user_portfolio", return_value=portfolio)
+    response = client.get("/users/test@test.com/portfolio/", params={"month": 12})
+    assert response.status_code == 200
+    assert response.json() == portfolio
+    assert get_portfolio.call_args.kwargs["month"] == 12
+    assert client.get("/users/test@test.com/portfolio/").status_code == 422
+
+    mocker.patch("app.main.get_user_by_email", return_value=None)
+    response = client.get("/users/test@test.com/portfolio/", params={"month": 12})
+    assert response.status_code == 404
+
+def test_simulate_loan(mocker):
+    result = {"loan_id": 1, "scenarios": [{"extra_principal": 100, "lump_sums_index": 0, "rate_resets_index": 0,
+                                           "total_interest": 1234.56, "payoff_month": 300}]}
+    simulate = mocker.patch("app.main.simulate_loan", return_value=result)
+    response = client.post("/loans/1/simulate/", json={"extra_principal": [100], "lump_sums": [[{"month": 12, "amount": 5000}]]})
+    assert response.status_code == 200
+    assert response.json() == result
+    assert simulate.call_args.kwargs["simulation"].rate_resets == [[]]
+
+    response = client.post("/loans/1/simulate/", json={"extra_principal": list(range(1000)), "rate_resets": [[]] * 101})
+    assert response.status_code == 400
+    assert client.post("/loans/1/simulate/", json={"lump_sums": [[{"month": 0, "amount": 5000}]]}).status_code == 422
+    assert client.post("/loans/1/simulate/", json={"rate_resets": []}).status_code == 422
+
+    simulate.return_value = None
+    assert client.post("/loans/1/simulate/", json={}).status_code == 404
+
 def test_fetch_loan_schedule(mocker, loan_schedule):
     mocker.patch("app.main.get_loan_schedule", return_value=loan_schedule)
     response = client.get("/loans/1/schedule")
@@ -87,6 +224,50 @@ def test_fetch_loan_schedule(mocker, loan_schedule):
     assert response.json() == [{"month": 1, "remaining_balance": 300, "monthly_payment": 100},
                                {"month": 2, "remaining_balance": 200, "monthly_payment": 100}]
 
+def test_fetch_loan_schedule_window(mocker, loan_schedule):
+    get_schedule = mocker.patch("app.main.get_loan_schedule", return_value=loan_schedule[1:])
+    response = client.get("/loans/1/schedule", params={"from_month": 2, "to_month": 13})
+    assert response.status_code == 200
+    assert response.json() == [{"month": 2, "remaining_balance": 200, "monthly_payment": 100}]
+    assert get_schedule.call_args.kwargs == {"db": mocker.ANY, "loan_id": 1, "from_month": 2, "to_month": 13}
+    assert client.get("/loans/1/schedule", params={"from_month": 0}).status_code == 422
+
+def test_fetch_loan_schedule_fast_serialization(mocker, monkeypatch):
+    schedule = [{"month": 1, "remaining_balance": Decimal("19800.25"), "monthly_payment": Decimal("257.1")},
+                {"month": 2, "remaining_balance": Decimal("0.00"), "monthly_payment": 300}]
+    mocker.patch("app.main.get_loan_schedule", return_value=schedule)
+    mocker.patch("app.main.get_month_summary", return_value={"principal_balance": Decimal("1000.50"),
+                                                             "principal_paid": 900, "interest_paid": Decimal("0.01")})
+    validated = [client.get("/loans/1/schedule"), client.get("/loans/1/month/1/")]
+    monkeypatch.setattr(settings, "fast_serialization", True)
+    fast = [client.get("/loans/1/schedule"), client.get("/loans/1/month/1/")]
+    for validated_response, fast_response in zip(validated, fast):
+        assert fast_response.status_code == 200
+        assert fast_response.content == validated_response.content
+        assert fast_response.headers["content-type"] == validated_response.headers["content-type"]
+
+def test_fetch_loan_schedule_not_modified(mocker, monkeypatch, loan_schedule):
+    mocker.patch("app.main.get_loan_version", return_value=3)
+    get_schedule = mocker.patch("app.main.get_loan_schedule", return_value=loan_schedule)
+    response = client.get("/loans/1/schedule/")
+    assert response.status_code == 200
+    assert response.headers["etag"] == '"loan-1-3-schedule-1-"'
+    assert response.headers["cache-control"] == "public, max-age=60"
+
+    response = client.get("/loans/1/schedule/", headers={"If-None-Match": '"other", "loan-1-3-schedule-1-"'})
+    assert response.status_code == 304
+    assert response.headers["etag"] == '"loan-1-3-schedule-1-"'
+    assert get_schedule.call_count == 1
+
+    monkeypatch.setattr(settings, "fast_serialization", True)
+    response = client.get("/loans/1/schedule/", params={"from_month": 2}, headers={"If-None-Match": '"loan-1-3-schedule-1-"'})
+    assert response.status_code == 200
+    assert response.headers["etag"] == '"loan-1-3-schedule-2-"'
+
+    mocker.patch("app.main.get_loan_version", return_value=4)
+    response = client.get("/loans/1/schedule/", headers={"If-None-Match": '"loan-1-3-schedule-1-"'})
+    assert response.status_code == 200
+
 def test_fetch_loan_schedule_no_loan(mocker):
     mocker.patch("app.main.get_loan_schedule", return_value=None)
     response = client.get("/loans/1/schedule")
@@ -100,6 +281,14 @@ def test_fetch_month_summary(mocker):
     assert response.status_code == 200
     assert response.json() == month_summary
 
+def test_fetch_month_summary_not_modified(mocker):
+    mocker.patch("app.main.get_loan_version", return_value=1)
+    get_summary = mocker.patch("app.main.get_month_summary")
+    response = client.get("/loans/1/month/3/", headers={"If-None-Match": 'W/"loan-1-1-month-3"'})
+    assert response.status_code == 304
+    assert response.headers["cache-control"] == "public, max-age=60"
+    assert not get_summary.called
+
 def test_fetch_month_summary_no_loan(mocker):
     month_summary = None
     mocker.patch("app.main.get_month_summary", return_value=month_summary)
@@ -122,12 +311,64 @@ def test_user_loans(mocker, user, loan, loan_2):
     assert response.json() == [{"id": 1, "term": 36, "interest_rate": 3.5, "amount": 20000, "loan_months": [{'id': 1, 'interest_amount': 100.0, 'month': 1, 'principal_amount': 200.0}]},
                                {"id": 2, "term": 48, "interest_rate": 2.5, "amount": 30000, "loan_months": [{'id': 2, 'interest_amount': 200.0, 'month': 1, 'principal_amount': 300.0}]}]
 
+def test_user_loans_without_months(mocker, user, loan, loan_2):
+    mocker.patch("app.main.get_user_by_email", return_value=user)
+    get_user_loans = mocker.patch("app.main.get_user_loans", return_value=[loan, loan_2])
+    response = client.get("/users/test@test.com/loans/", params={"include_months": False})
+    assert response.status_code == 200
+    assert response.json() == [{"id": 1, "term": 36, "interest_rate": 3.5, "amount": 20000},
+                               {"id": 2, "term": 48, "interest_rate": 2.5, "amount": 30000}]
+    assert get_user_loans.call_args.kwargs["include_months"] is False
+
+def test_user_loans_not_modified(mocker, loan, loan_2):
+    mocker.patch("app.main.get_user_by_email", return_value=User(id=1, email="test@test.com", loans_version=7))
+    get_user_loans = mocker.patch("app.main.get_user_loans", return_value=[loan, loan_2])
+    response = client.get("/users/test@test.com/loans/")
+    assert response.headers["etag"] == '"user-1-7-loans-1"'
+    response = client.get("/users/test@test.com/loans/", headers={"If-None-Match": '"user-1-7-loans-1"'})
+    assert response.status_code == 304
+    assert get_user_loans.call_count == 1
+    response = client.get("/users/test@test.com/loans/", params={"include_months": False},
+                          headers={"If-None-Match": '"user-1-7-loans-1"'})
+    assert response.status_code == 200
+
 def test_user_loans_no_user(mocker, loan, loan_2):
     mocker.patch("app.main.get_user_by_email", return_value=None)
     mocker.patch("app.main.get_user_loans", return_value=[loan, loan_2])
     response = client.get("/users/test@test.com/loans/")
     assert response.status_code == 404
-    assert response.json() == {"detail": "User not found"}    
+    assert response.json() == {"detail": "User not found"}
+
+def test_loan_months_in_every_schedule_storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "database_url", f"sqlite:///{tmp_path / 'storage.db'}")
+    get_engine.cache_clear()
+    _get_sessionmaker.cache_clear()
+    upgrade()
+    responses = {}
+    try:
+        for storage in ("rows", "lazy", "packed"):
+            monkeypatch.setattr(settings, "schedule_storage", storage)
+            email = f"{storage}@test.com"
+            client.post("/users/", json={"first_name": "Grey", "last_name": "Stone", "email": email})
+            created = client.post(f"/loans/{email}/", json={"amount": 20000, "term": 36, "interest_rate": 3.5},
+                                  headers={"Idempotency-Key": storage})
+            replayed = client.post(f"/loans/{email}/", json={"amount": 20000, "term": 36, "interest_rate": 3.5},
+                                   headers={"Idempotency-Key": storage})
+            responses[storage] = [created.json(), replayed.json(), *client.get(f"/users/{email}/loans/").json()]
+    finally:
+        get_engine().dispose()
+        get_engine.cache_clear()
+        _get_sessionmaker.cache_clear()
+
+    def without_ids(loans):
+        # Loans, their users and the loan months stored as rows have ids of their own in every storage
+        return [{**loan, "id": None, "users": [], "loan_months": [{**month, "id": None} for month in loan["loan_months"]]}
+                for loan in loans]
+    assert len(responses["rows"][0]["loan_months"]) == 36
+    assert all(month["id"] is not None for month in responses["rows"][0]["loan_months"])
+    for storage in ("lazy", "packed"):
+        assert all(month["id"] is None for loan in responses[storage] for month in loan["loan_months"])
+        assert without_ids(responses[storage]) == without_ids(responses["rows"])
 
 def test_share_loan(mocker, user, loan):
     mocker.patch("app.main.get_user_by_email", return_value=user)
@@ -136,6 +377,17 @@ def test_share_loan(mocker, user, loan):
     response = client.patch("/loans/1/share/test@test.com/")
     assert response.status_code == 200
 
+def test_share_loans(mocker):
+    shares = [{"loan_id": 1, "email": "test@test.com"}, {"loan_id": 2, "email": "nobody@test.com"}]
+    share = mocker.patch("app.main.share_loans_by_email", return_value=[
+        {**shares[0], "shared": True}, {**shares[1], "error": "User not found"}])
+    response = client.patch("/loans/share", json=shares)
+    assert response.status_code == 200
+    assert response.json() == [{"loan_id": 1, "email": "test@test.com", "shared": True, "error": None},
+                               {"loan_id": 2, "email": "nobody@test.com", "shared": False, "error": "User not found"}]
+    assert [share.loan_id for share in share.call_args.kwargs["shares"]] == [1, 2]
+    assert client.patch("/loans/share/", json=shares).status_code == 200
+
 def test_share_loan_no_user(mocker, loan):
     mocker.patch("app.main.get_user_by_email", return_value=None)
     mocker.patch("app.main.get_loan", return_value=loan)
@@ -0,0 +1,132 @@
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select
+
+from app import database, idempotency, main
+from app.config import settings
+from app.database import SessionLocal
+from app.jobs import InMemoryJobBackend, JobQueue
+from app.logic import loan as loan_logic
+from app.main import app
+from app.migrations import upgrade
+from app.models import Loan, User, idempotency_keys
+
+client = TestClient(app)
+
+LOAN = {"amount": 20000, "term": 36, "interest_rate": 3.5}
+
+
+@pytest.fixture(autouse=True)
+def database_url(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "database_url", f"sqlite:///{tmp_path / 'idempotency.db'}")
+    database.get_engine.cache_clear()
+    database._get_sessionmaker.cache_clear()
+    upgrade()
+    yield
+    database.get_engine().dispose()
+    database.get_engine.cache_clear()
+    database._get_sessionmaker.cache_clear()
+
+def count(column):
+    db = SessionLocal()
+    try:
+        return db.scalar(select(func.count(column)))
+    finally:
+        db.close()
+
+def register(email="grey@greystone.com", key=None):
+    headers = {"Idempotency-Key": key} if key else {}
+    return client.post("/users/", json={"first_name": "Grey", "last_name": "Stone", "email": email}, headers=headers)
+
+def test_replayed_create_loan(mocker):
+    register()
+    create_loan = mocker.spy(main, "create_loan")
+    schedule = mocker.spy(loan_logic, "calculate_schedule_cents")
+    response = client.post("/loans/grey@greystone.com/", json=LOAN, headers={"Idempotency-Key": "loan-1"})
+    assert response.status_code == 201
+    assert "idempotent-replayed" not in response.headers
+
+    replayed = client.post("/loans/grey@greystone.com/", json=LOAN, headers={"Idempotency-Key": "loan-1"})
+    assert replayed.status_code == 201
+    assert replayed.headers["idempotent-replayed"] == "true"
+    assert replayed.json() == response.json()
+    assert create_loan.call_count == 1 and count(Loan.id) == 1
+    assert schedule.call_count == 1
+
+    # The same key for another request is refused, requests without a key are never deduplicated
+    mismatched = client.post("/loans/grey@greystone.com/", json={**LOAN, "amount": 30000}, headers={"Idempotency-Key": "loan-1"})
+    assert mismatched.status_code == 422
+    assert client.post("/loans/grey@greystone.com/", json=LOAN).status_code == 201
+    assert client.post("/loans/grey@greystone.com/", json=LOAN).status_code == 201
+    assert count(Loan.id) == 3
+    assert client.post("/loans/grey@greystone.com/", json=LOAN, headers={"Idempotency-Key": "x" * 256}).status_code == 400
+
+def test_replayed_register_user():
+    response = register(key="user-1")
+    assert response.status_code == 201
+    replayed = register(key="user-1")
+    assert replayed.status_code == 201 and replayed.json() == response.json()
+    assert register(key="user-2").status_code == 400
+    assert count(User.id) == 1
+
+def test_failed_request_releases_key():
+    assert client.post("/loans/grey@greystone.com/", json=LOAN, headers={"Idempotency-Key": "loan-1"}).status_code == 404
+    assert count(idempotency_keys.c.key) == 0
+    register()
+    assert client.post("/loans/grey@greystone.com/", json=LOAN, headers={"Idempotency-Key": "loan-1"}).status_code == 201
+
+def test_concurrent_duplicates_wait(mocker, monkeypatch):
+    register()
+    started, release = threading.Event(), threading.Event()
+    create_loan = main.create_loan
+    def slow_create_loan(**kwargs):
+        started.set()
+        release.wait(5)
+        return create_loan(**kwargs)
+    mocker.patch("app.main.create_loan", side_effect=slow_create_loan)
+    responses = []
+    def post():
+        responses.append(client.post("/loans/grey@greystone.com/", json=LOAN, headers={"Idempotency-Key": "loan-1"}))
+
+    first = threading.Thread(target=post)
+    first.start()
+    assert started.wait(5)
+    # A duplicate that gives up waiting is told to retry
+    monkeypatch.setattr(settings, "idempotency_wait_timeout", 0)
+    busy = client.post("/loans/grey@greystone.com/", json=LOAN, headers={"Idempotency-Key": "loan-1"})
+    assert busy.status_code == 409 and busy.headers["retry-after"] == "1"
+    monkeypatch.setattr(settings, "idempotency_wait_timeout", 5)
+    second = threading.Thread(target=post)
+    second.start()
+    release.set()
+    first.join()
+    second.join()
+    assert [response.status_code for response in responses] == [201, 201]
+    assert responses[0].json()["id"] == responses[1].json()["id"]
+    assert count(Loan.id) == 1
+
+def test_expired_keys(monkeypatch):
+    register()
+    monkeypatch.setattr(settings, "idempotency_ttl", -1)
+    for key in ("loan-1", "loan-2"):
+        assert client.post("/loans/grey@greystone.com/", json=LOAN, headers={"Idempotency-Key": key}).status_code == 201
+    # An expired key is claimed anew, and every other expired key is cleaned up along with it
+    monkeypatch.setattr(idempotency, "_last_cleanup", 0)
+    response = client.post("/loans/grey@greystone.com/", json=LOAN, headers={"Idempotency-Key": "loan-1"})
+    assert response.status_code == 201 and "idempotent-replayed" not in response.headers
+    assert count(Loan.id) == 3 and count(idempotency_keys.c.key) == 1
+
+def test_replayed_background_loan(mocker, monkeypatch):
+    register()
+    jobs = JobQueue(InMemoryJobBackend(ttl=60))
+    mocker.patch("app.main.get_job_queue", return_value=jobs)
+    mocker.patch("app.idempotency.get_job_queue", return_value=jobs)
+    monkeypatch.setattr(settings, "background_writes", True)
+    response = client.post("/loans/grey@greystone.com/", json=LOAN, headers={"Idempotency-Key": "loan-1"})
+    replayed = client.post("/loans/grey@greystone.com/", json=LOAN, headers={"Idempotency-Key": "loan-1"})
+    assert response.status_code == replayed.status_code == 202
+    assert replayed.json()["id"] == response.json()["id"]
+    assert replayed.headers["location"] == response.headers["location"]
+    assert jobs.backend.pending() == 1
@@ -0,0 +1,111 @@
+import time
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from app.config import settings
+from app.jobs import JOB_FAILED, JOB_QUEUED, JOB_SUCCEEDED, JOBS_FINISHED, InMemoryJobBackend, Job, JobQueue,\
+    RedisJobBackend
+from app.logic.loan import get_loan_schedule
+from app.models import Loan, LoanMonth, User
+from app.tests.conftest import FakeRedis, engine_fixture
+
+engine = engine_fixture("test_jobs.db", schema="migrate")
+
+
+@pytest.fixture(scope="module")
+def session_factory(engine):
+    db = sessionmaker(bind=engine)()
+    db.add(User(email="jobs@greystone.com", first_name="Grey", last_name="Stone"))
+    db.commit()
+    db.close()
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+@pytest.fixture(params=["memory", "redis"])
+def backend(request):
+    if request.param == "redis":
+        return RedisJobBackend(FakeRedis(), ttl=60)
+    return InMemoryJobBackend(ttl=60)
+
+def test_create_loan_job(session_factory, backend, monkeypatch):
+    monkeypatch.setattr(settings, "schedule_storage", "rows")
+    jobs = JobQueue(backend, session_factory=session_factory)
+    job = jobs.submit("create_loan", {"email": "JOBS@greystone.com", "loan": {"amount": 20000, "interest_rate": 3.5, "term": 36}})
+    assert jobs.get(job.id).status == JOB_QUEUED
+    assert backend.pending() == 1
+
+    assert jobs.run_next().id == job.id
+    finished = jobs.get(job.id)
+    assert finished.status == JOB_SUCCEEDED and finished.error is None
+    assert finished.payload is None
+    assert backend.pending() == 0 and jobs.run_next() is None
+
+    db = session_factory()
+    try:
+        loan = db.get(Loan, finished.result["loan_id"])
+        assert loan.schedule_storage == "rows"
+        assert db.query(LoanMonth).filter(LoanMonth.loan_id == loan.id).count() == 36
+        assert get_loan_schedule(db, loan.id)[-1]["remaining_balance"] == 0
+    finally:
+        db.close()
+
+def test_create_loan_job_writes_in_batches(session_factory, backend, monkeypatch):
+    monkeypatch.setattr(settings, "schedule_storage", "rows")
+    monkeypatch.setattr(settings, "job_batch_size", 10)
+    commits = []
+    def counting_session_factory():
+        db = session_factory()
+        commit = db.commit
+        def counted_commit():
+            commits.append(db.query(LoanMonth).count())
+            commit()
+        db.commit = counted_commit
+        return db
+
+    jobs = JobQueue(backend, session_factory=counting_session_factory)
+    jobs.submit("create_loan", {"email": "jobs@greystone.com", "loan": {"amount": 20000, "interest_rate": 3.5, "term": 36}})
+    jobs.run_next()
+    # The lazily stored loan, then four batches of loan months
+    assert [count - commits[0] for count in commits[:5]] == [0, 10, 20, 30, 36]
+
+def test_bulk_job(session_factory, backend):
+    jobs = JobQueue(backend, session_factory=session_factory)
+    job = jobs.submit("create_loans_bulk", {"loans": [{"amount": 1000, "interest_rate": 1, "term": 12, "email": "jobs@greystone.com"},
+                                                      {"amount": 1000, "interest_rate": 1, "term": 12, "email": "nobody@greystone.com"}]})
+    jobs.run_next()
+    result = jobs.get(job.id).result
+    assert result[0]["loan_id"] is not None
+    assert result[1] == {"email": "nobody@greystone.com", "loan_id": None, "error": "No user for loan found"}
+
+def test_failed_job(session_factory, backend):
+    jobs = JobQueue(backend, session_factory=session_factory)
+    failures = JOBS_FINISHED.value(kind="create_loan", status=JOB_FAILED)
+    job = jobs.submit("create_loan", {"email": "nobody@greystone.com", "loan": {"amount": 1000, "interest_rate": 1, "term": 12}})
+    jobs.run_next()
+    assert jobs.get(job.id).status == JOB_FAILED
+    assert jobs.get(job.id).error == "LookupError: No user for loan found"
+    assert JOBS_FINISHED.value(kind="create_loan", status=JOB_FAILED) == failures + 1
+    with pytest.raises(ValueError):
+        jobs.submit("unknown", {})
+
+def test_workers(session_factory):
+    jobs = JobQueue(InMemoryJobBackend(ttl=60), session_factory=session_factory)
+    jobs.start(2)
+    try:
+        submitted = [jobs.submit("create_loan", {"email": "jobs@greystone.com", "loan": {"amount": 1000, "interest_rate": 1, "term": 12}})
+                     for _ in range(4)]
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and not all(jobs.get(job.id).finished for job in submitted):
+            time.sleep(0.01)
+    finally:
+        jobs.stop()
+    assert [jobs.get(job.id).status for job in submitted] == [JOB_SUCCEEDED] * 4
+
+def test_finished_jobs_expire():
+    backend = InMemoryJobBackend(ttl=0)
+    queued = Job("create_loan", {})
+    backend.push(queued)
+    finished = Job("create_loan", {}, status=JOB_SUCCEEDED)
+    backend.save(finished)
+    assert backend.get(finished.id) is None
+    assert backend.get(queued.id).status == JOB_QUEUED
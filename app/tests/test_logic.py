@@ -1,34 +1,33 @@
-import os
+import numpy as np
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker
 
-from ..database import Base
 from app.logic.ping_db import ping_db
-from app.schemas import UserCreate, LoanCreate
-from app.logic.user import create_user, get_user_loans
+from app.schemas import UserCreate, LoanCreate, LoanBulkCreate, LoanShare, UserLoan, LoanHeader, SimulationRequest
+from app.logic.user import create_user, get_user_loans, get_user_by_email
 from app.models import User, LoanMonth, Loan
 from app.logic.loan import create_loan, get_loan_schedule, get_month_summary,\
-    share_loan
-from decimal import Decimal
+    share_loan, share_loans_by_email, backfill_loan_month_totals, materialize_loan_schedule, create_loans_bulk, pack_loan_schedules,\
+    get_loan_version
+from app.logic.export import export_loan_schedules, iter_loan_schedules, select_user_loan_ids
+from app.logic.portfolio import get_user_portfolio
+from app.logic.simulation import simulate_loan
+from app.config import settings
+from app.packing import pack_schedule, unpack_schedule
+import json
+from app.logic.common import generate_amoritization_schedule, generate_amoritization_schedules, amortization_factors,\
+    prewarm_amortization_factors
+from decimal import Context, Decimal, localcontext
 from _decimal import getcontext
+from app.tests.conftest import count_statements, engine_fixture
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
-
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = engine_fixture("test.db")
 
 
 @pytest.fixture(scope="module")
-def db():
-    try:
-        os.remove("test.db")
-    except FileNotFoundError:
-        pass
-    Base.metadata.create_all(bind=engine)
-    db = TestingSessionLocal()
+def db(engine):
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
     yield db
     db.rollback()
     db.close()
@@ -36,13 +35,16 @@ def db():
 @pytest.fixture(scope="module")
 def loan():
     loan = Loan(term=36, interest_rate=3.5, amount=300)
-    loan.loan_months.append(LoanMonth(month=1, principal_amount=100, interest_amount=200))
-    loan.loan_months.append(LoanMonth(month=2, principal_amount=200, interest_amount=100))
+    loan.loan_months.append(LoanMonth(month=1, principal_amount=100, interest_amount=200,
+                                      cumulative_principal=100, cumulative_interest=200, remaining_balance=200))
+    loan.loan_months.append(LoanMonth(month=2, principal_amount=200, interest_amount=100,
+                                      cumulative_principal=300, cumulative_interest=300, remaining_balance=0))
     return loan
    
 @pytest.fixture(scope="module")
 def user():
-    user = User(email='test@test.com', first_name="Test", last_name="McTest")
+    # Not test@test.com, which the user of user_loans already registered
+    user = User(email='share@test.com', first_name="Test", last_name="McTest")
     return user
 
 @pytest.fixture(scope="module")
@@ -75,6 +77,15 @@ def test_user_create(db):
     assert  user_input.email == user.email
     assert  user.id > 0
 
+def test_user_create_lowercases_email(db):
+    user = create_user(db=db, user=UserCreate(first_name="Grey", last_name="Stone", email="Mixed.Case@Greystone.com"))
+    assert user.email == "mixed.case@greystone.com"
+    # Emails differing by case alone are one and the same
+    with pytest.raises(IntegrityError):
+        db.add(User(first_name="Grey", last_name="Stone", email="MIXED.case@greystone.com"))
+        db.commit()
+    db.rollback()
+
 def test_loan_create(db):
     getcontext().prec=2
     user = User(first_name="Grey", last_name="Stone", email="loan_create@greystone.com")
@@ -97,14 +108,125 @@ def test_loan_create(db):
     assert first_loan_month.interest_amount == Decimal('75.00')
     
     last_loan_month = db.query(LoanMonth).filter(LoanMonth.loan==loan, LoanMonth.month==48).first()
-    assert last_loan_month.principal_amount == Decimal('662.37') #TODO: Should be 36 cents... resolve rounding error
+    assert last_loan_month.principal_amount == Decimal('662.38') # Absorbs the rounding residue of the prior months
     assert last_loan_month.interest_amount == Decimal('1.66')
+    assert last_loan_month.cumulative_principal == Decimal('30000.00')
+    assert last_loan_month.remaining_balance == Decimal('0.00')
     
     # Test arbitrary month(10th)
     tenth_loan_month = db.query(LoanMonth).filter(LoanMonth.loan==loan, LoanMonth.month==10).first()
     assert tenth_loan_month.principal_amount == Decimal('602.42')
     assert tenth_loan_month.interest_amount == Decimal('61.61')
     
+def test_lazy_loan_matches_stored_loan(db, monkeypatch):
+    user = User(first_name="Grey", last_name="Stone", email="lazy@greystone.com")
+    db.add(user)
+    db.commit()
+    loan_input = LoanCreate(**{"amount": 250000, "term": 360, "interest_rate": 6.125})
+    stored_loan = create_loan(db=db, loan=loan_input, user=user)
+    monkeypatch.setattr(settings, "schedule_storage", "lazy")
+    lazy_loan = create_loan(db=db, loan=loan_input, user=user)
+
+    assert lazy_loan.schedule_storage == "lazy"
+    assert db.query(LoanMonth).filter(LoanMonth.loan==lazy_loan).count() == 0
+    assert repr(get_loan_schedule(db=db, loan_id=lazy_loan.id)) == repr(get_loan_schedule(db=db, loan_id=stored_loan.id))
+    for month in (1, 180, 360, 361):
+        lazy_summary = get_month_summary(db=db, loan_id=lazy_loan.id, month=month)
+        assert repr(lazy_summary) == repr(get_month_summary(db=db, loan_id=stored_loan.id, month=month))
+
+    lazy_schedule = repr(get_loan_schedule(db=db, loan_id=lazy_loan.id))
+    materialize_loan_schedule(db=db, loan=lazy_loan)
+    assert lazy_loan.schedule_storage == "rows"
+    assert db.query(LoanMonth).filter(LoanMonth.loan==lazy_loan).count() == 360
+    assert repr(get_loan_schedule(db=db, loan_id=lazy_loan.id)) == lazy_schedule
+
+def test_packed_loan_matches_stored_loan(db, monkeypatch):
+    user = User(first_name="Grey", last_name="Stone", email="packed@greystone.com")
+    db.add(user)
+    db.commit()
+    loan_input = LoanCreate(**{"amount": 250000, "term": 360, "interest_rate": 6.125})
+    stored_loan = create_loan(db=db, loan=loan_input, user=user)
+    monkeypatch.setattr(settings, "schedule_storage", "packed")
+    packed_loan = create_loan(db=db, loan=loan_input, user=user)
+
+    assert packed_loan.schedule_storage == "packed"
+    assert len(packed_loan.schedule_blob) == 8 + 2 * 360 * 8
+    assert db.query(LoanMonth).filter(LoanMonth.loan==packed_loan).count() == 0
+    schedule = repr(get_loan_schedule(db=db, loan_id=stored_loan.id))
+    assert repr(get_loan_schedule(db=db, loan_id=packed_loan.id)) == schedule
+    for from_month, to_month in ((13, 24), (350, None), (1, 3), (361, None)):
+        assert repr(get_loan_schedule(db=db, loan_id=packed_loan.id, from_month=from_month, to_month=to_month)) == \
+            repr(get_loan_schedule(db=db, loan_id=stored_loan.id, from_month=from_month, to_month=to_month))
+    for month in (1, 180, 360, 361):
+        assert repr(get_month_summary(db=db, loan_id=packed_loan.id, month=month)) == \
+            repr(get_month_summary(db=db, loan_id=stored_loan.id, month=month))
+    exported = list(iter_loan_schedules(db=db, loan_ids=[stored_loan.id, packed_loan.id]))
+    assert [row[1:] for row in exported[:360]] == [row[1:] for row in exported[360:]]
+
+    # Loans storing their loan months are converted in place
+    assert pack_loan_schedules(db=db, loan_ids=[stored_loan.id, packed_loan.id]) == 1
+    db.refresh(stored_loan)
+    assert stored_loan.schedule_storage == "packed"
+    assert stored_loan.schedule_blob == packed_loan.schedule_blob
+    assert db.query(LoanMonth).filter(LoanMonth.loan==stored_loan).count() == 0
+    assert repr(get_loan_schedule(db=db, loan_id=stored_loan.id)) == schedule
+
+    materialize_loan_schedule(db=db, loan=packed_loan)
+    assert packed_loan.schedule_storage == "rows" and packed_loan.schedule_blob is None
+    assert db.query(LoanMonth).filter(LoanMonth.loan==packed_loan).count() == 360
+    assert repr(get_loan_schedule(db=db, loan_id=packed_loan.id)) == schedule
+
+def test_create_loans_bulk(db):
+    user = User(first_name="Grey", last_name="Stone", email="bulk@greystone.com")
+    db.add(user)
+    db.commit()
+    loan_inputs = [LoanBulkCreate(**{"amount": 30000, "term": 48, "interest_rate": 3.0, "email": "bulk@greystone.com"}),
+                   LoanBulkCreate(**{"amount": 30000, "term": 48, "interest_rate": 3.0, "email": "nobody@greystone.com"}),
+                   LoanBulkCreate(**{"amount": 1000, "term": 12, "interest_rate": 0, "email": "bulk@greystone.com"})]
+
+    results = create_loans_bulk(db=db, loans=loan_inputs, chunk_size=1)
+
+    assert [result.email for result in results] == [loan.email for loan in loan_inputs]
+    assert results[1].loan_id is None
+    assert results[1].error == "No user for loan found"
+    db.refresh(user)
+    assert [loan.id for loan in user.loans] == [results[0].loan_id, results[2].loan_id]
+    assert [len(loan.loan_months) for loan in user.loans] == [48, 12]
+
+    bulk_loan = user.loans[0]
+    tenth_loan_month = db.query(LoanMonth).filter(LoanMonth.loan==bulk_loan, LoanMonth.month==10).first()
+    assert tenth_loan_month.principal_amount == Decimal('602.42')
+    assert tenth_loan_month.interest_amount == Decimal('61.61')
+    month_summary = get_month_summary(db=db, loan_id=bulk_loan.id, month=48)
+    assert month_summary["principal_balance"] == Decimal('0.00')
+    assert month_summary["principal_paid"] == Decimal('30000.00')
+
+def test_export_loan_schedules(db, monkeypatch):
+    user = User(first_name="Grey", last_name="Stone", email="export@greystone.com")
+    db.add(user)
+    db.commit()
+    loan_input = LoanCreate(**{"amount": 250000, "term": 360, "interest_rate": 6.125})
+    stored_loan = create_loan(db=db, loan=loan_input, user=user)
+    monkeypatch.setattr(settings, "schedule_storage", "lazy")
+    lazy_loan = create_loan(db=db, loan=loan_input, user=user)
+    # Amounts are added up in the active decimal context, which an earlier test narrows
+    with localcontext(Context()):
+        expected = get_loan_schedule(db=db, loan_id=stored_loan.id)
+
+        chunks = list(export_loan_schedules(db=db, loan_ids=select_user_loan_ids(user), format="ndjson", batch_size=100))
+        assert len(chunks) == 8
+        rows = [json.loads(line) for line in "".join(chunks).splitlines()]
+        assert len(rows) == 720
+        assert [row["loan_id"] for row in rows] == [stored_loan.id] * 360 + [lazy_loan.id] * 360
+        assert rows[:360] == [{"loan_id": stored_loan.id, "month": item["month"], "remaining_balance": float(item["remaining_balance"]),
+                               "monthly_payment": float(item["monthly_payment"])} for item in expected]
+        assert rows[:360] == [{**row, "loan_id": stored_loan.id} for row in rows[360:]]
+
+        lines = "".join(export_loan_schedules(db=db, loan_ids=[stored_loan.id, -1], format="csv")).splitlines()
+        assert lines[0] == "loan_id,month,remaining_balance,monthly_payment"
+        assert lines[-1] == f"{stored_loan.id},360,0.00,{expected[-1]['monthly_payment']}"
+        assert len(lines) == 361
+
 def test_get_loan_schedule(db, loan):
     db.add(loan)
     db.commit()
@@ -161,6 +283,23 @@ def test_get_month_summary_no_month(db, loan):
     month_summary = get_month_summary(db=db, loan_id=loan.id, month=3)
     assert month_summary["principal_balance"] is None
 
+def test_backfill_loan_month_totals(db):
+    loan = Loan(term=2, interest_rate=3.5, amount=30000)
+    loan.loan_months.append(LoanMonth(month=1, principal_amount=14934.62, interest_amount=87.50))
+    loan.loan_months.append(LoanMonth(month=2, principal_amount=15065.38, interest_amount=43.94))
+    db.add(loan)
+    db.commit()
+
+    assert backfill_loan_month_totals(db=db) == 1
+    month_summary = get_month_summary(db=db, loan_id=loan.id, month=1)
+    assert month_summary["principal_balance"] == Decimal('15065.38')
+    assert month_summary["principal_paid"] == Decimal('14934.62')
+    assert month_summary["interest_paid"] == Decimal('87.50')
+    month_summary = get_month_summary(db=db, loan_id=loan.id, month=2)
+    assert month_summary["principal_balance"] == Decimal('0.00')
+    assert month_summary["interest_paid"] == Decimal('131.44')
+    assert backfill_loan_month_totals(db=db) == 0
+
 def test_get_user_loans(db, user_loans):
     db.add(user_loans)
     db.commit()
@@ -169,6 +308,158 @@ def test_get_user_loans(db, user_loans):
     assert len(loans) == 2
     assert loans[0] != loans[1]
 
+@pytest.mark.parametrize("loan_count", [1, 20])
+def test_get_user_loans_statement_count(db, loan_count):
+    email = f"eager_{loan_count}@greystone.com"
+    db.add(User(first_name="Grey", last_name="Stone", email=email))
+    db.commit()
+    create_loans_bulk(db=db, loans=[LoanBulkCreate(**{"amount": 1000, "term": 12, "interest_rate": 3.0, "email": email})] * loan_count)
+    db.expire_all()
+
+    with count_statements(db) as statements:
+        user = get_user_by_email(db, email=email)
+        loans = [UserLoan.from_orm(loan) for loan in get_user_loans(db=db, user=user)]
+    assert [len(loan.loan_months) for loan in loans] == [12] * loan_count
+    assert len(statements) == 3
+
+    db.expire_all()
+    with count_statements(db) as statements:
+        user = get_user_by_email(db, email=email)
+        loans = [LoanHeader.from_orm(loan) for loan in get_user_loans(db=db, user=user, include_months=False)]
+    assert len(loans) == loan_count
+    assert len(statements) == 2
+
+    db.expire_all()
+    with count_statements(db) as statements:
+        user = get_user_by_email(db, email=email, with_loans=True)
+        loans = [UserLoan.from_orm(loan) for loan in user.loans]
+    assert len(loans) == loan_count
+    assert len(statements) == 3
+
+def test_get_loan_schedule_window(db, monkeypatch):
+    user = create_user(db, UserCreate(email="window@test.com", first_name="Test", last_name="McTest"))
+    with localcontext(Context()):
+        stored_loan = create_loan(db, LoanCreate(amount=250000, interest_rate=6.5, term=360), user)
+        monkeypatch.setattr(settings, "schedule_storage", "lazy")
+        lazy_loan = create_loan(db, LoanCreate(amount=250000, interest_rate=6.5, term=360), user)
+        expected = get_loan_schedule(db=db, loan_id=stored_loan.id)
+
+        with count_statements(db) as statements:
+            window = get_loan_schedule(db=db, loan_id=stored_loan.id, from_month=13, to_month=24)
+        assert window == expected[12:24]
+        assert len(statements) == 1
+        assert get_loan_schedule(db=db, loan_id=lazy_loan.id, from_month=13, to_month=24) == expected[12:24]
+        assert get_loan_schedule(db=db, loan_id=stored_loan.id, from_month=350) == expected[349:]
+        assert get_loan_schedule(db=db, loan_id=lazy_loan.id, to_month=3) == expected[:3]
+    assert get_loan_schedule(db=db, loan_id=stored_loan.id, from_month=361) == []
+    assert get_loan_schedule(db=db, loan_id=lazy_loan.id, from_month=361) == []
+    assert get_loan_schedule(db=db, loan_id=lazy_loan.id + 1, from_month=2) is None
+
+def test_get_user_portfolio(db, monkeypatch):
+    user = create_user(db, UserCreate(email="portfolio@test.com", first_name="Test", last_name="McTest"))
+    with localcontext(Context()):
+        loans = [create_loan(db, LoanCreate(amount=amount, interest_rate=rate, term=term), user)
+                 for amount, rate, term in ((250000, 6.5, 360), (20000, 4, 24), (5000, 0, 12))]
+        db.refresh(user)
+        with count_statements(db) as statements:
+            portfolio = get_user_portfolio(db, user, month=12)
+        assert len(statements) == 1
+        monkeypatch.setattr(settings, "schedule_storage", "lazy")
+        loans.append(create_loan(db, LoanCreate(amount=100000, interest_rate=5, term=120), user))
+        portfolio = get_user_portfolio(db, user, month=12)
+
+        assert [loan["loan_id"] for loan in portfolio["loans"]] == [loan.id for loan in loans]
+        for loan, row in zip(loans, portfolio["loans"]):
+            summary = get_month_summary(db, loan.id, 12)
+            schedule = get_loan_schedule(db, loan.id)
+            assert row["principal_balance"] == summary["principal_balance"]
+            assert row["principal_paid"] == summary["principal_paid"]
+            assert row["interest_paid"] == summary["interest_paid"]
+            assert row["next_payment"] == (schedule[12]["monthly_payment"] if loan.term > 12 else None)
+        assert portfolio["principal_balance"] == sum(row["principal_balance"] for row in portfolio["loans"])
+        assert portfolio["next_payment"] == sum(row["next_payment"] or 0 for row in portfolio["loans"])
+
+        paid_off = get_user_portfolio(db, user, month=480)
+    assert [row["principal_balance"] for row in paid_off["loans"]] == [0, 0, 0, 0]
+    assert [row["next_payment"] for row in paid_off["loans"]] == [None] * 4
+    assert paid_off["principal_paid"] == 375000
+
+def test_simulate_loan(db):
+    user = create_user(db, UserCreate(email="simulate@test.com", first_name="Test", last_name="McTest"))
+    loan = create_loan(db, LoanCreate(amount=20000, interest_rate=4, term=24), user)
+    simulation = SimulationRequest(extra_principal=[0, 500], rate_resets=[[], [{"month": 13, "interest_rate": 6}]])
+    result = simulate_loan(db, loan.id, simulation)
+    assert result["loan_id"] == loan.id
+    assert [(scenario["extra_principal"], scenario["rate_resets_index"]) for scenario in result["scenarios"]] == \
+        [(0, 0), (0, 1), (500, 0), (500, 1)]
+    baseline, reset, prepaid, _ = result["scenarios"]
+    assert baseline["payoff_month"] == 24 and prepaid["payoff_month"] < 24
+    assert abs(baseline["total_interest"] - sum(float(month.interest_amount) for month in loan.loan_months)) < 1
+    assert reset["total_interest"] > baseline["total_interest"] > prepaid["total_interest"]
+    assert simulate_loan(db, loan.id + 1, simulation) is None
+
+@pytest.mark.parametrize("storage", ["rows", "lazy", "packed"])
+def test_schedules_end_at_exactly_zero(db, monkeypatch, storage):
+    monkeypatch.setattr(settings, "schedule_storage", storage)
+    user = create_user(db, UserCreate(email=f"cents_{storage}@test.com", first_name="Test", last_name="McTest"))
+    amounts = (999999.99, 1234.57, 0.03)
+    loans = [create_loan(db, LoanCreate(amount=amount, interest_rate=7.3, term=480), user) for amount in amounts]
+    results = create_loans_bulk(db, [LoanBulkCreate(amount=amount, interest_rate=7.3, term=480, email=user.email)
+                                     for amount in amounts])
+    bulk_loan_ids = [result.loan_id for result in results]
+    for amount, loan, bulk_loan_id in zip(amounts, loans, bulk_loan_ids):
+        assert loan.amount_cents == round(amount * 100)
+        schedule = get_loan_schedule(db=db, loan_id=loan.id)
+        assert schedule[-1]["remaining_balance"] == Decimal("0.00")
+        assert all(row["remaining_balance"] >= 0 for row in schedule)
+        assert repr(get_loan_schedule(db=db, loan_id=bulk_loan_id)) == repr(schedule)
+        assert get_month_summary(db=db, loan_id=loan.id, month=480)["principal_paid"] == Decimal(f"{amount:.2f}")
+
+def test_versions(db, monkeypatch):
+    owner = create_user(db, UserCreate(email="versions@test.com", first_name="Test", last_name="McTest"))
+    other = create_user(db, UserCreate(email="versions_2@test.com", first_name="Test", last_name="McTest"))
+    assert owner.loans_version == 1
+    monkeypatch.setattr(settings, "schedule_storage", "lazy")
+    loan = create_loan(db, LoanCreate(amount=1000, interest_rate=3, term=12), owner)
+    db.refresh(owner)
+    assert owner.loans_version == 2 and get_loan_version(db, loan.id) == 1
+
+    share_loan(db, loan, other)
+    db.refresh(owner), db.refresh(other)
+    assert (owner.loans_version, other.loans_version) == (2, 2)
+
+    # Storing the months of a loan changes the loans of every user holding it
+    materialize_loan_schedule(db, loan)
+    db.refresh(owner), db.refresh(other)
+    assert get_loan_version(db, loan.id) == 2
+    assert (owner.loans_version, other.loans_version) == (3, 3)
+    pack_loan_schedules(db, loan_ids=[loan.id])
+    assert get_loan_version(db, loan.id) == 3
+
+    create_loans_bulk(db, [LoanBulkCreate(amount=1000, interest_rate=3, term=12, email=other.email)])
+    db.refresh(owner), db.refresh(other)
+    assert (owner.loans_version, other.loans_version) == (4, 5)
+    assert get_loan_version(db, -1) is None
+
+def test_share_loans_by_email(db):
+    owner = create_user(db, UserCreate(email="sharing@test.com", first_name="Test", last_name="McTest"))
+    other = create_user(db, UserCreate(email="sharing_2@test.com", first_name="Test", last_name="McTest"))
+    loan_ids = [result.loan_id for result in create_loans_bulk(db, [LoanBulkCreate(amount=1000, interest_rate=3, term=12,
+                                                                                   email=owner.email)] * 3)]
+    shares = [LoanShare(loan_id=loan_ids[0], email="SHARING_2@test.com"), LoanShare(loan_id=loan_ids[1], email=other.email),
+              LoanShare(loan_id=loan_ids[0], email=owner.email), LoanShare(loan_id=loan_ids[1], email=other.email),
+              LoanShare(loan_id=-1, email=other.email), LoanShare(loan_id=loan_ids[2], email="nobody@test.com")]
+    with count_statements(db) as statements:
+        results = share_loans_by_email(db, shares)
+    # The users, the loans, the insert and the version bump, whatever the number of shares
+    assert len(statements) == 4
+    assert [(result.shared, result.error) for result in results] == [
+        (True, None), (True, None), (False, None), (False, None), (False, "Loan not found"), (False, "User not found")]
+    db.refresh(owner), db.refresh(other)
+    assert (owner.loans_version, other.loans_version) == (2, 2)
+    assert [loan.id for loan in get_user_loans(db, other)] == loan_ids[:2]
+    assert not any(result.shared for result in share_loans_by_email(db, shares[:2]))
+
 def test_share_loan(db, user, user_2, loan):
     loan.users.append(user)
     db.add(loan)
@@ -186,4 +477,65 @@ def test_share_loan(db, user, user_2, loan):
     
     assert len(loan.users) == 2
     assert loan.users[0] != loan.users[1]
-    
\ No newline at end of file
+
+    # Sharing again is a no-op, which does not load the loan's users
+    loans_version = user_2.loans_version
+    db.refresh(loan)
+    with count_statements(db) as statements:
+        share_loan(db, loan, user_2)
+    assert len(statements) == 1
+    assert len(loan.users) == 2
+    assert user_2.loans_version == loans_version
+    
+def test_amoritization_schedule_pays_off_exactly():
+    schedule = generate_amoritization_schedule(interest=6.5, term=360, principal=350000)
+    assert len(schedule) == 360
+    assert sum(round(principal * 100) for principal, _ in schedule) == 350000 * 100
+    assert schedule[0] == (316.4, 1895.83)
+
+def test_amoritization_schedule_zero_interest():
+    schedule = generate_amoritization_schedule(interest=0, term=3, principal=100)
+    assert schedule == [(33.33, 0.0), (33.33, 0.0), (33.34, 0.0)]
+
+def test_amoritization_schedules_batch():
+    schedules = generate_amoritization_schedules([3.0, 0, 6.5], [48, 3, 360], [30000, 100, 350000])
+    assert [len(schedule) for schedule in schedules] == [48, 3, 360]
+    assert schedules[0] == generate_amoritization_schedule(interest=3.0, term=48, principal=30000)
+    assert schedules[1] == generate_amoritization_schedule(interest=0, term=3, principal=100)
+    assert schedules[2] == generate_amoritization_schedule(interest=6.5, term=360, principal=350000)
+
+def test_amortization_factor_table():
+    amortization_factors.cache_clear()
+    schedule = generate_amoritization_schedule(interest=6.5, term=360, principal=350000)
+    assert amortization_factors.cache_info().misses == 1
+    # Another loan of the same product is priced from the table
+    generate_amoritization_schedules([6.5, 6.5, 3.0], [360, 360, 48], [100000, 350000, 30000])
+    assert amortization_factors.cache_info().hits == 1
+    assert amortization_factors.cache_info().misses == 2
+    assert generate_amoritization_schedule(interest=6.5, term=360, principal=350000) == schedule
+    assert amortization_factors.cache_info().maxsize == settings.amortization_cache_size
+
+    payment_factor, principal_fractions = amortization_factors(6.5, 360)
+    assert len(principal_fractions) == 360
+    assert principal_fractions[-1] == pytest.approx(payment_factor / (1 + 6.5 / 1200))
+    assert principal_fractions.sum() == pytest.approx(1)
+    with pytest.raises(ValueError):
+        principal_fractions[0] = 1
+    assert amortization_factors(0, 4) == (0.25, pytest.approx([0.25] * 4))
+
+def test_prewarm_amortization_factors():
+    amortization_factors.cache_clear()
+    prewarm_amortization_factors([180, 360], rate_step=0.1, max_rate=1)
+    assert amortization_factors.cache_info().currsize == 22
+    generate_amoritization_schedules([0.3, 0.7], [360, 180], [1000, 1000])
+    assert amortization_factors.cache_info().misses == 22
+
+def test_pack_schedule():
+    principal_cents, interest_cents = [100, 200, 300], [30, 20, 10]
+    blob = pack_schedule(principal_cents, interest_cents)
+    assert blob[:2] == b"GS" and len(blob) == 8 + 6 * 8
+    principal, interest = unpack_schedule(memoryview(blob))
+    assert principal.tolist() == principal_cents and interest.tolist() == interest_cents
+    assert principal.dtype == np.int64 and not principal.flags.writeable
+    with pytest.raises(ValueError):
+        unpack_schedule(b"GS\x02\x00" + blob[4:])
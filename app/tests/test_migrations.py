@@ -0,0 +1,159 @@
+import pytest
+from contextlib import contextmanager
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import sessionmaker
+
+from app.logic.loan import get_loan_schedule
+from app.logic.user import get_user_by_email, get_user_loans
+from app.migrations import downgrade, upgrade
+from app.models import Loan, LoanMonth, User
+from app.tests.conftest import engine_fixture
+
+engine = engine_fixture("test_migrations.db", schema=None, scope="function")
+
+
+def schema_version(engine):
+    with engine.connect() as connection:
+        return connection.execute(text("SELECT version_num FROM alembic_version")).scalar()
+
+def index_names(engine, table):
+    with engine.connect() as connection:
+        return set(connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"),
+                                      {"table": table}).scalars())
+
+@contextmanager
+def query_plans(engine):
+    """
+    Collects the statements executed in the block, then the EXPLAIN QUERY PLAN details of each of them
+    """
+    statements, plans = [], []
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        statements.append((statement, parameters))
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield plans
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    with engine.connect() as connection:
+        for statement, parameters in statements:
+            plans.append(" / ".join(row.detail for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)))
+
+def test_upgrade_creates_schema(engine):
+    upgrade(engine)
+    assert schema_version(engine) == "0007"
+    assert {"users", "loans", "user_loans", "loan_months"} <= set(inspect(engine).get_table_names())
+    assert "ix_user_loans_loan_id" in index_names(engine, "user_loans")
+    assert "ix_users_email_lower" in index_names(engine, "users")
+
+    # Upgrading an up to date database changes nothing
+    upgrade(engine)
+    assert schema_version(engine) == "0007"
+
+def test_downgrade_drops_indexes(engine):
+    upgrade(engine)
+    downgrade(engine, "0001")
+    assert schema_version(engine) == "0001"
+    assert "ix_user_loans_loan_id" not in index_names(engine, "user_loans")
+    assert "ix_users_email_lower" not in index_names(engine, "users")
+
+def test_upgrade_adopts_existing_database(engine):
+    # The schema of the first release, created by create_all before migrations existed
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, email VARCHAR UNIQUE, "
+                                "first_name VARCHAR, last_name VARCHAR)"))
+        connection.execute(text("CREATE TABLE loans (id INTEGER PRIMARY KEY, amount FLOAT, term INTEGER, interest_rate FLOAT)"))
+        connection.execute(text("CREATE TABLE loan_months (id INTEGER PRIMARY KEY, month INTEGER, principal_amount NUMERIC, "
+                                "interest_amount NUMERIC, loan_id INTEGER REFERENCES loans (id), UNIQUE (loan_id, month))"))
+        connection.execute(text("INSERT INTO loans (id, amount, term, interest_rate) VALUES (1, 1000, 12, 3.5)"))
+
+    upgrade(engine, "0002")
+
+    assert schema_version(engine) == "0002"
+    assert "user_loans" in inspect(engine).get_table_names()
+    assert {"schedule_storage"} <= {column["name"] for column in inspect(engine).get_columns("loans")}
+    assert {"cumulative_principal", "cumulative_interest", "remaining_balance"} <= \
+        {column["name"] for column in inspect(engine).get_columns("loan_months")}
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT amount, schedule_storage FROM loans")).all() == [(1000, None)]
+
+def test_upgrade_refuses_case_duplicate_emails(engine):
+    upgrade(engine, "0001")
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (email) VALUES ('Grey@Stone.com'), ('grey@stone.com'), ('other@stone.com')"))
+
+    with pytest.raises(RuntimeError, match="grey@stone.com"):
+        upgrade(engine)
+    assert schema_version(engine) == "0001"
+
+def test_upgrade_converts_money_to_cents(engine):
+    upgrade(engine, "0002")
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO loans (id, amount, term, interest_rate) VALUES (1, 999999.99, 1, 3.5)"))
+        connection.execute(text("INSERT INTO loan_months (month, principal_amount, interest_amount, cumulative_principal, "
+                                "cumulative_interest, remaining_balance, loan_id) VALUES (1, 999999.99, 2916.67, 999999.99, 2916.67, 0, 1)"))
+
+    upgrade(engine)
+
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT amount_cents FROM loans")).all() == [(99999999,)]
+        assert connection.execute(text("SELECT principal_cents, interest_cents, cumulative_principal_cents, "
+                                       "cumulative_interest_cents, remaining_balance_cents FROM loan_months")).all() == \
+            [(99999999, 291667, 99999999, 291667, 0)]
+    assert "ix_loan_months_id" in index_names(engine, "loan_months")
+
+    downgrade(engine, "0002")
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT amount FROM loans")).all() == [(999999.99,)]
+        assert connection.execute(text("SELECT principal_amount, remaining_balance FROM loan_months")).all() == [(999999.99, 0)]
+
+def test_downgrade_unpacks_schedules(engine):
+    upgrade(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO loans (id, amount_cents, term, interest_rate, schedule_storage, schedule_blob) "
+                                "VALUES (1, 100000, 12, 3.5, 'packed', x'00'), (2, 100000, 12, 3.5, 'rows', NULL)"))
+
+    downgrade(engine, "0003")
+
+    assert "schedule_blob" not in {column["name"] for column in inspect(engine).get_columns("loans")}
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT schedule_storage FROM loans ORDER BY id")).scalars().all() == ["lazy", "rows"]
+
+@pytest.fixture
+def db(engine):
+    upgrade(engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    user = User(email="Plan@Test.com", first_name="Grey", last_name="Stone")
+    loan = Loan(amount=1000, term=2, interest_rate=3.5, schedule_storage="rows")
+    loan.loan_months.append(LoanMonth(month=1, principal_amount=500, interest_amount=3))
+    loan.loan_months.append(LoanMonth(month=2, principal_amount=500, interest_amount=1))
+    user.loans.append(loan)
+    db.add(user)
+    db.commit()
+    db.expunge_all()
+    yield db
+    db.close()
+
+def test_email_lookup_plan(db, engine):
+    with query_plans(engine) as plans:
+        user = get_user_by_email(db, "plan@TEST.com")
+    assert user.email == "Plan@Test.com"
+    assert "USING INDEX ix_users_email_lower" in plans[0]
+
+def test_loan_users_plan(db, engine):
+    loan = db.query(Loan).one()
+    with query_plans(engine) as plans:
+        assert [user.email for user in loan.users] == ["Plan@Test.com"]
+    assert "SEARCH user_loans USING INDEX ix_user_loans_loan_id" in plans[0]
+
+def test_user_loans_plan(db, engine):
+    user = get_user_by_email(db, "plan@test.com")
+    with query_plans(engine) as plans:
+        assert len(get_user_loans(db, user)) == 1
+    assert all("SCAN" not in plan for plan in plans)
+    assert "sqlite_autoindex_user_loans_1 (user_id=?)" in plans[0]
+
+def test_loan_schedule_plan(db, engine):
+    loan_id = db.query(Loan.id).scalar()
+    with query_plans(engine) as plans:
+        assert len(get_loan_schedule(db, loan_id, from_month=2)) == 1
+    assert all("SCAN" not in plan for plan in plans)
@@ -0,0 +1,63 @@
+import os
+import pstats
+
+from fastapi.testclient import TestClient
+
+from app.config import settings
+from app.main import app
+from app.profiling import REQUEST_PHASE_SECONDS, REQUEST_SQL_STATEMENTS, SAVED_PROFILES
+
+client = TestClient(app)
+
+
+def parse_server_timing(header: str):
+    metrics = {}
+    for metric in header.split(", "):
+        name, *params = metric.split(";")
+        metrics[name] = dict(param.split("=", 1) for param in params)
+    return metrics
+
+def test_server_timing_header():
+    response = client.get("/health_check")
+    assert response.status_code == 200
+    timings = parse_server_timing(response.headers["server-timing"])
+    assert list(timings) == ["sql", "endpoint", "serialize", "total"]
+    assert timings["sql"]["desc"] == '"1 statements"'
+    assert float(timings["sql"]["dur"]) > 0
+    assert float(timings["total"]["dur"]) >= float(timings["sql"]["dur"]) + float(timings["endpoint"]["dur"])
+
+def test_server_timing_header_without_sql(mocker):
+    mocker.patch("app.main.ping_db", return_value=True)
+    response = client.get("/health_check")
+    timings = parse_server_timing(response.headers["server-timing"])
+    assert timings["sql"] == {"dur": "0.000", "desc": '"0 statements"'}
+
+def test_request_phase_metrics():
+    requests = REQUEST_PHASE_SECONDS.count(route="/health_check", phase="total")
+    statements = REQUEST_SQL_STATEMENTS.count(route="/health_check")
+    client.get("/health_check")
+    assert REQUEST_PHASE_SECONDS.count(route="/health_check", phase="total") == requests + 1
+    assert REQUEST_PHASE_SECONDS.count(route="/health_check", phase="sql") == requests + 1
+    assert REQUEST_SQL_STATEMENTS.count(route="/health_check") == statements + 1
+    assert 'greystone_request_phase_seconds_count{route="/health_check",phase="endpoint"}' in client.get("/metrics").text
+
+def test_unmatched_request_metrics():
+    requests = REQUEST_PHASE_SECONDS.count(route="unmatched", phase="total")
+    assert client.get("/no/such/route").status_code == 404
+    assert REQUEST_PHASE_SECONDS.count(route="unmatched", phase="total") == requests + 1
+
+def test_slow_request_profile(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "profile_dir", str(tmp_path))
+    monkeypatch.setattr(settings, "profile_slow_requests", 60)
+    client.get("/health_check")
+    assert os.listdir(tmp_path) == []
+
+    saved = SAVED_PROFILES.value()
+    monkeypatch.setattr(settings, "profile_slow_requests", 0)
+    client.get("/health_check")
+    profiles = os.listdir(tmp_path)
+    assert len(profiles) == 1
+    assert "-GET-health_check-" in profiles[0]
+    assert SAVED_PROFILES.value() == saved + 1
+    stats = pstats.Stats(str(tmp_path / profiles[0]))
+    assert any(function == "ping_db" for _, _, function in stats.stats)
@@ -0,0 +1,51 @@
+from decimal import Context, Decimal, localcontext
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app import schemas
+from app.logic.loan import build_loan_schedule, build_month_summary, compute_loan_month
+from app.models import SCHEDULE_LAZY, Loan
+from app.serialization import fast_response
+
+
+def validated_body(model, content):
+    """
+    Renders content like FastAPI does for a route declaring `model` as its response model
+    """
+    if isinstance(content, list):
+        return JSONResponse(jsonable_encoder([model(**row) for row in content])).body
+    return JSONResponse(jsonable_encoder(model(**content))).body
+
+@pytest.mark.parametrize("amount,interest_rate,term", [(250000, 6.5, 360), (20000, 3.5, 36), (1200, 0, 12),
+                                                       (999999.99, 12.25, 480), (0.5, 1, 2)])
+def test_fast_response_matches_validated_response(amount, interest_rate, term):
+    loan = Loan(amount=amount, interest_rate=interest_rate, term=term, schedule_storage=SCHEDULE_LAZY)
+    with localcontext(Context()):
+        schedule = build_loan_schedule(loan)
+        summaries = [build_month_summary(compute_loan_month(loan, month)) for month in (1, term // 2 or 1, term)]
+    assert fast_response(schemas.ScheduleItem, schedule).body == validated_body(schemas.ScheduleItem, schedule)
+    for summary in summaries:
+        assert fast_response(schemas.MonthSummary, summary).body == validated_body(schemas.MonthSummary, summary)
+
+def test_fast_response_casts_to_field_types():
+    schedule = [{"month": 1, "remaining_balance": 300, "monthly_payment": Decimal("100.10"), "extra": "dropped"}]
+    body = fast_response(schemas.ScheduleItem, schedule).body
+    assert body == b'[{"month":1,"remaining_balance":300.0,"monthly_payment":100.1}]'
+    assert body == validated_body(schemas.ScheduleItem, schedule)
+
+@pytest.mark.parametrize("amount", [0, 0.01, 0.1, 999.99, 123456789012.34, 9999999999999998.0])
+def test_fast_response_matches_validated_response_in_range(amount):
+    schedule = [{"month": 1, "remaining_balance": amount, "monthly_payment": Decimal(str(amount or 0.01))}]
+    assert fast_response(schemas.ScheduleItem, schedule).body == validated_body(schemas.ScheduleItem, schedule)
+
+def test_fast_response_exponent_beyond_range():
+    # Out of the supported range the numbers are equal, the bytes are not
+    schedule = [{"month": 1, "remaining_balance": 1e16, "monthly_payment": 1e16}]
+    assert fast_response(schemas.ScheduleItem, schedule).body == b'[{"month":1,"remaining_balance":1e16,"monthly_payment":1e16}]'
+    assert validated_body(schemas.ScheduleItem, schedule) == b'[{"month":1,"remaining_balance":1e+16,"monthly_payment":1e+16}]'
+
+def test_fast_response_rejects_nested_models():
+    with pytest.raises(TypeError):
+        fast_response(schemas.Portfolio, {})
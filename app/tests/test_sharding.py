@@ -0,0 +1,190 @@
+import json
+from collections import Counter
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import delete, select
+
+from app import database, sharding
+from app.config import settings
+from app.jobs import JOB_SUCCEEDED, InMemoryJobBackend, JobQueue
+from app.logic.shards import rebalance_loans
+from app.main import app
+from app.migrations import upgrade
+from app.models import Loan, LoanMonth, User
+from app.sharding import ID_BLOCKS_RESERVED, IdAllocator, ShardSession, allocate_loan_ids, get_shard_engine,\
+    shard_for_loan, shard_names
+
+client = TestClient(app)
+
+
+def clear_shards():
+    for cached in (database.get_engine, database._get_sessionmaker, sharding.get_shard_engine,
+                   sharding._get_shard_sessionmaker, sharding.get_id_allocator):
+        cached.cache_clear()
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "database_url", f"sqlite:///{tmp_path / 'main.db'}")
+    monkeypatch.setattr(settings, "shards", {shard: f"sqlite:///{tmp_path / shard}.db" for shard in ("a", "b")})
+    monkeypatch.setattr(settings, "shard_id_block_size", 10)
+    clear_shards()
+    for shard in shard_names():
+        upgrade(get_shard_engine(shard))
+    yield tmp_path
+    for shard in shard_names():
+        get_shard_engine(shard).dispose()
+    clear_shards()
+
+def loans_by_shard():
+    result = {}
+    for shard in shard_names():
+        db = ShardSession(shard)
+        try:
+            result[shard] = set(db.scalars(select(Loan.id)))
+        finally:
+            db.close()
+    return result
+
+def register(email):
+    response = client.post("/users/", json={"first_name": "Grey", "last_name": "Stone", "email": email})
+    assert response.status_code == 201
+    return response.json()
+
+def test_shard_for_loan():
+    shards = ["main", "a", "b"]
+    placement = {loan_id: shard_for_loan(loan_id, shards) for loan_id in range(1, 3001)}
+    assert placement == {loan_id: shard_for_loan(loan_id, shards) for loan_id in range(1, 3001)}
+    assert all(800 < count < 1200 for count in Counter(placement.values()).values())
+
+    # A new shard only takes loans, about a quarter of them, from the others
+    moved = [loan_id for loan_id, shard in placement.items() if shard_for_loan(loan_id, shards + ["c"]) != shard]
+    assert all(shard_for_loan(loan_id, shards + ["c"]) == "c" for loan_id in moved)
+    assert 600 < len(moved) < 900
+
+def test_allocate_loan_ids(shards):
+    db = ShardSession("b")
+    db.add(Loan(id=41, amount=1000, term=12, interest_rate=1))
+    db.commit()
+    db.close()
+    reserved = ID_BLOCKS_RESERVED.value()
+
+    # The first block starts after the loans created before the shards had ids handed out
+    assert allocate_loan_ids(3) == [42, 43, 44]
+    assert allocate_loan_ids() == [45]
+    # Larger requests than what is left of the block get a block of their own
+    assert allocate_loan_ids(25) == list(range(52, 77))
+    # Another process gets a block of its own
+    assert IdAllocator(block_size=10).allocate(2) == [77, 78]
+    assert allocate_loan_ids() == [87]
+    assert ID_BLOCKS_RESERVED.value() == reserved + 4
+
+def test_sharded_routes(shards, mocker):
+    grey = register("grey@greystone.com")
+    stone = register("stone@greystone.com")
+    # Users are replicated to every shard with their ids
+    for shard in shard_names():
+        db = ShardSession(shard)
+        assert db.scalars(select(User.id).order_by(User.id)).all() == [grey["id"], stone["id"]]
+        db.close()
+
+    loan_ids = [client.post("/loans/grey@greystone.com/", json={"amount": 10000 + 1000 * loan, "term": 12, "interest_rate": 4})
+                .json()["id"] for loan in range(6)]
+    bulk = client.post("/loans/bulk", json=[{"email": "grey@greystone.com", "amount": 5000, "term": 24, "interest_rate": 2},
+                                            {"email": "nobody@greystone.com", "amount": 5000, "term": 24, "interest_rate": 2}]).json()
+    assert bulk[1] == {"email": "nobody@greystone.com", "loan_id": None, "error": "No user for loan found"}
+    loan_ids.append(bulk[0]["loan_id"])
+    placed = loans_by_shard()
+    assert all(loan_id in placed[shard_for_loan(loan_id)] for loan_id in loan_ids)
+    assert sum(map(len, placed.values())) == 7
+    assert len([shard for shard in placed if placed[shard]]) > 1
+
+    # Single loan routes are answered by the loan's shard
+    for loan_id in loan_ids:
+        assert len(client.get(f"/loans/{loan_id}/schedule/").json()) in (12, 24)
+    assert client.get(f"/loans/{loan_ids[0]}/month/12/").json()["principal_balance"] == 0
+
+    response = client.get("/users/grey@greystone.com/loans/")
+    assert [loan["id"] for loan in response.json()] == sorted(loan_ids)
+    etag = response.headers["etag"]
+    assert client.get("/users/grey@greystone.com/loans/", headers={"If-None-Match": etag}).status_code == 304
+    assert client.patch(f"/loans/{loan_ids[0]}/share/stone@greystone.com/").status_code == 200
+    assert [loan["id"] for loan in client.get("/users/stone@greystone.com/loans/?include_months=false").json()] == [loan_ids[0]]
+    shares = [{"loan_id": loan_id, "email": "stone@greystone.com"} for loan_id in loan_ids]
+    assert [result["shared"] for result in client.patch("/loans/share", json=shares).json()] == [False] + [True] * 6
+    assert [loan["id"] for loan in client.get("/users/stone@greystone.com/loans/?include_months=false").json()] == sorted(loan_ids)
+    # Retries are answered from the shard the loan was placed on
+    created, replayed = [client.post("/loans/grey@greystone.com/", json={"amount": 1000, "term": 12, "interest_rate": 4},
+                                     headers={"Idempotency-Key": "shard-loan"}) for _ in range(2)]
+    assert replayed.headers["idempotent-replayed"] == "true" and replayed.json() == created.json()
+    assert client.get("/users/grey@greystone.com/loans/", headers={"If-None-Match": etag}).status_code == 200
+    assert client.get("/users/nobody@greystone.com/loans/").status_code == 404
+
+    portfolio = client.get("/users/grey@greystone.com/portfolio/", params={"month": 12}).json()
+    assert len(portfolio["loans"]) == 8
+    assert portfolio["principal_paid"] == pytest.approx(sum(loan["principal_paid"] for loan in portfolio["loans"]))
+
+    exported = [json.loads(line) for line in client.get("/loans/export/", params={"email": "grey@greystone.com"}).text.splitlines()]
+    assert len({row["loan_id"] for row in exported}) == 8
+    exported = [json.loads(line) for line in client.get("/loans/export/", params={"loan_id": loan_ids[:2]}).text.splitlines()]
+    assert sorted({row["loan_id"] for row in exported}) == sorted(loan_ids[:2])
+
+    mocker.patch("app.main.ping_db", return_value=True)
+    assert client.get("/health_check").status_code == 200
+
+def test_failed_user_replication(shards, mocker):
+    fan_out = sharding.fan_out
+    def fail_on_b(function, shards=None):
+        fan_out(function, ["a"])
+        raise RuntimeError("Shard b is down")
+    mocker.patch("app.logic.shards.fan_out", side_effect=fail_on_b)
+    with pytest.raises(RuntimeError):
+        register("grey@greystone.com")
+    # The user is only committed on the main shard once every shard has it, the copy left on a is replaced on retry
+    mocker.stopall()
+    assert client.get("/users/grey@greystone.com/loans/").status_code == 404
+    grey = register("grey@greystone.com")
+    for shard in shard_names():
+        db = ShardSession(shard)
+        assert db.execute(select(User.id, User.email)).all() == [(grey["id"], "grey@greystone.com")]
+        db.close()
+
+    # Loans placed on a shard the user is missing from are refused
+    db = ShardSession("b")
+    db.execute(delete(User.__table__))
+    db.commit()
+    db.close()
+    statuses = {client.post("/loans/grey@greystone.com/", json={"amount": 1000, "term": 12, "interest_rate": 4}).status_code
+                for _ in range(10)}
+    assert statuses == {201, 409}
+
+def test_sharded_background_jobs(shards):
+    register("jobs@greystone.com")
+    queue = JobQueue(InMemoryJobBackend(ttl=60))
+    queue.submit("create_loan", {"email": "jobs@greystone.com", "loan": {"amount": 1000, "term": 36, "interest_rate": 3}})
+    job = queue.run_next()
+    assert job.status == JOB_SUCCEEDED
+    assert job.result["loan_id"] in loans_by_shard()[shard_for_loan(job.result["loan_id"])]
+
+def test_rebalance_loans(shards, monkeypatch):
+    register("grey@greystone.com")
+    loans = [{"email": "grey@greystone.com", "amount": 1000, "term": 12, "interest_rate": 3} for _ in range(30)]
+    loan_ids = [result["loan_id"] for result in client.post("/loans/bulk", json=loans).json()]
+
+    monkeypatch.setattr(settings, "shards", {**settings.shards, "c": f"sqlite:///{shards / 'c'}.db"})
+    upgrade(get_shard_engine("c"))
+    assert rebalance_loans(batch_size=4) == sum(shard_for_loan(loan_id) == "c" for loan_id in loan_ids) > 0
+    placed = loans_by_shard()
+    assert all(loan_id in placed[shard_for_loan(loan_id)] for loan_id in loan_ids)
+    assert sum(map(len, placed.values())) == 30
+    db = ShardSession("c")
+    assert db.scalar(select(User.email)) == "grey@greystone.com"
+    assert db.query(LoanMonth).count() == 12 * len(placed["c"])
+    db.close()
+    assert [loan["id"] for loan in client.get("/users/grey@greystone.com/loans/").json()] == loan_ids
+    assert rebalance_loans() == 0
+
+    assert rebalance_loans(drain=["c"]) == len(placed["c"])
+    assert not loans_by_shard()["c"]
+    with pytest.raises(ValueError):
+        rebalance_loans(drain=["main"])
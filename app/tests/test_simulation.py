@@ -0,0 +1,37 @@
+from app.logic.common import generate_amoritization_schedule
+from app.logic.simulation import build_scenario_grid, run_simulation, simulate_scenarios
+
+
+def test_baseline_scenario_matches_schedule():
+    schedule = generate_amoritization_schedule(interest=6.5, term=360, principal=250000)
+    total_interest, payoff_month = simulate_scenarios(6.5, 360, 250000, [(0, [], [])])
+    assert abs(total_interest[0] - sum(interest for _, interest in schedule)) < 1
+    assert payoff_month[0] == 360
+
+def test_prepayments_shorten_the_loan():
+    total_interest, payoff_month = simulate_scenarios(6.5, 360, 250000, [(0, [], []), (200, [], []), (500, [], []),
+                                                                         (0, [(12, 50000)], []), (0, [(1, 250000)], [])])
+    assert list(total_interest[:3]) == sorted(total_interest[:3], reverse=True)
+    assert list(payoff_month[:3]) == sorted(payoff_month[:3], reverse=True)
+    assert payoff_month[3] < 360 and total_interest[3] < total_interest[0]
+    assert payoff_month[4] == 1 and total_interest[4] == round(250000 * 0.065 / 12, 2)
+
+def test_rate_resets():
+    total_interest, payoff_month = simulate_scenarios(6.5, 360, 250000, [(0, [], []), (0, [], [(61, 6.5)]),
+                                                                         (0, [], [(61, 8.5)]), (0, [], [(61, 4.5)])])
+    assert abs(total_interest[1] - total_interest[0]) < 1
+    assert total_interest[2] > total_interest[0] > total_interest[3]
+    assert list(payoff_month) == [360] * 4
+
+def test_zero_interest_scenarios():
+    total_interest, payoff_month = simulate_scenarios(0, 12, 1200, [(0, [], []), (100, [], []), (0, [], [(7, 12)])])
+    # The last 600 amortize over 6 months at 1% a month: 6 payments of 103.53, settled at 103.51
+    assert list(total_interest) == [0, 0, 21.16]
+    assert list(payoff_month) == [12, 6, 12]
+
+def test_run_simulation_in_batches():
+    grid = build_scenario_grid([0, 100, 250], [[], [(24, 10000)]], [[], [(61, 7.5)], [(61, 5.5), (121, 8)]])
+    assert len(grid) == 18
+    inline = run_simulation(6.5, 360, 250000, grid, batch_size=len(grid))
+    assert run_simulation(6.5, 360, 250000, grid, batch_size=4) == inline
+    assert all(isinstance(total_interest, float) and isinstance(payoff_month, int) for total_interest, payoff_month in inline)
@@ -0,0 +1,53 @@
+"""
+Synthetic portfolios for the benchmarks: users holding loans of realistic amounts, terms and rates.
+"""
+import os
+import random
+from dataclasses import dataclass
+
+from sqlalchemy.orm import Session, sessionmaker
+
+TERMS = (120, 180, 240, 360)
+
+
+@dataclass
+class Dataset:
+    emails: list[str]
+    loan_ids: list[int]
+
+def generate_dataset(db: Session, users: int, loans: int, seed: int = 0, prefix: str = "bench") -> Dataset:
+    """
+    Creates `users` users sharing `loans` loans between them, round robin. The loans are drawn from a
+    random generator seeded with `seed`, so the same arguments always produce the same portfolio.
+    """
+    from app.logic.loan import create_loans_bulk
+    from app.models import User
+    from app.schemas import LoanBulkCreate
+
+    rng = random.Random(seed)
+    emails = [f"{prefix}_{user}@greystone.com" for user in range(users)]
+    db.add_all(User(first_name="Bench", last_name="Mark", email=email) for email in emails)
+    db.commit()
+    results = create_loans_bulk(db, [LoanBulkCreate(amount=rng.randint(50, 500) * 1000, term=rng.choice(TERMS),
+                                                    interest_rate=rng.randint(16, 64) / 8, email=emails[loan % users])
+                                     for loan in range(loans)])
+    return Dataset(emails=emails, loan_ids=[result.loan_id for result in results])
+
+def create_database(directory: str, users: int, loans: int, seed: int = 0, name: str = "greystone_app.db"):
+    """
+    Creates the SQLite database `name` in `directory` holding a generated portfolio.
+    Returns its URL along with the Dataset.
+    """
+    from app.database import create_db_engine
+    from app.migrations import upgrade
+
+    url = f"sqlite:///{os.path.join(directory, name)}"
+    engine = create_db_engine(url)
+    upgrade(engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        dataset = generate_dataset(db, users, loans, seed)
+    finally:
+        db.close()
+        engine.dispose()
+    return url, dataset
@@ -0,0 +1,97 @@
+"""
+Compares the request throughput of the sync (threadpool) and async database paths.
+
+Each mode is served by its own uvicorn process over the same seeded SQLite database, and hammered
+with the read routes (schedule, month summary and user loans) by a fixed number of concurrent clients.
+
+Usage: python -m benchmarks.load_test [--duration 10] [--concurrency 64] [--loans 200]
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.dataset import create_database
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = {"sync": "0", "async": "1"}
+
+
+def seed(directory: str, users: int, loans: int):
+    """
+    Creates greystone_app.db in `directory` with `users` users sharing `loans` loans between them.
+    Returns the paths that the clients request.
+    """
+    _, dataset = create_database(directory, users, loans, seed=random.randrange(2**32))
+    paths = [f"/users/{email}/loans/?include_months=false" for email in dataset.emails]
+    for loan_id in dataset.loan_ids:
+        paths.append(f"/loans/{loan_id}/schedule/")
+        paths.append(f"/loans/{loan_id}/month/{random.randint(1, 120)}/")
+    return paths
+
+def serve(mode: str, directory: str, port: int):
+    env = {**os.environ, "GREYSTONE_DATABASE_ASYNC": MODES[mode], "PYTHONPATH": REPO_ROOT}
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+                            cwd=directory, env=env)
+
+async def wait_until_up(base_url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while True:
+            try:
+                if (await client.get("/health_check")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+            await asyncio.sleep(0.2)
+
+async def hammer(base_url: str, paths: list[str], duration: float, concurrency: int):
+    """
+    Requests random paths from `concurrency` concurrent clients for `duration` seconds.
+    Returns the number of (successful, failed) requests.
+    """
+    counts = {"ok": 0, "failed": 0}
+    deadline = time.monotonic() + duration
+
+    async def client_loop(client: httpx.AsyncClient):
+        while time.monotonic() < deadline:
+            response = await client.get(random.choice(paths))
+            counts["ok" if response.status_code == 200 else "failed"] += 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+    return counts["ok"], counts["failed"]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=10, help="seconds to load each mode for")
+    parser.add_argument("--concurrency", type=int, default=64, help="number of concurrent clients")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--loans", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = seed(directory, args.users, args.loans)
+        print(f"{'mode':<8}{'requests/sec':>14}{'ok':>10}{'failed':>10}")
+        for mode in MODES:
+            server = serve(mode, directory, args.port)
+            try:
+                base_url = f"http://127.0.0.1:{args.port}"
+                asyncio.run(wait_until_up(base_url))
+                ok, failed = asyncio.run(hammer(base_url, paths, args.duration, args.concurrency))
+            finally:
+                server.terminate()
+                server.wait()
+            print(f"{mode:<8}{ok / args.duration:>14.1f}{ok:>10}{failed:>10}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Measures how loan write throughput scales with the number of shards.
+
+For every --shards count a fresh set of SQLite shard files is created, the main shard and count - 1 further
+ones, and --writers processes create loans through the loan creation path of the routes for --duration seconds.
+With a single database every write waits for its one write lock, the writers of several shards mostly take
+different ones.
+
+Usage: python -m benchmarks.shard_writes [--shards 1 2 4] [--writers 4] [--duration 5] [--term 360]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+EMAIL = "bench@greystone.com"
+
+
+def shard_env(directory: str, shards: int):
+    return {"GREYSTONE_DATABASE_URL": f"sqlite:///{os.path.join(directory, 'main.db')}",
+            "GREYSTONE_SHARDS": json.dumps({f"shard{shard}": f"sqlite:///{os.path.join(directory, f'shard{shard}.db')}"
+                                            for shard in range(1, shards)})}
+
+def setup(env: dict):
+    """
+    Migrates every shard and registers the user the loans are created for
+    """
+    os.environ.update(env)
+    from app.database import SessionLocal
+    from app.logic.shards import create_user_on_shards
+    from app.logic.user import create_user
+    from app.migrations import upgrade
+    from app.schemas import UserCreate
+    from app.sharding import get_shard_engine, shard_names, sharding_enabled
+
+    for shard in shard_names():
+        upgrade(get_shard_engine(shard))
+    db = SessionLocal()
+    try:
+        user = UserCreate(first_name="Bench", last_name="Mark", email=EMAIL)
+        if sharding_enabled():
+            create_user_on_shards(db, user)
+        else:
+            create_user(db, user)
+    finally:
+        db.close()
+
+def write_loans(env: dict, start: float, duration: float, term: int):
+    """
+    Creates and serializes loans from `start` until `duration` seconds later, like POST /loans/{email}/ does.
+    Returns the number of loans created.
+    """
+    os.environ.update(env)
+    from app.database import SessionLocal
+    from app.logic.loan import create_loan
+    from app.logic.shards import create_loan_on_shard
+    from app.logic.user import get_user_by_email
+    from app.schemas import Loan, LoanCreate
+    from app.sharding import sharding_enabled
+
+    loan = LoanCreate(amount=250000, term=term, interest_rate=5.5)
+    time.sleep(max(0, start - time.time()))
+    count = 0
+    while time.time() < start + duration:
+        if sharding_enabled():
+            create_loan_on_shard(loan, EMAIL)
+        else:
+            db = SessionLocal()
+            try:
+                Loan.from_orm(create_loan(db, loan, get_user_by_email(db, EMAIL)))
+            finally:
+                db.close()
+        count += 1
+    return count
+
+def measure(shards: int, writers: int, duration: float, term: int):
+    with tempfile.TemporaryDirectory() as directory:
+        env = shard_env(directory, shards)
+        with ProcessPoolExecutor(writers, mp_context=get_context("spawn")) as pool:
+            pool.submit(setup, env).result()
+            start = time.time() + 2
+            counts = list(pool.map(write_loans, *zip(*[(env, start, duration, term)] * writers)))
+    return sum(counts) / duration
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4], help="numbers of shards")
+    parser.add_argument("--writers", type=int, default=4, help="number of writing processes")
+    parser.add_argument("--duration", type=float, default=5, help="seconds to write for")
+    parser.add_argument("--term", type=int, default=360, help="months of every loan created")
+    args = parser.parse_args()
+
+    print(f"{'shards':<8}{'loans/sec':>12}{'speedup':>10}")
+    baseline = None
+    for shards in args.shards:
+        throughput = measure(shards, args.writers, args.duration, args.term)
+        baseline = baseline or throughput
+        print(f"{shards:<8}{throughput:>12.1f}{throughput / baseline:>9.2f}x", flush=True)
+
+if __name__ == "__main__":
+    main()
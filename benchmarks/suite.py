@@ -0,0 +1,277 @@
+"""
+Micro benchmarks for the amortization math, the loan logic and the HTTP routes.
+
+Every benchmark is timed over several rounds, each round calling it enough times to take at least
+--min-time seconds, and reported as seconds per call. The logic and route benchmarks run against
+synthetic portfolios of each --portfolio-sizes number of loans, with the loan cache disabled so the
+database path is what gets measured.
+
+Results can be written as JSON with --output. A results file saved from an earlier run can be passed
+to --compare, which makes the run exit with status 1 when any benchmark's median got more than
+--max-slowdown percent slower than in that baseline.
+
+Usage: python -m benchmarks.suite [-k schedule] [--output results.json] [--compare baseline.json --max-slowdown 10]
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy.orm import sessionmaker
+
+AMORTIZATION_TERMS = (12, 60, 120, 240, 360, 480)
+
+
+class Suite:
+    def __init__(self):
+        self.benchmarks = {}
+
+    def add(self, name: str, function):
+        self.benchmarks[name] = function
+
+    def run(self, pattern: str | None = None, rounds: int = 5, min_time: float = 0.05):
+        """
+        Times the benchmarks whose name contains `pattern`, returning their statistics by name
+        """
+        results = {}
+        for name, function in self.benchmarks.items():
+            if pattern and pattern not in name:
+                continue
+            results[name] = timeit(function, rounds, min_time)
+            print(f"{name:<56}{results[name]['median'] * 1000:>12.3f} ms", flush=True)
+        return results
+
+def timeit(function, rounds: int, min_time: float):
+    """
+    Times `rounds` rounds of calls to `function`, calibrating the number of calls per round so a round
+    takes at least `min_time` seconds. Returns the per call timings in seconds.
+    """
+    number = 1
+    while True:
+        elapsed = _time_calls(function, number)
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    timings = [elapsed / number] + [_time_calls(function, number) / number for _ in range(rounds - 1)]
+    return {"min": min(timings), "median": statistics.median(timings), "mean": statistics.fmean(timings),
+            "max": max(timings), "rounds": rounds, "calls_per_round": number}
+
+def _time_calls(function, number: int):
+    start = time.perf_counter()
+    for _ in range(number):
+        function()
+    return time.perf_counter() - start
+
+def compare(results: dict, baseline: dict, max_slowdown: float):
+    """
+    Compares the medians of `results` with those of the same benchmarks in `baseline`.
+    Returns the (name, baseline median, median, change in percent) of the benchmarks that slowed down by
+    more than `max_slowdown` percent.
+    """
+    regressions = []
+    print(f"\n{'benchmark':<56}{'baseline ms':>14}{'ms':>12}{'change':>10}")
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]["median"], stats["median"]
+        change = (after - before) / before * 100
+        flag = " <-- slower" if change > max_slowdown else ""
+        print(f"{name:<56}{before * 1000:>14.3f}{after * 1000:>12.3f}{change:>+9.1f}%{flag}")
+        if change > max_slowdown:
+            regressions.append((name, before, after, change))
+    return regressions
+
+def add_amortization_benchmarks(suite: Suite):
+    """
+    Times the schedules of loans whose factors are in the factor table against cold ones, which clear the
+    table first and so compute the factors of every product they price
+    """
+    from app.logic.common import amortization_factors, generate_amoritization_schedule, generate_amoritization_schedules
+
+    def cold(function):
+        def run():
+            amortization_factors.cache_clear()
+            function()
+        return run
+
+    for term in AMORTIZATION_TERMS:
+        schedule = lambda term=term: generate_amoritization_schedule(interest=6.5, term=term, principal=250000)
+        suite.add(f"amortization/term={term}", schedule)
+        suite.add(f"amortization/term={term} cold", cold(schedule))
+    batch = lambda: generate_amoritization_schedules([6.5] * 1000, [360] * 1000, [250000] * 1000)
+    suite.add("amortization/batch=1000x360", batch)
+    suite.add("amortization/batch=1000x360 cold", cold(batch))
+
+    # A book of standard products, 15, 20 and 30 year terms at rates in 0.125% steps
+    rng = random.Random(0)
+    rates = [rng.randint(16, 64) / 8 for _ in range(1000)]
+    terms = [rng.choice((180, 240, 360)) for _ in range(1000)]
+    principals = [rng.randint(50, 500) * 1000 for _ in range(1000)]
+    products = lambda: generate_amoritization_schedules(rates, terms, principals)
+    suite.add("amortization/batch=1000 standard products", products)
+    suite.add("amortization/batch=1000 standard products cold", cold(products))
+
+def add_simulation_benchmarks(suite: Suite):
+    from app.logic.simulation import build_scenario_grid, run_simulation
+
+    grid = build_scenario_grid([extra * 10 for extra in range(100)],
+                               [[], [(12, 5000)], [(24, 20000)], [(12, 1000), (36, 1000)], [(60, 50000)]] * 2,
+                               [[], [(61, 7)], [(61, 5)], [(85, 9)], [(61, 7), (73, 8)]] * 2)
+    suite.add(f"simulation/scenarios={len(grid)}x360", lambda: run_simulation(6.5, 360, 250000, grid))
+
+def add_serialization_benchmarks(suite: Suite):
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from pydantic import parse_obj_as
+    from app import schemas
+    from app.logic.loan import build_loan_schedule
+    from app.models import SCHEDULE_LAZY, Loan
+    from app.serialization import fast_response
+
+    schedule = build_loan_schedule(Loan(amount=250000, interest_rate=6.5, term=360, schedule_storage=SCHEDULE_LAZY))
+    suite.add("serialize/schedule=360 validated",
+              lambda: JSONResponse(jsonable_encoder(parse_obj_as(list[schemas.ScheduleItem], schedule))))
+    suite.add("serialize/schedule=360 fast", lambda: fast_response(schemas.ScheduleItem, schedule))
+
+def add_logic_benchmarks(suite: Suite, directory: str, portfolio_sizes: list[int]):
+    from app.config import settings
+    from app.database import create_db_engine
+    from app.logic.loan import create_loan, get_loan_schedule, get_month_summary
+    from app.logic.portfolio import get_user_portfolio
+    from app.logic.user import get_user_by_email, get_user_loans
+    from app.schemas import LoanCreate
+    from benchmarks.dataset import create_database
+
+    for size in portfolio_sizes:
+        url, dataset = create_database(directory, users=max(1, size // 10), loans=size, name=f"logic_{size}.db")
+        db = sessionmaker(autocommit=False, autoflush=False, bind=create_db_engine(url))()
+        rng = random.Random(size)
+        user = get_user_by_email(db, dataset.emails[0])
+
+        def read_schedule(db=db, rng=rng, loan_ids=dataset.loan_ids):
+            get_loan_schedule(db, rng.choice(loan_ids))
+            db.expunge_all()
+
+        def read_window(db=db, rng=rng, loan_ids=dataset.loan_ids):
+            get_loan_schedule(db, rng.choice(loan_ids), from_month=13, to_month=24)
+
+        suite.add(f"get_loan_schedule/portfolio={size}", read_schedule)
+        suite.add(f"get_loan_schedule[13:24]/portfolio={size}", read_window)
+        suite.add(f"get_month_summary/portfolio={size}",
+                  lambda db=db, rng=rng, loan_ids=dataset.loan_ids: get_month_summary(db, rng.choice(loan_ids), rng.randint(1, 120)))
+
+        settings.schedule_storage = "packed"
+        packed_url, packed = create_database(directory, users=max(1, size // 10), loans=size, name=f"logic_{size}_packed.db")
+        settings.schedule_storage = "rows"
+        packed_db = sessionmaker(autocommit=False, autoflush=False, bind=create_db_engine(packed_url))()
+        suite.add(f"get_loan_schedule/portfolio={size} storage=packed",
+                  lambda db=packed_db, rng=rng, loan_ids=packed.loan_ids: read_schedule(db, rng, loan_ids))
+        suite.add(f"get_loan_schedule[13:24]/portfolio={size} storage=packed",
+                  lambda db=packed_db, rng=rng, loan_ids=packed.loan_ids: read_window(db, rng, loan_ids))
+        suite.add(f"get_month_summary/portfolio={size} storage=packed",
+                  lambda db=packed_db, rng=rng, loan_ids=packed.loan_ids: get_month_summary(db, rng.choice(loan_ids), rng.randint(1, 120)))
+
+        def read_user_loans(db=db, user=user):
+            get_user_loans(db, user, include_months=False)
+            db.expunge_all()
+
+        suite.add(f"get_user_loans/portfolio={size}", read_user_loans)
+        suite.add(f"get_user_portfolio/portfolio={size}",
+                  lambda db=db, user=user, rng=rng: get_user_portfolio(db, user, rng.randint(1, 120)))
+
+    url, dataset = create_database(directory, users=1, loans=0, name="create_loan.db")
+    db = sessionmaker(autocommit=False, autoflush=False, bind=create_db_engine(url))()
+    user = get_user_by_email(db, dataset.emails[0])
+    for storage in ("rows", "lazy", "packed"):
+        def create(db=db, user=user, storage=storage):
+            settings.schedule_storage = storage
+            create_loan(db, LoanCreate(amount=250000, interest_rate=6.5, term=360), user)
+        suite.add(f"create_loan/storage={storage}", create)
+
+def add_route_benchmarks(suite: Suite, dataset):
+    """
+    Benchmarks the routes through the TestClient against the configured database, which must already hold
+    the generated `dataset` when app.main is imported
+    """
+    from fastapi.testclient import TestClient
+    from app.config import settings
+    from app.main import app
+
+    client = TestClient(app)
+    rng = random.Random(0)
+    url_loans = [f"/loans/{loan_id}" for loan_id in dataset.loan_ids]
+    emails = dataset.emails
+    portfolio_size = len(dataset.loan_ids)
+
+    def get(path, fast_serialization=False):
+        settings.fast_serialization = fast_serialization
+        response = client.get(path)
+        assert response.status_code == 200, (path, response.status_code)
+
+    suite.add(f"GET /loans/{{id}}/schedule/ portfolio={portfolio_size}", lambda: get(f"{rng.choice(url_loans)}/schedule/"))
+    suite.add(f"GET /loans/{{id}}/schedule/ fast portfolio={portfolio_size}",
+              lambda: get(f"{rng.choice(url_loans)}/schedule/", fast_serialization=True))
+    suite.add(f"GET /loans/{{id}}/schedule/ window=13-24 portfolio={portfolio_size}",
+              lambda: get(f"{rng.choice(url_loans)}/schedule/?from_month=13&to_month=24"))
+    suite.add(f"GET /loans/{{id}}/month/{{month}}/ portfolio={portfolio_size}",
+              lambda: get(f"{rng.choice(url_loans)}/month/{rng.randint(1, 120)}/"))
+    suite.add(f"GET /loans/{{id}}/month/{{month}}/ fast portfolio={portfolio_size}",
+              lambda: get(f"{rng.choice(url_loans)}/month/{rng.randint(1, 120)}/", fast_serialization=True))
+    suite.add(f"GET /users/{{email}}/loans/ portfolio={portfolio_size}",
+              lambda: get(f"/users/{rng.choice(emails)}/loans/?include_months=false"))
+    suite.add(f"GET /users/{{email}}/portfolio/ portfolio={portfolio_size}",
+              lambda: get(f"/users/{rng.choice(emails)}/portfolio/?month={rng.randint(1, 120)}"))
+
+    def post_loan():
+        settings.schedule_storage = "rows"
+        response = client.post(f"/loans/{emails[0]}/", json={"amount": 250000, "interest_rate": 6.5, "term": 360})
+        assert response.status_code == 201, response.status_code
+    suite.add("POST /loans/{email}/", post_loan)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", dest="pattern", help="only run the benchmarks whose name contains this")
+    parser.add_argument("--portfolio-sizes", type=int, nargs="+", default=[100, 1000], help="numbers of loans")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.05, help="minimum seconds per round")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="a results file to compare the run against")
+    parser.add_argument("--max-slowdown", type=float, default=10, help="percent slower than the baseline that fails the run")
+    args = parser.parse_args()
+
+    from app.config import settings
+    from app.logic.cache import get_loan_cache
+
+    settings.cache_backend = "none"
+    get_loan_cache.cache_clear()
+    suite = Suite()
+    with tempfile.TemporaryDirectory() as directory:
+        add_amortization_benchmarks(suite)
+        add_simulation_benchmarks(suite)
+        add_serialization_benchmarks(suite)
+        add_logic_benchmarks(suite, directory, args.portfolio_sizes)
+        from benchmarks.dataset import create_database
+        settings.database_url, dataset = create_database(directory, users=max(1, args.portfolio_sizes[-1] // 10),
+                                                         loans=args.portfolio_sizes[-1], name="routes.db")
+        add_route_benchmarks(suite, dataset)
+        results = suite.run(args.pattern, args.rounds, args.min_time)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"created": datetime.now(timezone.utc).isoformat(), "python": platform.python_version(),
+                       "machine": platform.machine(), "benchmarks": results}, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["benchmarks"]
+        regressions = compare(results, baseline, args.max_slowdown)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) more than {args.max_slowdown:g}% slower than the baseline")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()